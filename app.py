@@ -1,73 +1,52 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.http import is_resource_modified
+from sqlalchemy.orm import joinedload, selectinload
 import os
 import random
 import copy
 import math
 import time
 import json
+import gzip
 
 # Import models
-from models import db, Faculty, Teacher, Group, Room, Course, CourseGroup, ScheduleItem, Settings, LabSubgroup, CourseTeacher
+from models import (db, Faculty, Teacher, Group, Room, Course, CourseGroup, ScheduleItem, Settings, LabSubgroup,
+                    CourseTeacher, ScheduleVersion, schedule_item_group)
 
 # Import forms
 from forms import (FacultyForm, TeacherForm, GroupForm, RoomForm, CourseForm,
                   SettingsForm, ManualScheduleItemForm, SubgroupForm)
 
-# Import scheduler
-from scheduler import ScheduleGenerator
+# Import conflict checks for manual placement
+from conflicts import Placement, check_placements, check_schedule_conflicts
+
+# Import background schedule generation
+from jobs import submit_generation, get_job, cancel_job
+from versions import (get_active_version_id, active_schedule_items, get_or_create_active_version,
+                      activate_version, bump_schedule_revision)
+from bulk_operations import apply_bulk_operation
+from free_slots import get_occupancy_index
+from timetables import (ENTITY_TYPES, get_timetable, get_timetables, encode_timetables, item_timetable_entities,
+                        refresh_timetables, invalidate_timetables)
+
+# Import response cache for timetable endpoints
+from schedule_cache import response_cache
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///schedule.db'
+# Другую базу данных (например, временную для тестов) можно задать переменной окружения
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SCHEDULE_DATABASE_URI', 'sqlite:///schedule.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Initialize extensions
 db.init_app(app)
 csrf = CSRFProtect(app)
 
-# Helper functions
-def check_schedule_conflicts(time_key, teacher_id, room_id, group_ids, exclude_id=None):
-    """
-    Проверяет наличие конфликтов в расписании при добавлении нового занятия.
-    Возвращает список строк с описаниями конфликтов.
-    """
-    week, day, time_slot = time_key
-    conflicts = []
-
-    # Получаем существующие занятия в это время
-    existing_items = ScheduleItem.query.filter_by(
-        week=week, day=day, time_slot=time_slot
-    ).all()
-
-    # Исключаем элемент, который редактируется
-    if exclude_id:
-        existing_items = [item for item in existing_items if item.id != exclude_id]
-
-    # Проверка на конфликт преподавателя
-    teacher_conflicts = [item for item in existing_items if item.teacher_id == teacher_id]
-    if teacher_conflicts:
-        teacher = Teacher.query.get(teacher_id)
-        conflicts.append(f"Преподаватель {teacher.name} уже занят в это время другим занятием")
-
-    # Проверка на конфликт аудитории
-    room_conflicts = [item for item in existing_items if item.room_id == room_id]
-    if room_conflicts:
-        room = Room.query.get(room_id)
-        conflicts.append(f"Аудитория {room.name} уже занята в это время")
-
-    # Проверка на конфликт групп
-    for item in existing_items:
-        item_group_ids = item.get_group_ids()
-        for group_id in group_ids:
-            if group_id in item_group_ids:
-                group = Group.query.get(group_id)
-                conflicts.append(f"Группа {group.name} уже имеет занятие в это время")
-                break
-
-    return conflicts
-
+MAX_BATCH_TIMETABLES = 500  # сколько расписаний можно запросить одним обращением к /api/timetables
+MAX_CHECKED_PLACEMENTS = 1000  # сколько размещений можно проверить одним обращением к /api/check-conflicts
 
+# Helper functions
 def get_day_name(day_index):
     """Возвращает название дня недели по индексу"""
     days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница']
@@ -85,6 +64,93 @@ def get_time_name(slot_index):
     return "Неизвестное время"
 
 
+def schedule_items_query(query):
+    """Запрос занятий с загрузкой дисциплин, аудиторий, преподавателей и подгрупп join'ом, групп - IN-запросом"""
+    return query.options(
+        joinedload(ScheduleItem.course, innerjoin=True),
+        joinedload(ScheduleItem.room),
+        joinedload(ScheduleItem.teacher),
+        joinedload(ScheduleItem.lab_subgroup),
+        selectinload(ScheduleItem.assigned_groups)
+    )
+
+
+def load_schedule_items(query):
+    """
+    Загружает занятия вместе с дисциплинами, аудиториями, преподавателями, подгруппами и группами.
+    Число запросов не зависит от количества занятий: связи загружаются join'ом, группы - одним IN-запросом.
+    """
+    return schedule_items_query(query).all()
+
+
+def get_item_group_names(item):
+    """Названия групп занятия в порядке строки groups (группы загружены load_schedule_items)"""
+    groups_by_id = {group.id: group for group in item.assigned_groups}
+    return [groups_by_id[group_id].name for group_id in item.get_group_ids() if group_id in groups_by_id]
+
+
+def get_fallback_teachers(items):
+    """
+    Преподаватели из CourseTeacher для занятий без teacher_id, одним запросом.
+    Возвращает словарь (course_id, lesson_type, lab_subgroup_id) -> Teacher.
+    """
+    course_ids = {item.course_id for item in items if not item.teacher_id}
+    if not course_ids:
+        return {}
+
+    fallback = {}
+    course_teachers = (CourseTeacher.query.options(joinedload(CourseTeacher.teacher))
+                       .filter(CourseTeacher.course_id.in_(course_ids))
+                       .order_by(CourseTeacher.id))
+    for course_teacher in course_teachers:
+        fallback.setdefault((course_teacher.course_id, course_teacher.lesson_type, course_teacher.lab_subgroup_id),
+                            course_teacher.teacher)
+    return fallback
+
+
+def get_schedule_revision():
+    """Ревизия видимого расписания и время ее изменения"""
+    settings = Settings.query.first()
+    if settings is None:
+        return 0, None
+    return settings.schedule_revision or 0, settings.schedule_modified_at
+
+
+def cached_schedule_response(key, build, compress=False):
+    """
+    JSON-ответ расписания с ETag и Last-Modified по ревизии расписания.
+    Условный запрос с актуальной ревизией получает 304 без чтения занятий, остальные - готовый
+    ответ из кэша процесса; build() вызывается только при промахе кэша.
+    При compress=True клиенту, принимающему gzip, отдается (и кэшируется) сжатый ответ.
+    """
+    use_gzip = compress and request.accept_encodings.quality('gzip') > 0
+    revision, modified_at = get_schedule_revision()
+    etag = f"schedule-{revision}-gzip" if use_gzip else f"schedule-{revision}"
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modified_at):
+        response = app.response_class(status=304)
+    else:
+        cache_key = (revision, use_gzip) + key
+        body = response_cache.get(cache_key)
+        if body is None:
+            body = jsonify(build()).get_data()
+            if use_gzip:
+                body = gzip.compress(body, compresslevel=6)
+            response_cache.put(cache_key, body)
+        response = app.response_class(body, mimetype='application/json')
+        if use_gzip:
+            response.content_encoding = 'gzip'
+
+    if compress:
+        response.vary.add('Accept-Encoding')
+
+    response.set_etag(etag)
+    response.last_modified = modified_at
+    # Браузер может хранить ответ, но перед использованием сверяет ревизию с сервером
+    response.cache_control.no_cache = True
+    return response
+
+
 # Маршруты
 @app.route('/')
 def index():
@@ -99,7 +165,7 @@ def index():
     room_count = Room.query.count()
     course_count = Course.query.count()
     faculty_count = Faculty.query.count()
-    schedule_exists = ScheduleItem.query.first() is not None
+    schedule_exists = active_schedule_items().first() is not None
 
     return render_template('index.html',
                            settings=settings,
@@ -199,6 +265,7 @@ def add_teacher():
             notes=form.notes.data
         )
         db.session.add(teacher)
+        bump_schedule_revision()
         db.session.commit()
         flash('Преподаватель успешно добавлен!', 'success')
         return redirect(url_for('teachers_list'))
@@ -223,6 +290,7 @@ def edit_teacher(id):
         teacher.max_lessons_per_day = form.max_lessons_per_day.data
         teacher.notes = form.notes.data
 
+        invalidate_timetables()
         db.session.commit()
         flash('Данные преподавателя обновлены!', 'success')
         return redirect(url_for('teachers_list'))
@@ -233,6 +301,7 @@ def edit_teacher(id):
 def delete_teacher(id):
     teacher = Teacher.query.get_or_404(id)
     db.session.delete(teacher)
+    invalidate_timetables()
     db.session.commit()
     flash('Преподаватель удален!', 'success')
     return redirect(url_for('teachers_list'))
@@ -275,6 +344,7 @@ def add_group():
         # Создаем подгруппы если нужно
         group.create_subgroups()
 
+        bump_schedule_revision()
         db.session.commit()
         flash('Группа успешно добавлена!', 'success')
         return redirect(url_for('groups_list'))
@@ -314,6 +384,7 @@ def edit_group(id):
         if old_subgroups_count != group.lab_subgroups_count:
             group.create_subgroups()
 
+        invalidate_timetables()
         db.session.commit()
         flash('Данные группы обновлены!', 'success')
         return redirect(url_for('groups_list'))
@@ -325,6 +396,7 @@ def edit_group(id):
 def delete_group(id):
     group = Group.query.get_or_404(id)
     db.session.delete(group)
+    invalidate_timetables()
     db.session.commit()
     flash('Группа удалена!', 'success')
     return redirect(url_for('groups_list'))
@@ -368,6 +440,7 @@ def add_room():
             notes=form.notes.data
         )
         db.session.add(room)
+        bump_schedule_revision()
         db.session.commit()
         flash('Аудитория успешно добавлена!', 'success')
         return redirect(url_for('rooms_list'))
@@ -380,6 +453,7 @@ def edit_room(id):
     form = RoomForm(obj=room)
     if form.validate_on_submit():
         form.populate_obj(room)
+        invalidate_timetables()
         db.session.commit()
         flash('Данные аудитории обновлены!', 'success')
         return redirect(url_for('rooms_list'))
@@ -390,6 +464,7 @@ def edit_room(id):
 def delete_room(id):
     room = Room.query.get_or_404(id)
     db.session.delete(room)
+    invalidate_timetables()
     db.session.commit()
     flash('Аудитория удалена!', 'success')
     return redirect(url_for('rooms_list'))
@@ -530,6 +605,7 @@ def add_course():
                 if room:
                     course.preferred_rooms.append(room)
 
+        bump_schedule_revision()
         db.session.commit()
 
         # Проверяем что реально сохранилось в базе
@@ -726,6 +802,7 @@ def edit_course(id):
                     teacher_name = Teacher.query.get(lab_teacher_id).name
                     teachers_added.append(f"лабораторные: {teacher_name}")
 
+        invalidate_timetables()
         db.session.commit()
 
         # Проверяем что реально сохранилось в базе
@@ -754,6 +831,7 @@ def delete_course(id):
     CourseGroup.query.filter_by(course_id=course.id).delete()
     # Удаляем связи с преподавателями (автоматически через cascade)
     db.session.delete(course)
+    invalidate_timetables()
     db.session.commit()
     flash('Дисциплина удалена!', 'success')
     return redirect(url_for('courses_list'))
@@ -761,45 +839,81 @@ def delete_course(id):
 
 @app.route('/generate-schedule')
 def generate_schedule():
-    # Удалим существующее расписание, сохраняя ручные корректировки
-    if request.args.get('keep_manual', False):
-        # Удаляем только автоматически созданные элементы
-        ScheduleItem.query.filter_by(is_manually_placed=False).delete()
-    else:
-        # Удаляем все элементы расписания
-        ScheduleItem.query.delete()
-
-    db.session.commit()
-
     settings = Settings.query.first()
     if not settings:
         settings = Settings(weeks_count=18)
         db.session.add(settings)
         db.session.commit()
 
-    courses = Course.query.all()
-    rooms = Room.query.all()
-
-    if not courses or not rooms:
+    if not Course.query.first() or not Room.query.first():
         flash('Невозможно сгенерировать расписание. Добавьте дисциплины и аудитории.', 'error')
         return redirect(url_for('index'))
 
-    # Генерация расписания с использованием оптимизированного алгоритма
-    schedule_generator = ScheduleGenerator(settings)
-    success = schedule_generator.generate()
+    # Генерация выполняется в фоне, страница задачи показывает ее ход.
+    # incremental - заново разместить только занятия, затронутые изменениями данных после генерации
+    job = submit_generation(app, keep_manual=bool(request.args.get('keep_manual', False)),
+                            incremental=bool(request.args.get('incremental', False)))
+    return redirect(url_for('generation_progress', job_id=job.id))
+
+
+@app.route('/generate-schedule/<job_id>')
+def generation_progress(job_id):
+    job = get_job(job_id)
+    if job is None:
+        flash('Задача генерации не найдена', 'error')
+        return redirect(url_for('index'))
+
+    return render_template('generation_progress.html', job=job)
+
+
+@app.route('/api/generation-jobs', methods=['POST'])
+def api_submit_generation():
+    data = request.get_json(silent=True) or {}
+
+    if not Course.query.first() or not Room.query.first():
+        return jsonify({'error': 'Добавьте дисциплины и аудитории'}), 400
+
+    job = submit_generation(app, keep_manual=bool(data.get('keep_manual', False)),
+                            incremental=bool(data.get('incremental', False)))
+    return jsonify(job.to_dict()), 202
 
-    if success:
-        flash('Расписание успешно сгенерировано!', 'success')
-    else:
-        flash('Не удалось сгенерировать расписание. Попробуйте изменить параметры.', 'error')
 
-    return redirect(url_for('index'))
+@app.route('/api/generation-jobs/<job_id>')
+def api_generation_progress(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/generation-jobs/<job_id>/cancel', methods=['POST'])
+def api_cancel_generation(job_id):
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/generation-jobs/<job_id>/result')
+def api_generation_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.is_active:
+        return jsonify({'error': 'Job is still running', **job.to_dict()}), 409
+
+    result = job.to_dict()
+    result['stats'] = job.stats
+    return jsonify(result)
 
 
 @app.route('/schedule')
 def view_schedule():
     groups = Group.query.all()
     teachers = Teacher.query.all()
+    rooms = Room.query.all()
     settings = Settings.query.first()
     if not settings:
         settings = Settings(weeks_count=18)
@@ -811,83 +925,93 @@ def view_schedule():
     return render_template('schedule_view.html',
                            groups=groups,
                            teachers=teachers,
+                           rooms=rooms,
                            weeks=weeks)
 
 
 @app.route('/schedule/data')
 def schedule_data():
     group_id = request.args.get('group_id', type=int)
+    subgroup_id = request.args.get('subgroup_id', type=int)
     teacher_id = request.args.get('teacher_id', type=int)
+    room_id = request.args.get('room_id', type=int)
     week = request.args.get('week', type=int)
 
-    if not ((group_id or teacher_id) and week):
+    # Если задано несколько сущностей, приоритет у группы, затем у подгруппы, преподавателя и аудитории
+    if group_id:
+        entity = ('group', group_id)
+    elif subgroup_id:
+        entity = ('subgroup', subgroup_id)
+    elif teacher_id:
+        entity = ('teacher', teacher_id)
+    elif room_id:
+        entity = ('room', room_id)
+    else:
+        entity = None
+
+    if not (entity and week):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    # Базовый запрос
-    query = db.session.query(ScheduleItem).join(Course)
+    return cached_schedule_response(('data',) + entity + (week,),
+                                    lambda: build_schedule_data(entity, week))
 
-    # Фильтруем по группе или преподавателю и неделе
-    if group_id:
-        query = query.filter(
-            ScheduleItem.week == week,
-            ScheduleItem.groups.like(f'%{group_id}%')
-        )
-    elif teacher_id:
-        query = query.filter(
-            ScheduleItem.week == week,
-            ScheduleItem.teacher_id == teacher_id
-        )
 
-    schedule_items = query.all()
+def build_schedule_data(entity, week):
+    """Занятия группы, подгруппы, преподавателя или аудитории на неделю из готового документа расписания"""
+    entity_type, entity_id = entity
+    document = get_timetable(get_active_version_id(), entity_type, entity_id)
+    return document.get(str(week), [])
 
-    schedule_data = []
-    for item in schedule_items:
-        course = Course.query.get(item.course_id)
-        room = Room.query.get(item.room_id)
 
-        # Получаем преподавателя для этого занятия
-        teacher_name = "Не назначен"
-        if item.teacher_id:
-            teacher = Teacher.query.get(item.teacher_id)
-            teacher_name = teacher.name if teacher else "Не назначен"
-        else:
-            # Если преподаватель не назначен в ScheduleItem, ищем в CourseTeacher
-            course_teacher = CourseTeacher.query.filter_by(
-                course_id=course.id,
-                lesson_type=item.lesson_type,
-                lab_subgroup_id=item.lab_subgroup_id
-            ).first()
-            if course_teacher and course_teacher.teacher:
-                teacher_name = course_teacher.teacher.name
-
-        # Добавляем информацию о подгруппе, если это лабораторная работа для подгруппы
-        subgroup_info = ""
-        if item.lesson_type == 'lab' and item.lab_subgroup:
-            subgroup_info = f" ({item.lab_subgroup.name})"
-
-        # Получаем список групп
-        group_names = []
-        for group_id in item.get_group_ids():
-            group = Group.query.get(group_id)
-            if group:
-                group_names.append(group.name)
-
-        schedule_data.append({
-            'id': item.id,
-            'day': item.day,
-            'time_slot': item.time_slot,
-            'course_name': f"{course.name}{subgroup_info}",
-            'teacher_name': teacher_name,
-            'teacher_id': item.teacher_id,
-            'room_name': room.name,
-            'room_id': item.room_id,
-            'lesson_type': item.lesson_type,
-            'subgroup_id': item.lab_subgroup_id,
-            'is_manually_placed': item.is_manually_placed,
-            'group_names': ', '.join(group_names)
-        })
+@app.route('/api/timetables')
+def api_timetables():
+    """
+    Расписания нескольких групп, подгрупп, преподавателей и аудиторий за диапазон недель одним запросом.
+    Параметры group_id, subgroup_id, teacher_id и room_id можно повторять; faculty_id добавляет все группы
+    факультета; week_from и week_to по умолчанию охватывают весь семестр.
+    Ответ в компактном виде (см. encode_timetables), сжимается gzip, если клиент его принимает.
+    """
+    entities = {(entity_type, entity_id) for entity_type in ENTITY_TYPES
+                for entity_id in request.args.getlist(f'{entity_type}_id', type=int)}
+    faculty_id = request.args.get('faculty_id', type=int)
+    if faculty_id:
+        entities.update(('group', group_id) for (group_id,) in
+                        db.session.query(Group.id).filter(Group.faculty_id == faculty_id))
+
+    settings = Settings.query.first()
+    week_from = request.args.get('week_from', 1, type=int)
+    week_to = request.args.get('week_to', settings.weeks_count if settings else 18, type=int)
+
+    if not entities or not 1 <= week_from <= week_to:
+        return jsonify({'error': 'Missing parameters'}), 400
+    if len(entities) > MAX_BATCH_TIMETABLES:
+        return jsonify({'error': f'Too many timetables requested (at most {MAX_BATCH_TIMETABLES})'}), 400
+
+    def build():
+        return encode_timetables(entities, get_timetables(get_active_version_id(), entities), week_from, week_to)
+
+    return cached_schedule_response(('batch', week_from, week_to) + tuple(sorted(entities)), build, compress=True)
 
-    return jsonify(schedule_data)
+
+@app.route('/schedule/versions')
+def schedule_versions():
+    """Сохраненные версии расписания для отката"""
+    versions = (ScheduleVersion.query.filter(ScheduleVersion.status.in_(['active', 'archived']))
+                .order_by(ScheduleVersion.activated_at.desc(), ScheduleVersion.id.desc()).all())
+    item_counts = dict(db.session.query(ScheduleItem.version_id, db.func.count(ScheduleItem.id))
+                       .group_by(ScheduleItem.version_id).all())
+
+    return render_template('schedule_versions.html', versions=versions, item_counts=item_counts)
+
+
+@app.route('/schedule/versions/<int:id>/activate', methods=['POST'])
+def activate_schedule_version(id):
+    """Откат к сохраненной версии расписания"""
+    if activate_version(id):
+        flash('Версия расписания восстановлена!', 'success')
+    else:
+        flash('Эту версию расписания нельзя восстановить', 'error')
+    return redirect(url_for('schedule_versions'))
 
 
 @app.route('/schedule/manual', methods=['GET', 'POST'])
@@ -938,6 +1062,7 @@ def add_schedule_item():
         lab_subgroup_id = form.lab_subgroup_id.data if form.lab_subgroup_id.data != 0 else None
 
         schedule_item = ScheduleItem(
+            version_id=get_or_create_active_version(),
             course_id=form.course_id.data,
             teacher_id=form.teacher_id.data,
             room_id=form.room_id.data,
@@ -945,13 +1070,15 @@ def add_schedule_item():
             day=form.day.data,
             time_slot=form.time_slot.data,
             lesson_type=form.lesson_type.data,
-            groups=','.join(map(str, form.groups.data)),
             lab_subgroup_id=lab_subgroup_id,
             is_manually_placed=True,
             notes=form.notes.data
         )
+        schedule_item.set_group_ids(form.groups.data)
 
         db.session.add(schedule_item)
+        refresh_timetables(schedule_item.version_id, item_timetable_entities(schedule_item))
+        bump_schedule_revision()
         db.session.commit()
 
         flash('Занятие успешно добавлено в расписание!', 'success')
@@ -967,7 +1094,7 @@ def add_schedule_item():
 @app.route('/schedule/edit-item/<int:id>', methods=['GET', 'POST'])
 def edit_schedule_item(id):
     """Редактирование элемента расписания"""
-    schedule_item = ScheduleItem.query.get_or_404(id)
+    schedule_item = active_schedule_items().filter_by(id=id).first_or_404()
     form = ManualScheduleItemForm(obj=schedule_item)
 
     # Заполняем списки выбора
@@ -1002,6 +1129,8 @@ def edit_schedule_item(id):
             return render_template('manual_schedule_form.html', form=form, title='Редактировать занятие')
 
         # Если нет конфликтов, обновляем элемент расписания
+        # Документы расписания перестраиваются и для прежних группы, преподавателя и аудитории
+        previous_entities = item_timetable_entities(schedule_item)
         schedule_item.course_id = form.course_id.data
         schedule_item.teacher_id = form.teacher_id.data
         schedule_item.room_id = form.room_id.data
@@ -1009,11 +1138,13 @@ def edit_schedule_item(id):
         schedule_item.day = form.day.data
         schedule_item.time_slot = form.time_slot.data
         schedule_item.lesson_type = form.lesson_type.data
-        schedule_item.groups = ','.join(map(str, form.groups.data))
+        schedule_item.set_group_ids(form.groups.data)
         schedule_item.lab_subgroup_id = form.lab_subgroup_id.data if form.lab_subgroup_id.data != 0 else None
         schedule_item.is_manually_placed = True
         schedule_item.notes = form.notes.data
 
+        refresh_timetables(schedule_item.version_id, previous_entities | item_timetable_entities(schedule_item))
+        bump_schedule_revision()
         db.session.commit()
 
         flash('Занятие успешно обновлено!', 'success')
@@ -1025,8 +1156,11 @@ def edit_schedule_item(id):
 @app.route('/schedule/delete-item/<int:id>')
 def delete_schedule_item(id):
     """Удаление элемента расписания"""
-    schedule_item = ScheduleItem.query.get_or_404(id)
+    schedule_item = active_schedule_items().filter_by(id=id).first_or_404()
+    entities = item_timetable_entities(schedule_item)
     db.session.delete(schedule_item)
+    refresh_timetables(schedule_item.version_id, entities)
+    bump_schedule_revision()
     db.session.commit()
 
     flash('Занятие удалено из расписания!', 'success')
@@ -1041,25 +1175,22 @@ def get_schedule_items():
     if not week:
         return jsonify({'error': 'Missing week parameter'}), 400
 
-    items = ScheduleItem.query.filter_by(week=week).all()
+    return cached_schedule_response(('items', week), lambda: build_week_items(week))
+
+
+def build_week_items(week):
+    """Все занятия недели для страницы ручного управления"""
+    items = load_schedule_items(active_schedule_items().filter_by(week=week))
     result = []
 
     for item in items:
-        course = Course.query.get(item.course_id)
-        room = Room.query.get(item.room_id)
-        teacher = Teacher.query.get(item.teacher_id) if item.teacher_id else None
-
-        group_names = []
-        for group_id in item.get_group_ids():
-            group = Group.query.get(group_id)
-            if group:
-                group_names.append(group.name)
-
-        subgroup_name = ""
-        if item.lab_subgroup_id:
-            subgroup = LabSubgroup.query.get(item.lab_subgroup_id)
-            if subgroup:
-                subgroup_name = subgroup.name
+        course = item.course
+        room = item.room
+        teacher = item.teacher if item.teacher_id else None
+
+        group_names = get_item_group_names(item)
+
+        subgroup_name = item.lab_subgroup.name if item.lab_subgroup else ""
 
         # Определяем типы занятий
         lesson_types = {
@@ -1091,28 +1222,127 @@ def get_schedule_items():
             'notes': item.notes
         })
 
-    return jsonify(result)
+    return result
 
 
 @app.route('/api/check-conflicts', methods=['POST'])
 def api_check_conflicts():
-    """API для проверки конфликтов перед добавлением/редактированием занятия"""
-    data = request.json
-
-    week = data.get('week')
-    day = data.get('day')
-    time_slot = data.get('time_slot')
-    teacher_id = data.get('teacher_id')
-    room_id = data.get('room_id')
-    group_ids = data.get('group_ids', [])
+    """
+    API для проверки конфликтов перед добавлением/редактированием занятий.
+    Принимает одно размещение (week, day, time_slot, teacher_id, room_id, group_ids, exclude_id)
+    или пакет {"placements": [...]}; размещения пакета проверяются и друг с другом.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'request body must be a JSON object'}), 400
+
+    if 'placements' not in data:
+        try:
+            placement = placement_from_json(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        conflicts = check_placements([placement])[0]
+        return jsonify({
+            'has_conflicts': len(conflicts) > 0,
+            'conflicts': conflicts
+        })
+
+    placements = data['placements']
+    if not isinstance(placements, list) or len(placements) > MAX_CHECKED_PLACEMENTS:
+        return jsonify({'error': f'placements must be a list of at most {MAX_CHECKED_PLACEMENTS} items'}), 400
+
+    try:
+        placements = [placement_from_json(placement, f"placements[{index}]")
+                      for index, placement in enumerate(placements)]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    results = check_placements(placements)
+    return jsonify({
+        'has_conflicts': any(results),
+        'placements': [{'has_conflicts': len(conflicts) > 0, 'conflicts': conflicts} for conflicts in results]
+    })
+
+
+def placement_from_json(data, name='placement'):
+    """
+    Размещение из JSON-объекта запроса; name - как назвать объект в сообщении об ошибке.
+    При неверных полях выбрасывает ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"{name}: ожидался объект, получено {data!r}")
+
+    def integer(field, value):
+        # bool в Python - тоже int, но как id или номер пары не годится
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"{name}.{field}: ожидалось целое число, получено {value!r}")
+        return value
+
+    fields = {field: integer(field, data.get(field)) for field in ('week', 'day', 'time_slot', 'teacher_id', 'room_id')}
+    group_ids = data.get('group_ids')
+    if not isinstance(group_ids, list):
+        raise ValueError(f"{name}.group_ids: ожидался список id групп, получено {group_ids!r}")
+    fields['group_ids'] = [integer('group_ids', group_id) for group_id in group_ids]
     exclude_id = data.get('exclude_id')
+    fields['exclude_id'] = integer('exclude_id', exclude_id) if exclude_id is not None else None
+    return Placement(**fields)
+
+
+@app.route('/api/schedule/bulk', methods=['POST'])
+def api_bulk_schedule_operation():
+    """
+    Массовая операция над занятиями активной версии расписания:
+    {"filter": {...}, "action": "move" | "shift" | "reassign" | "cancel", "params": {...}, "dry_run": false}.
+    Возвращает изменения занятий; при конфликтах ничего не меняет и отвечает 409.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'request body must be a JSON object'}), 400
+    item_filter = data.get('filter') or {}
+    params = data.get('params') or {}
+    if not isinstance(item_filter, dict) or not isinstance(params, dict):
+        return jsonify({'error': 'filter and params must be objects'}), 400
+
+    try:
+        result = apply_bulk_operation(item_filter, data.get('action'), params, dry_run=bool(data.get('dry_run')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(result), 409 if result['conflicts'] else 200
 
-    time_key = (week, day, time_slot)
-    conflicts = check_schedule_conflicts(time_key, teacher_id, room_id, group_ids, exclude_id)
 
+@app.route('/api/free-slots')
+def api_free_slots():
+    """
+    Свободные моменты для ручного размещения занятия: course_id, lesson_type, teacher_id, group_id (можно
+    повторять), lab_subgroup_id, week_from, week_to, exclude_id (редактируемое занятие), limit.
+    Кандидаты отсортированы от лучшего; каждый - [неделя, день, пара, id аудитории].
+    """
+    course_id = request.args.get('course_id', type=int)
+    lesson_type = request.args.get('lesson_type')
+    if not course_id or lesson_type not in ('lecture', 'practice', 'lab'):
+        return jsonify({'error': 'Missing parameters'}), 400
+
+    try:
+        candidates = get_occupancy_index().find_free_slots(
+            course_id, lesson_type,
+            teacher_id=request.args.get('teacher_id', type=int),
+            group_ids=request.args.getlist('group_id', type=int),
+            lab_subgroup_id=request.args.get('lab_subgroup_id', type=int),
+            week_from=request.args.get('week_from', type=int),
+            week_to=request.args.get('week_to', type=int),
+            exclude_id=request.args.get('exclude_id', type=int)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    limit = request.args.get('limit', type=int)
+    shown = candidates[:limit] if limit else candidates
     return jsonify({
-        'has_conflicts': len(conflicts) > 0,
-        'conflicts': conflicts
+        'total': len(candidates),
+        'fields': ['week', 'day', 'time_slot', 'room_id'],
+        'candidates': [[week, day, time_slot, room.id] for week, day, time_slot, room in shown],
+        'rooms': {room.id: room.name for week, day, time_slot, room in shown}
     })
 
 
@@ -1133,7 +1363,10 @@ def create_tables():
                 optimize_room_usage=True,
                 max_lessons_per_day_global=4,
                 preferred_lesson_distribution='balanced',
-                version=1
+                version=1,
+                evaluation_backend='python',
+                chains_count=1,
+                parallel_workers=0
             )
             db.session.add(settings)
             db.session.commit()
@@ -0,0 +1,231 @@
+"""
+Бенчмарк генератора расписания на лестнице синтетических наборов данных.
+
+Каждый набор генерируется один раз (generate_dataset.py) и затем расписание строится в отдельном
+процессе, чтобы замер памяти и времени одного экземпляра не зависел от остальных. Генерация
+выполняется с фиксированным seed, поэтому оценки сравнимы между запусками.
+Примеры:
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --max-throughput-drop 0.2 --max-score-drop 0.05
+Код возврата 1 означает, что по сравнению с эталоном скорость или качество ухудшились сильнее порога.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = [10, 50, 200, 500, 1000, 2000]
+DATASET_SEED = 1
+GENERATION_SEED = 12345
+
+
+def dataset_path(directory, courses, seed):
+    return os.path.join(directory, f"courses_{courses}_seed_{seed}.db")
+
+
+def prepare_dataset(directory, courses, seed):
+    """Создает набор данных указанного размера, если его еще нет"""
+    path = dataset_path(directory, courses, seed)
+    if not os.path.exists(path):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_dataset.py')
+        subprocess.run([sys.executable, script, path, '--courses', str(courses), '--seed', str(seed)],
+                       check=True, stdout=subprocess.DEVNULL)
+    return path
+
+
+def run_instance(path, iterations, seed):
+    """
+    Запускает генерацию на одном наборе в отдельном процессе и возвращает его замеры.
+    Генерация сохраняет в базу настройки и новую версию расписания, поэтому запускается на копии набора:
+    иначе каждый следующий запуск начинался бы с большей базы и замеры одного набора были бы несравнимы.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        copy = shutil.copy(path, os.path.join(directory, os.path.basename(path)))
+        command = [sys.executable, os.path.abspath(__file__), '--run-one', copy, '--seed', str(seed)]
+        if iterations:
+            command += ['--iterations', str(iterations)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Генерация на {path} завершилась с ошибкой:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_one(path, iterations, seed):
+    """Выполняется в дочернем процессе: строит и сохраняет расписание, печатает замеры в JSON"""
+    from generate_dataset import create_app
+    from models import db, Settings
+    from scheduler import ScheduleGenerator, get_peak_rss_mb
+
+    app = create_app(path)
+    with app.app_context():
+        settings = Settings.query.first()
+        settings.random_seed = seed
+        settings.chains_count = 1
+        db.session.commit()
+
+        # Подробный журнал генератора бенчмарку не нужен
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            generator = ScheduleGenerator(settings)
+            if iterations:
+                generator.max_iterations = iterations
+            success = generator.generate()
+
+        stats = generator.stats
+        optimization_time = stats.get('optimization_time', 0)
+        result = {
+            'success': success,
+            'courses': len(generator.courses),
+            'groups': len(generator.groups),
+            'teachers': len(generator.teachers),
+            'rooms': len(generator.rooms),
+            'lessons': stats.get('lessons', 0),
+            'unplaced': stats.get('unplaced'),
+            'score': stats.get('score'),
+            'iterations': stats.get('iterations', 0),
+            'iterations_per_sec': stats.get('iterations', 0) / optimization_time if optimization_time else None,
+            'construction_time': stats.get('construction_time'),
+            'optimization_time': optimization_time,
+            'save_time': stats.get('save_time'),
+            'saved_rows': stats.get('saved_rows'),
+            'save_rows_per_sec': stats.get('save_rows_per_sec'),
+            'total_time': stats.get('total_time'),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+    print(json.dumps(result))
+
+
+def compare(results, baseline, thresholds):
+    """Сравнивает замеры с эталоном; возвращает список описаний регрессий"""
+    baseline_results = {result['instance']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = baseline_results.get(result['instance'])
+        if base is None or not base.get('success') or not result.get('success'):
+            continue
+        name = result['instance']
+
+        if base.get('iterations_per_sec') and result.get('iterations_per_sec') is not None:
+            limit = base['iterations_per_sec'] * (1 - thresholds['max_throughput_drop'])
+            if result['iterations_per_sec'] < limit:
+                regressions.append(f"{name}: скорость отжига {result['iterations_per_sec']:.0f} итер./с, "
+                                   f"эталон {base['iterations_per_sec']:.0f}")
+
+        if base.get('total_time'):
+            limit = base['total_time'] * (1 + thresholds['max_time_increase'])
+            if result['total_time'] > limit:
+                regressions.append(f"{name}: время генерации {result['total_time']:.2f} с, "
+                                   f"эталон {base['total_time']:.2f} с")
+
+        if base.get('score') is not None:
+            limit = base['score'] - abs(base['score']) * thresholds['max_score_drop']
+            if result['score'] < limit:
+                regressions.append(f"{name}: оценка {result['score']:.2f}, эталон {base['score']:.2f}")
+
+        if base.get('unplaced') is not None:
+            limit = base['unplaced'] + thresholds['max_unplaced_increase']
+            if result['unplaced'] > limit:
+                regressions.append(f"{name}: не размещено {result['unplaced']}, эталон {base['unplaced']}")
+
+    return regressions
+
+
+def print_table(results):
+    print(f"{'набор':<14}{'занятий':>9}{'не разм.':>10}{'оценка':>12}{'итер./с':>10}"
+          f"{'размещ.':>9}{'отжиг':>9}{'сохр.':>8}{'строк/с':>10}{'всего':>9}{'память':>9}")
+    for result in results:
+        if not result.get('success'):
+            print(f"{result['instance']:<14} ошибка генерации")
+            continue
+        print(f"{result['instance']:<14}{result['lessons']:>9}{result['unplaced']:>10}{result['score']:>12.2f}"
+              f"{result['iterations_per_sec'] or 0:>10.0f}{result['construction_time']:>8.2f}с"
+              f"{result['optimization_time']:>8.2f}с{result['save_time']:>7.2f}с"
+              f"{result.get('save_rows_per_sec') or 0:>10.0f}{result['total_time']:>8.2f}с"
+              f"{result['peak_rss_mb'] or 0:>7.0f}МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк генератора расписания")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="количества дисциплин в наборах данных")
+    parser.add_argument('--iterations', type=int, help="итераций отжига (по умолчанию - как в генераторе)")
+    parser.add_argument('--seed', type=int, default=GENERATION_SEED, help="seed генерации расписания")
+    parser.add_argument('--dataset-seed', type=int, default=DATASET_SEED, help="seed наборов данных")
+    parser.add_argument('--datasets', default=os.path.join(tempfile.gettempdir(), 'schedule_benchmark'),
+                        help="каталог для наборов данных")
+    parser.add_argument('--output', help="файл для сохранения результатов в JSON")
+    parser.add_argument('--baseline', help="JSON с эталонными результатами для сравнения")
+    parser.add_argument('--max-throughput-drop', type=float, default=0.2,
+                        help="допустимое падение скорости отжига (доля)")
+    parser.add_argument('--max-time-increase', type=float, default=0.3,
+                        help="допустимый рост общего времени генерации (доля)")
+    parser.add_argument('--max-score-drop', type=float, default=0.05, help="допустимое падение оценки (доля)")
+    parser.add_argument('--max-unplaced-increase', type=int, default=0,
+                        help="допустимый рост числа неразмещенных занятий")
+    parser.add_argument('--run-one', metavar='PATH', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one, args.iterations, args.seed)
+        return 0
+
+    os.makedirs(args.datasets, exist_ok=True)
+    results = []
+    for courses in args.sizes:
+        path = prepare_dataset(args.datasets, courses, args.dataset_seed)
+        print(f"Набор {courses} дисциплин...", flush=True)
+        try:
+            result = run_instance(path, args.iterations, args.seed)
+        except RuntimeError as e:
+            print(e)
+            result = {'success': False}
+        result['instance'] = f"courses_{courses}"
+        results.append(result)
+
+    print_table(results)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'dataset_seed': args.dataset_seed,
+        'iterations': args.iterations,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+    failed = [result['instance'] for result in results if not result.get('success')]
+    if failed:
+        print(f"Генерация не удалась: {', '.join(failed)}")
+        return 1
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, {
+            'max_throughput_drop': args.max_throughput_drop,
+            'max_time_increase': args.max_time_increase,
+            'max_score_drop': args.max_score_drop,
+            'max_unplaced_increase': args.max_unplaced_increase,
+        })
+        if regressions:
+            print("Обнаружены регрессии относительно эталона:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("Регрессий относительно эталона нет")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
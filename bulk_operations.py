@@ -0,0 +1,239 @@
+"""
+Массовые операции над занятиями активной версии расписания.
+
+Операция выбирает занятия по фильтру и одинаково меняет их все: переносит на другое время (move),
+сдвигает на несколько недель, дней или пар (shift), переназначает аудитории и преподавателей (reassign)
+или отменяет (cancel). Новые места всех измененных занятий проверяются на конфликты одним пакетом -
+и с остальным расписанием, и друг с другом. Операция применяется целиком в одной транзакции
+или не применяется вовсе; в ответ возвращается список изменений занятий.
+"""
+from sqlalchemy import select
+
+from conflicts import Placement, check_placements
+from models import db, Room, ScheduleItem, Settings, Teacher, schedule_item_group
+from timetables import items_timetable_entities, refresh_timetables
+from versions import bump_schedule_revision, delete_schedule_items
+
+BULK_ACTIONS = ('move', 'shift', 'reassign', 'cancel')
+
+# Поля занятия, которые меняют операции и которые показываются в списке изменений
+CHANGED_FIELDS = ('week', 'day', 'time_slot', 'room_id', 'teacher_id')
+
+# Числовые условия фильтра, сравниваемые на равенство с полями занятия
+FILTER_FIELDS = ('course_id', 'teacher_id', 'room_id', 'lab_subgroup_id', 'week', 'day', 'time_slot')
+
+
+def apply_bulk_operation(item_filter, action, params, dry_run=False):
+    """
+    Применяет действие action с параметрами params ко всем занятиям активной версии, подходящим под фильтр.
+
+    Фильтр: ids, course_id, lesson_type, teacher_id, room_id, group_id, lab_subgroup_id, week, week_from,
+    week_to, day, time_slot - условия объединяются через И; пустой фильтр не допускается.
+    Параметры действий:
+      move     - week, day, time_slot: новое значение для всех занятий (любые из трех);
+      shift    - weeks, days, time_slots: сдвиг на заданное число недель, дней, пар;
+      reassign - room_id, teacher_id: новые аудитория, преподаватель для всех занятий,
+                 или rooms, teachers: замены {старый id: новый id} (обмен двух аудиторий - {a: b, b: a});
+      cancel   - без параметров, занятия удаляются.
+
+    Возвращает словарь: applied - применена ли операция, matched - сколько занятий подошло под фильтр,
+    changes - изменения занятий ({id, course_id, lesson_type, before, after}; after = None для отмененных),
+    conflicts - конфликты новых мест ({id, conflicts}). При конфликтах или dry_run ничего не меняется.
+    При неверных параметрах выбрасывает ValueError.
+    """
+    if action not in BULK_ACTIONS:
+        raise ValueError(f"Неизвестное действие: {action}. Допустимые: {', '.join(BULK_ACTIONS)}")
+
+    settings = Settings.query.first()
+    version_id = settings.active_schedule_version_id
+    if version_id is None:
+        raise ValueError("Расписание еще не составлено")
+
+    items = _select_items(version_id, item_filter)
+    if action == 'cancel':
+        targets = {item.id: None for item in items}
+    else:
+        compute = {'move': _move_target, 'shift': _shift_target, 'reassign': _reassign_target}[action]
+        prepare = {'move': _move_params, 'shift': _shift_params, 'reassign': _reassign_params}[action]
+        options = prepare(params or {})
+        targets = {}
+        for item in items:
+            target = compute(item, options)
+            if target != _placement_fields(item):
+                _check_grid(settings, item, target)
+                targets[item.id] = target
+
+    changed = [item for item in items if item.id in targets]
+    changes = [{
+        'id': item.id,
+        'course_id': item.course_id,
+        'lesson_type': item.lesson_type,
+        'before': _placement_fields(item),
+        'after': targets[item.id],
+    } for item in changed]
+
+    moved = [item for item in changed if targets[item.id] is not None]
+    results = check_placements([
+        Placement(targets[item.id]['week'], targets[item.id]['day'], targets[item.id]['time_slot'],
+                  targets[item.id]['teacher_id'], targets[item.id]['room_id'], item.get_group_ids(), item.id)
+        for item in moved
+    ], version_id)
+    conflicts = [{'id': item.id, 'conflicts': found} for item, found in zip(moved, results) if found]
+
+    result = {'applied': False, 'matched': len(items), 'changes': changes, 'conflicts': conflicts}
+    if conflicts or dry_run or not changed:
+        return result
+
+    try:
+        _apply_changes(version_id, changed, targets, settings)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    result['applied'] = True
+    return result
+
+
+def _apply_changes(version_id, changed, targets, settings):
+    """Записывает изменения занятий, перестраивает затронутые документы расписания (без фиксации)"""
+    entities = items_timetable_entities(changed)
+
+    delete_schedule_items(item.id for item in changed if targets[item.id] is None)
+
+    moved = [item for item in changed if targets[item.id] is not None]
+    for item in moved:
+        for field, value in targets[item.id].items():
+            setattr(item, field, value)
+        # Как и при ручной правке, перенесенное занятие сохраняется при следующей генерации
+        item.is_manually_placed = True
+    entities |= items_timetable_entities(moved)
+
+    refresh_timetables(version_id, entities)
+    bump_schedule_revision(settings)
+
+
+def _select_items(version_id, item_filter):
+    """Занятия версии, подходящие под фильтр, в порядке недель, дней и пар"""
+    query = ScheduleItem.query.filter(ScheduleItem.version_id == version_id)
+    criteria = 0
+
+    if item_filter.get('ids') is not None:
+        ids = item_filter['ids']
+        if not isinstance(ids, list):
+            raise ValueError("ids должен быть списком id занятий")
+        query = query.filter(ScheduleItem.id.in_([_int(item_id, 'ids') for item_id in ids]))
+        criteria += 1
+
+    for field in FILTER_FIELDS:
+        if item_filter.get(field) is not None:
+            query = query.filter(getattr(ScheduleItem, field) == _int(item_filter[field], field))
+            criteria += 1
+
+    if item_filter.get('lesson_type'):
+        query = query.filter(ScheduleItem.lesson_type == item_filter['lesson_type'])
+        criteria += 1
+
+    if item_filter.get('group_id') is not None:
+        group_id = _int(item_filter['group_id'], 'group_id')
+        query = query.filter(ScheduleItem.id.in_(
+            select(schedule_item_group.c.schedule_item_id).where(schedule_item_group.c.group_id == group_id)))
+        criteria += 1
+
+    if item_filter.get('week_from') is not None:
+        query = query.filter(ScheduleItem.week >= _int(item_filter['week_from'], 'week_from'))
+        criteria += 1
+    if item_filter.get('week_to') is not None:
+        query = query.filter(ScheduleItem.week <= _int(item_filter['week_to'], 'week_to'))
+        criteria += 1
+
+    if not criteria:
+        raise ValueError("Не задан фильтр занятий")
+
+    return query.order_by(ScheduleItem.week, ScheduleItem.day, ScheduleItem.time_slot, ScheduleItem.id).all()
+
+
+def _move_params(params):
+    options = {field: _int(params[field], field) for field in ('week', 'day', 'time_slot')
+               if params.get(field) is not None}
+    if not options:
+        raise ValueError("Для переноса нужно задать week, day или time_slot")
+    return options
+
+
+def _move_target(item, options):
+    target = _placement_fields(item)
+    target.update(options)
+    return target
+
+
+def _shift_params(params):
+    options = {field: _int(params.get(name) or 0, name)
+               for field, name in (('week', 'weeks'), ('day', 'days'), ('time_slot', 'time_slots'))}
+    if not any(options.values()):
+        raise ValueError("Для сдвига нужно задать weeks, days или time_slots")
+    return options
+
+
+def _shift_target(item, options):
+    target = _placement_fields(item)
+    for field, offset in options.items():
+        target[field] += offset
+    return target
+
+
+def _reassign_params(params):
+    options = {}
+    for field, mapping_name, model, title in (('room_id', 'rooms', Room, 'аудитории'),
+                                              ('teacher_id', 'teachers', Teacher, 'преподаватели')):
+        if params.get(field) is not None and params.get(mapping_name) is not None:
+            raise ValueError(f"{field} и {mapping_name} нельзя задавать одновременно")
+        if params.get(field) is not None:
+            new_id = _int(params[field], field)
+            mapping = lambda old_id, new_id=new_id: new_id
+            new_ids = {new_id}
+        elif params.get(mapping_name) is not None:
+            if not isinstance(params[mapping_name], dict):
+                raise ValueError(f"{mapping_name} должен быть объектом {{старый id: новый id}}")
+            replacements = {_int(old_id, mapping_name): _int(new_id, mapping_name)
+                            for old_id, new_id in params[mapping_name].items()}
+            mapping = lambda old_id, replacements=replacements: replacements.get(old_id, old_id)
+            new_ids = set(replacements.values())
+        else:
+            continue
+
+        existing = {row[0] for row in db.session.query(model.id).filter(model.id.in_(new_ids))}
+        missing = new_ids - existing
+        if missing:
+            raise ValueError(f"Не найдены {title}: {', '.join(map(str, sorted(missing)))}")
+        options[field] = mapping
+
+    if not options:
+        raise ValueError("Для переназначения нужно задать room_id, teacher_id, rooms или teachers")
+    return options
+
+
+def _reassign_target(item, options):
+    target = _placement_fields(item)
+    for field, mapping in options.items():
+        target[field] = mapping(target[field])
+    return target
+
+
+def _placement_fields(item):
+    return {field: getattr(item, field) for field in CHANGED_FIELDS}
+
+
+def _check_grid(settings, item, target):
+    """Новое время занятия должно попадать в сетку семестра"""
+    if not (1 <= target['week'] <= settings.weeks_count and 0 <= target['day'] < settings.days_per_week and
+            0 <= target['time_slot'] < settings.slots_per_day):
+        raise ValueError(f"Занятие {item.id} выходит за пределы расписания: неделя {target['week']}, "
+                         f"день {target['day']}, пара {target['time_slot']}")
+
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: ожидалось целое число, получено {value!r}")
@@ -0,0 +1,130 @@
+"""
+Проверка конфликтов при ручном размещении занятий.
+
+Проверяется сразу пакет предлагаемых размещений: занятость всех затронутых недель читается одним
+запросом, названия преподавателей, аудиторий и групп - только для найденных конфликтов. Размещения
+проверяются и с занятиями активной версии расписания, и друг с другом.
+"""
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import select
+
+from models import db, Group, Room, ScheduleItem, Teacher, schedule_item_group
+from versions import get_active_version_id
+
+# Предлагаемое размещение занятия; exclude_id - занятие, которое оно заменяет (перенос или правка):
+# место этого занятия не считается занятым
+Placement = namedtuple('Placement', ['week', 'day', 'time_slot', 'teacher_id', 'room_id', 'group_ids',
+                                     'exclude_id'])
+Placement.__new__.__defaults__ = (None,)
+
+
+def check_placements(placements, version_id=None):
+    """
+    Проверяет пакет размещений на конфликты преподавателей, аудиторий и групп.
+    Возвращает списки строк с описаниями конфликтов - по одному списку на размещение, в том же порядке.
+    """
+    if not placements:
+        return []
+    if version_id is None:
+        version_id = get_active_version_id()
+
+    excluded_ids = {placement.exclude_id for placement in placements if placement.exclude_id}
+    occupied = _load_occupancy(version_id, placements, excluded_ids)
+
+    # Конфликты собираются как (тип, id сущности, номер размещения-соперника или None), названия - потом
+    found = []
+    proposed = defaultdict(lambda: {'teacher': {}, 'room': {}, 'group': {}})  # время -> тип -> id -> номер
+    for index, placement in enumerate(placements):
+        time_key = (placement.week, placement.day, placement.time_slot)
+        existing = occupied.get(time_key)
+        taken = proposed[time_key]
+        conflicts = []
+
+        for entity_type, entity_ids in (('teacher', [placement.teacher_id] if placement.teacher_id else []),
+                                        ('room', [placement.room_id] if placement.room_id else []),
+                                        ('group', list(dict.fromkeys(placement.group_ids or ())))):
+            for entity_id in entity_ids:
+                if existing is not None and entity_id in existing[entity_type]:
+                    conflicts.append((entity_type, entity_id, None))
+                elif entity_id in taken[entity_type]:
+                    conflicts.append((entity_type, entity_id, taken[entity_type][entity_id]))
+                else:
+                    taken[entity_type][entity_id] = index
+        found.append(conflicts)
+
+    names = _load_names(found)
+    return [[_describe_conflict(names, *conflict) for conflict in conflicts] for conflicts in found]
+
+
+def check_schedule_conflicts(time_key, teacher_id, room_id, group_ids, exclude_id=None):
+    """
+    Проверяет наличие конфликтов в расписании при добавлении нового занятия.
+    Возвращает список строк с описаниями конфликтов.
+    """
+    week, day, time_slot = time_key
+    return check_placements([Placement(week, day, time_slot, teacher_id, room_id, group_ids, exclude_id)])[0]
+
+
+def _load_occupancy(version_id, placements, excluded_ids):
+    """
+    Занятость моментов размещений одним запросом: (week, day, slot) -> {тип: множество id}.
+    Условия по неделям, дням и парам по отдельности берут лишние моменты, но проходят по индексу
+    ix_schedule_item_version_time; лишнее отбрасывается здесь.
+    """
+    time_keys = {(placement.week, placement.day, placement.time_slot) for placement in placements}
+    occupied = {}
+    for item_id, week, day, time_slot, teacher_id, room_id, group_id in db.session.execute(
+            occupancy_select(version_id, time_keys)):
+        time_key = (week, day, time_slot)
+        if item_id in excluded_ids or time_key not in time_keys:
+            continue
+        busy = occupied.setdefault(time_key, {'teacher': set(), 'room': set(), 'group': set()})
+        busy['teacher'].add(teacher_id)
+        busy['room'].add(room_id)
+        if group_id is not None:
+            busy['group'].add(group_id)
+    return occupied
+
+
+def occupancy_select(version_id, time_keys):
+    """Выборка занятий версии с их группами в моменты time_keys (и в лишние моменты, см. _load_occupancy)"""
+    items = ScheduleItem.__table__
+    return (select(items.c.id, items.c.week, items.c.day, items.c.time_slot, items.c.teacher_id, items.c.room_id,
+                   schedule_item_group.c.group_id)
+            .outerjoin(schedule_item_group, schedule_item_group.c.schedule_item_id == items.c.id)
+            .where(items.c.version_id == version_id,
+                   items.c.week.in_({week for week, day, time_slot in time_keys}),
+                   items.c.day.in_({day for week, day, time_slot in time_keys}),
+                   items.c.time_slot.in_({time_slot for week, day, time_slot in time_keys})))
+
+
+def _load_names(found):
+    """Названия сущностей из найденных конфликтов: тип -> {id: название}, не больше запроса на тип"""
+    ids = defaultdict(set)
+    for conflicts in found:
+        for entity_type, entity_id, other in conflicts:
+            ids[entity_type].add(entity_id)
+
+    names = {}
+    for entity_type, model in (('teacher', Teacher), ('room', Room), ('group', Group)):
+        names[entity_type] = dict(db.session.query(model.id, model.name).filter(model.id.in_(ids[entity_type]))
+                                  ) if ids[entity_type] else {}
+    return names
+
+
+def _describe_conflict(names, entity_type, entity_id, other):
+    """Текст конфликта; other - номер размещения пакета, с которым он возник, или None для занятий расписания"""
+    name = names[entity_type].get(entity_id, f"№{entity_id}")
+    if other is None:
+        if entity_type == 'teacher':
+            return f"Преподаватель {name} уже занят в это время другим занятием"
+        if entity_type == 'room':
+            return f"Аудитория {name} уже занята в это время"
+        return f"Группа {name} уже имеет занятие в это время"
+
+    if entity_type == 'teacher':
+        return f"Преподаватель {name} уже занят в это время проверяемым занятием №{other + 1}"
+    if entity_type == 'room':
+        return f"Аудитория {name} уже занята в это время проверяемым занятием №{other + 1}"
+    return f"Группа {name} уже имеет в это время проверяемое занятие №{other + 1}"
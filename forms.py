@@ -103,6 +103,13 @@ class SettingsForm(FlaskForm):
         ('morning', 'Преимущественно утренние пары'),
         ('afternoon', 'Преимущественно дневные пары')
     ])
+    evaluation_backend = SelectField('Способ оценки расписания', choices=[
+        ('python', 'Python'),
+        ('numpy', 'NumPy (векторизованный)')
+    ])
+    chains_count = IntegerField('Количество цепочек генерации', default=1, validators=[NumberRange(min=1, max=64)])
+    parallel_workers = IntegerField('Количество процессов', default=0, validators=[NumberRange(min=0, max=64)])
+    random_seed = IntegerField('Начальное значение генератора случайных чисел', validators=[Optional()])
     submit = SubmitField('Сохранить')
 
 
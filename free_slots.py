@@ -0,0 +1,200 @@
+"""
+Поиск свободного времени для ручного размещения занятия.
+
+Для активной версии расписания строится индекс занятости: у каждого преподавателя, группы и аудитории
+есть битовая карта (целое число), в которой бит ((неделя - 1) * дней + день) * пар + пара установлен,
+если в это время у них есть занятие. Свободные моменты для занятия получаются несколькими побитовыми
+операциями над картами, а кандидаты упорядочиваются по тем же правилам, по которым генератор выбирает
+день, пару и аудиторию. Индекс строится один раз на ревизию расписания и версию настроек.
+"""
+import threading
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import select
+
+from models import db, ScheduleItem, Settings, schedule_item_group
+from snapshot import load_snapshot
+from scheduler import ScheduleGenerator
+
+# Занятие в индексе: бит момента времени и участники
+OccupiedItem = namedtuple('OccupiedItem', ['bit', 'teacher_id', 'room_id', 'group_ids'])
+
+_index_lock = threading.Lock()
+_cached_index = None  # (ключ, OccupancyIndex)
+
+
+class OccupancyIndex:
+    """Битовые карты занятости активной версии расписания и справочники генератора для ранжирования"""
+
+    def __init__(self, settings):
+        # Генератор без занятий нужен ради его правил выбора дней, пар и аудиторий
+        self.generator = ScheduleGenerator(settings, snapshot=load_snapshot(settings, keep_manual=False))
+        self.weeks_count = self.generator.weeks_count
+        self.days_per_week = self.generator.days_per_week
+        self.slots_per_day = self.generator.slots_per_day
+
+        self.teacher_masks = defaultdict(int)
+        self.group_masks = defaultdict(int)
+        self.room_masks = defaultdict(int)
+        self.items = {}  # id занятия -> OccupiedItem
+        self.items_by_bit = defaultdict(list)  # бит -> id занятий в это время
+
+        version_id = settings.active_schedule_version_id
+        connection = db.session.connection()
+        item_groups = defaultdict(list)
+        for item_id, group_id in connection.execute(item_groups_select(version_id)):
+            item_groups[item_id].append(group_id)
+
+        for item_id, teacher_id, room_id, week, day, time_slot in connection.execute(items_select(version_id)):
+            bit = self.bit(week, day, time_slot)
+            if bit is None:
+                continue
+            flag = 1 << bit
+            if teacher_id:
+                self.teacher_masks[teacher_id] |= flag
+            if room_id:
+                self.room_masks[room_id] |= flag
+            group_ids = tuple(item_groups.get(item_id, ()))
+            for group_id in group_ids:
+                self.group_masks[group_id] |= flag
+            self.items[item_id] = OccupiedItem(bit, teacher_id, room_id, group_ids)
+            self.items_by_bit[bit].append(item_id)
+
+    def bit(self, week, day, time_slot):
+        """Номер бита момента времени или None, если он вне сетки семестра"""
+        if not (1 <= week <= self.weeks_count and 0 <= day < self.days_per_week and
+                0 <= time_slot < self.slots_per_day):
+            return None
+        return ((week - 1) * self.days_per_week + day) * self.slots_per_day + time_slot
+
+    def time_key(self, bit):
+        """(неделя, день, пара) по номеру бита"""
+        week_day, time_slot = divmod(bit, self.slots_per_day)
+        week, day = divmod(week_day, self.days_per_week)
+        return week + 1, day, time_slot
+
+    def find_free_slots(self, course_id, lesson_type, teacher_id=None, group_ids=(), lab_subgroup_id=None,
+                        week_from=None, week_to=None, exclude_id=None):
+        """
+        Все моменты (неделя, день, пара, аудитория), в которые занятие можно поставить без конфликтов
+        преподавателя, групп и аудитории. Преподаватель, группы и начальная неделя по умолчанию берутся
+        из дисциплины; exclude_id - редактируемое занятие, которое не считается занятым.
+        Кандидаты упорядочены как при размещении генератором: дни по предпочтениям преподавателя, пары
+        по приоритету слотов, аудитории от наименьшей подходящей по вместимости; затем по неделям.
+        При неверных параметрах выбрасывает ValueError.
+        """
+        generator = self.generator
+        course = generator.courses_by_id.get(course_id)
+        if course is None:
+            raise ValueError("Дисциплина не найдена")
+
+        lab_subgroup = None
+        if lab_subgroup_id:
+            lab_subgroup = generator.subgroups_by_id.get(lab_subgroup_id)
+            if lab_subgroup is None:
+                raise ValueError("Подгруппа не найдена")
+
+        if not group_ids:
+            group_ids = (lab_subgroup.group_id,) if lab_subgroup else course.group_ids
+        group_ids = tuple(group_id for group_id in group_ids if group_id in generator.groups_by_id)
+        if not group_ids:
+            raise ValueError("Не заданы группы занятия")
+
+        if teacher_id:
+            teacher = generator.teachers_by_id.get(teacher_id)
+            if teacher is None:
+                raise ValueError("Преподаватель не найден")
+        else:
+            teacher = generator._get_course_teacher(course, lesson_type, lab_subgroup_id)
+            if teacher is None:
+                raise ValueError("Не задан преподаватель занятия")
+
+        if lab_subgroup:
+            students = lab_subgroup.size
+        else:
+            students = sum(generator.groups_by_id[group_id].size for group_id in group_ids)
+        suitable_rooms = generator._find_suitable_rooms(course, lesson_type, students)
+        if suitable_rooms is None:
+            return []
+
+        week_from = max(week_from or course.start_week or 1, 1)
+        week_to = min(week_to or self.weeks_count, self.weeks_count)
+        if week_from > week_to:
+            return []
+
+        # Моменты, занятые преподавателем или любой из групп, и моменты вне диапазона недель
+        week_bits = self.days_per_week * self.slots_per_day
+        in_range = (1 << (week_to * week_bits)) - (1 << ((week_from - 1) * week_bits))
+        busy = self._mask(self.teacher_masks, teacher.id, exclude_id, lambda item: item.teacher_id == teacher.id)
+        for group_id in group_ids:
+            busy |= self._mask(self.group_masks, group_id, exclude_id, lambda item: group_id in item.group_ids)
+        free = in_range & ~busy
+
+        day_rank = {day: rank for rank, day in enumerate(generator._get_prioritized_days(teacher))}
+        slot_rank = {slot: rank for rank, slot in
+                     enumerate(generator._get_prioritized_time_slots(teacher, course, group_ids))}
+
+        bucket, room_positions = suitable_rooms
+        rooms = generator._room_buckets[bucket][1]
+        candidates = []
+        room_rank = 0
+        while room_positions:
+            lowest = room_positions & -room_positions
+            room_positions ^= lowest
+            room = rooms[lowest.bit_length() - 1]
+            room_busy = self._mask(self.room_masks, room.id, exclude_id, lambda item: item.room_id == room.id)
+            room_free = free & ~room_busy
+            while room_free:
+                flag = room_free & -room_free
+                room_free ^= flag
+                week, day, time_slot = self.time_key(flag.bit_length() - 1)
+                candidates.append(((day_rank[day], slot_rank[time_slot], room_rank, week),
+                                   (week, day, time_slot, room)))
+            room_rank += 1
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        return [candidate for rank, candidate in candidates]
+
+    def _mask(self, masks, entity_id, exclude_id, uses):
+        """
+        Карта занятости сущности; если задан exclude_id, без момента этого занятия, когда сущность
+        в этот момент не занята другими занятиями. uses(OccupiedItem) - участвует ли сущность в занятии.
+        """
+        mask = masks.get(entity_id, 0)
+        excluded = self.items.get(exclude_id)
+        if excluded is None or not uses(excluded):
+            return mask
+        for item_id in self.items_by_bit[excluded.bit]:
+            if item_id != exclude_id and uses(self.items[item_id]):
+                return mask
+        return mask & ~(1 << excluded.bit)
+
+
+def item_groups_select(version_id):
+    """Выборка пар (id занятия, id группы) версии для индекса занятости"""
+    items = ScheduleItem.__table__
+    return (select(schedule_item_group.c.schedule_item_id, schedule_item_group.c.group_id)
+            .join(items, items.c.id == schedule_item_group.c.schedule_item_id)
+            .where(items.c.version_id == version_id))
+
+
+def items_select(version_id):
+    """Выборка занятий версии (id, преподаватель, аудитория, время) для индекса занятости"""
+    items = ScheduleItem.__table__
+    return (select(items.c.id, items.c.teacher_id, items.c.room_id, items.c.week, items.c.day, items.c.time_slot)
+            .where(items.c.version_id == version_id))
+
+
+def get_occupancy_index():
+    """Индекс занятости активной версии; перестраивается после изменения расписания или настроек"""
+    global _cached_index
+    settings = Settings.query.first()
+    key = (settings.schedule_revision, settings.version, settings.active_schedule_version_id)
+    with _index_lock:
+        if _cached_index is not None and _cached_index[0] == key:
+            return _cached_index[1]
+
+    index = OccupancyIndex(settings)
+    with _index_lock:
+        _cached_index = (key, index)
+    return index
@@ -0,0 +1,177 @@
+"""
+Генератор синтетических наборов данных для проверки скорости и качества генерации расписания.
+
+Создает SQLite-файл с факультетами, группами (с подгруппами для лабораторных), преподавателями
+с предпочтениями, аудиториями всех типов и дисциплинами с лекциями, практиками и лабораторными.
+Пример:
+    python generate_dataset.py datasets/medium.db --courses 200 --seed 1
+"""
+import argparse
+import os
+import random
+
+from flask import Flask
+
+from models import (db, Faculty, Teacher, Group, Room, Course, CourseGroup, CourseTeacher, Settings,
+                    LabSubgroup)
+
+
+def create_app(path):
+    """Приложение Flask, работающее с указанным файлом базы данных"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(path)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def _random_subset(rng, values, min_size, max_size):
+    """Случайное упорядоченное подмножество в виде строки "0,2,3", как хранятся предпочтения в моделях"""
+    size = rng.randint(min_size, max_size)
+    return ','.join(map(str, sorted(rng.sample(values, size))))
+
+
+def populate(courses_count, faculties_count=None, groups_count=None, teachers_count=None, rooms_count=None,
+             weeks_count=18, seed=0):
+    """
+    Заполняет пустую базу данных синтетическим набором.
+    Количества, которые не заданы, вычисляются из числа дисциплин в пропорциях обычного вуза.
+    """
+    rng = random.Random(seed)
+    faculties_count = faculties_count or max(1, courses_count // 150 + 1)
+    groups_count = groups_count or max(2, courses_count * 2 // 7)
+    teachers_count = teachers_count or max(2, courses_count // 3)
+    rooms_count = rooms_count or max(5, courses_count // 6)
+
+    days = list(range(5))
+    slots = list(range(7))
+
+    db.session.add(Settings(weeks_count=weeks_count, days_per_week=len(days), slots_per_day=len(slots),
+                            avoid_windows=True, prioritize_faculty=True, respect_teacher_preferences=True,
+                            optimize_room_usage=True, max_lessons_per_day_global=4,
+                            preferred_lesson_distribution='balanced', version=1, evaluation_backend='python',
+                            chains_count=1, parallel_workers=0))
+
+    faculties = [Faculty(name=f"Факультет {i + 1}", priority=rng.randint(1, 10)) for i in range(faculties_count)]
+    db.session.add_all(faculties)
+    db.session.flush()
+
+    # Группы по факультетам; часть групп делится на подгруппы для лабораторных
+    groups_by_faculty = {faculty.id: [] for faculty in faculties}
+    groups = []
+    for i in range(groups_count):
+        faculty = faculties[i % faculties_count]
+        group = Group(name=f"Г-{i + 1}", size=rng.randint(15, 30), year_of_study=rng.randint(1, 4),
+                      lab_subgroups_count=rng.choice([1, 2, 2, 3]), faculty_id=faculty.id,
+                      max_lessons_per_day=rng.choice([3, 4, 4, 5]),
+                      preferred_time_slots=_random_subset(rng, slots, 4, 7))
+        db.session.add(group)
+        groups.append(group)
+        groups_by_faculty[faculty.id].append(group)
+    db.session.flush()
+    for group in groups:
+        group.create_subgroups()
+
+    teachers = [
+        Teacher(name=f"Преподаватель {i + 1}", preferred_days=_random_subset(rng, days, 3, 5),
+                preferred_time_slots=_random_subset(rng, slots, 3, 7), max_lessons_per_day=rng.choice([3, 4, 5]))
+        for i in range(teachers_count)
+    ]
+    db.session.add_all(teachers)
+
+    # Аудитории всех типов: лекционные, компьютерные классы, лаборатории и обычные
+    rooms = []
+    for i in range(rooms_count):
+        kind = i % 6
+        if kind == 0:
+            room = Room(name=f"Л-{i + 1}", capacity=rng.choice([60, 90, 120, 150]), is_lecture_hall=True)
+        elif kind == 1:
+            room = Room(name=f"К-{i + 1}", capacity=rng.choice([12, 15, 20, 30]), is_lab=True, is_computer_lab=True)
+        elif kind == 2:
+            room = Room(name=f"Лаб-{i + 1}", capacity=rng.choice([12, 15, 20, 30]), is_lab=True)
+        else:
+            room = Room(name=f"А-{i + 1}", capacity=rng.choice([25, 30, 40, 60]))
+        room.building = str(rng.randint(1, 5))
+        room.floor = rng.randint(1, 5)
+        rooms.append(room)
+    db.session.add_all(rooms)
+    db.session.flush()
+
+    subgroups_by_group = {}
+    for subgroup in LabSubgroup.query.all():
+        subgroups_by_group.setdefault(subgroup.group_id, []).append(subgroup)
+
+    for i in range(courses_count):
+        # Дисциплину слушают 1-3 группы одного факультета (поток)
+        faculty_groups = groups_by_faculty[faculties[i % faculties_count].id] or groups
+        course_groups = rng.sample(faculty_groups, min(len(faculty_groups), rng.choice([1, 1, 2, 3])))
+
+        course = Course(name=f"Дисциплина {i + 1}", lecture_count=rng.choice([0, 8, 9, 16, 18]),
+                        practice_count=rng.choice([0, 8, 9, 16, 18]), lab_count=rng.choice([0, 0, 4, 8, 9]),
+                        start_week=rng.randint(1, 3),
+                        distribution_type=rng.choice(['even', 'even', 'front_loaded', 'back_loaded', 'block']),
+                        priority=rng.randint(1, 10))
+        if not (course.lecture_count or course.practice_count or course.lab_count):
+            course.practice_count = 8
+        if rng.random() < 0.1:
+            course.preferred_rooms.append(rng.choice(rooms))
+        db.session.add(course)
+        db.session.flush()
+
+        for group in course_groups:
+            db.session.add(CourseGroup(course_id=course.id, group_id=group.id))
+
+        # Преподаватели по типам занятий; у некоторых подгрупп свой преподаватель лабораторных
+        for lesson_type, count in (('lecture', course.lecture_count), ('practice', course.practice_count),
+                                   ('lab', course.lab_count)):
+            if count:
+                db.session.add(CourseTeacher(course_id=course.id, teacher_id=rng.choice(teachers).id,
+                                             lesson_type=lesson_type))
+        if course.lab_count:
+            for group in course_groups:
+                for subgroup in subgroups_by_group.get(group.id, []):
+                    if rng.random() < 0.3:
+                        db.session.add(CourseTeacher(course_id=course.id, teacher_id=rng.choice(teachers).id,
+                                                     lesson_type='lab', lab_subgroup_id=subgroup.id))
+
+    db.session.commit()
+    return {
+        'faculties': faculties_count,
+        'groups': groups_count,
+        'teachers': teachers_count,
+        'rooms': rooms_count,
+        'courses': courses_count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Создает SQLite-файл с синтетическими данными для расписания")
+    parser.add_argument('path', help="файл базы данных")
+    parser.add_argument('--courses', type=int, default=100, help="количество дисциплин")
+    parser.add_argument('--faculties', type=int, help="количество факультетов")
+    parser.add_argument('--groups', type=int, help="количество групп")
+    parser.add_argument('--teachers', type=int, help="количество преподавателей")
+    parser.add_argument('--rooms', type=int, help="количество аудиторий")
+    parser.add_argument('--weeks', type=int, default=18, help="количество недель в семестре")
+    parser.add_argument('--seed', type=int, default=0, help="seed генератора данных")
+    parser.add_argument('--overwrite', action='store_true', help="перезаписать существующий файл")
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        if not args.overwrite:
+            parser.error(f"файл {args.path} уже существует, используйте --overwrite")
+        os.remove(args.path)
+    directory = os.path.dirname(os.path.abspath(args.path))
+    os.makedirs(directory, exist_ok=True)
+
+    app = create_app(args.path)
+    with app.app_context():
+        db.create_all()
+        counts = populate(args.courses, args.faculties, args.groups, args.teachers, args.rooms,
+                          weeks_count=args.weeks, seed=args.seed)
+
+    print(f"Создан набор данных {args.path}: " + ', '.join(f"{name} - {count}" for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
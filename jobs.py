@@ -0,0 +1,122 @@
+"""
+Фоновая генерация расписания.
+
+Генерация выполняется в отдельном потоке, HTTP-запрос сразу получает идентификатор задачи,
+а ход генерации, отмена и результат доступны через API по этому идентификатору.
+Так же выполняется и инкрементальное восстановление расписания после изменения данных (incremental).
+"""
+import threading
+import time
+import uuid
+
+from models import db, Settings
+from scheduler import ScheduleGenerator
+
+MAX_FINISHED_JOBS = 20  # сколько завершенных задач хранить для запросов результата
+
+_jobs = {}  # job_id -> GenerationJob
+_jobs_lock = threading.Lock()
+
+
+class GenerationJob:
+    """Задача генерации расписания и ее состояние"""
+
+    def __init__(self, keep_manual, incremental=False):
+        self.id = uuid.uuid4().hex
+        self.keep_manual = keep_manual
+        self.incremental = incremental  # восстановить только затронутые изменениями занятия (repair)
+        self.status = 'queued'  # queued, running, completed, failed, cancelled
+        self.progress = {'phase': 'queued'}
+        self.stats = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+    def update_progress(self, progress):
+        """Вызывается генератором; словарь заменяется целиком, поэтому читатели видят согласованное состояние"""
+        self.progress = progress
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'keep_manual': self.keep_manual,
+            'incremental': self.incremental,
+            'progress': self.progress,
+            'error': self.error,
+            'elapsed': round(finished_at - (self.started_at or self.created_at), 2),
+        }
+
+
+def submit_generation(app, keep_manual=False, incremental=False):
+    """
+    Запускает генерацию (или инкрементальное восстановление) в фоновом потоке и возвращает задачу.
+    Одновременно выполняется только одна генерация: если она уже идет, возвращается текущая задача.
+    """
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job.is_active:
+                return job
+
+        job = GenerationJob(keep_manual, incremental)
+        _jobs[job.id] = job
+        _prune_finished_jobs()
+
+    thread = threading.Thread(target=_run_generation, args=(app, job), name=f"generation-{job.id}", daemon=True)
+    thread.start()
+    return job
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def cancel_job(job_id):
+    """Запрашивает отмену задачи; генератор прервется при ближайшей проверке"""
+    job = _jobs.get(job_id)
+    if job is not None and job.is_active:
+        job.cancel_event.set()
+    return job
+
+
+def _prune_finished_jobs():
+    finished = sorted((job for job in _jobs.values() if not job.is_active), key=lambda job: job.created_at)
+    for job in finished[:-MAX_FINISHED_JOBS]:
+        del _jobs[job.id]
+
+
+def _run_generation(app, job):
+    """Выполняется в фоновом потоке"""
+    job.status = 'running'
+    job.started_at = time.time()
+    with app.app_context():
+        try:
+            # Текущее расписание не удаляем: новое станет активным только после успешной генерации.
+            # Восстановление берет ручные занятия из активной версии вместе с остальными
+            generator = ScheduleGenerator(Settings.query.first(),
+                                          keep_manual=job.keep_manual and not job.incremental,
+                                          progress_callback=job.update_progress, cancel_event=job.cancel_event)
+            success = generator.repair() if job.incremental else generator.generate()
+            job.stats = generator.stats
+
+            if generator.stats.get('cancelled'):
+                job.status = 'cancelled'
+            elif success:
+                job.status = 'completed'
+            else:
+                job.status = 'failed'
+                job.error = generator.stats.get('repair_error') or 'Не удалось сгенерировать расписание'
+        except Exception as e:
+            db.session.rollback()
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            db.session.remove()
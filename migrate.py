@@ -1,5 +1,12 @@
-from app import app, db, Course, CourseTeacher, ScheduleItem, Teacher
-from sqlalchemy import text
+import sys
+from datetime import datetime
+
+from app import app, db, schedule_items_query, Course, CourseTeacher, ScheduleItem, ScheduleVersion, Settings, Teacher
+from conflicts import occupancy_select
+from free_slots import item_groups_select, items_select
+from models import CourseGroup, LabSubgroup, TimetableDocument, schedule_item_group
+from sqlalchemy import select, text
+from versions import bulk_insert
 
 
 def migrate_database():
@@ -101,5 +108,197 @@ def migrate_database():
             db.session.rollback()
 
 
+def add_missing_columns():
+    """
+    Добавляет в существующую базу данных поля, появившиеся в моделях после ее создания.
+    Каждое поле проверяется отдельно, поэтому скрипт можно запускать повторно.
+    """
+    # (таблица, поле, определение поля для ALTER TABLE)
+    columns = [
+        ('settings', 'evaluation_backend', "VARCHAR(20) DEFAULT 'python'"),
+        ('settings', 'chains_count', "INTEGER DEFAULT 1"),
+        ('settings', 'parallel_workers', "INTEGER DEFAULT 0"),
+        ('settings', 'random_seed', "INTEGER"),
+        ('settings', 'active_schedule_version_id', "INTEGER REFERENCES schedule_version(id)"),
+        ('schedule_item', 'version_id', "INTEGER REFERENCES schedule_version(id)"),
+        ('settings', 'schedule_revision', "INTEGER DEFAULT 1"),
+        ('settings', 'schedule_modified_at', "DATETIME"),
+        ('schedule_version', 'input_fingerprints', "TEXT"),
+    ]
+
+    with app.app_context():
+        # Новые таблицы (например, schedule_version) создаются целиком
+        db.create_all()
+
+        for table, column, definition in columns:
+            try:
+                db.session.execute(text(f"SELECT {column} FROM {table} LIMIT 1"))
+                print(f"Поле {column} в таблице {table} уже существует")
+            except:
+                db.session.rollback()
+                print(f"Добавление поля {column} в таблицу {table}...")
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+                db.session.commit()
+
+
+def migrate_schedule_versions():
+    """
+    Переносит занятия, созданные до появления версий расписания, в отдельную активную версию.
+    Повторный запуск ничего не меняет: занятий без версии после переноса не остается.
+    """
+    with app.app_context():
+        legacy_count = db.session.execute(
+            text("SELECT COUNT(*) FROM schedule_item WHERE version_id IS NULL")).scalar()
+        if not legacy_count:
+            print("Занятий без версии расписания нет")
+            return
+
+        settings = Settings.query.first()
+        if settings is None:
+            print("Настройки не найдены, перенос занятий в версию расписания пропущен")
+            return
+
+        print(f"Перенос {legacy_count} занятий в версию расписания...")
+        version_id = settings.active_schedule_version_id
+        if version_id is None:
+            version = ScheduleVersion(status='active', description='Расписание до введения версий',
+                                      activated_at=datetime.utcnow())
+            db.session.add(version)
+            db.session.flush()
+            version_id = version.id
+            settings.active_schedule_version_id = version_id
+
+        db.session.execute(text("UPDATE schedule_item SET version_id = :version_id WHERE version_id IS NULL"),
+                           {'version_id': version_id})
+        db.session.commit()
+
+
+def migrate_schedule_item_groups(batch_size=5000):
+    """
+    Заполняет таблицу schedule_item_group по строковому полю ScheduleItem.groups.
+    Занятия обрабатываются пачками по id с фиксацией после каждой пачки, поэтому большая таблица
+    не держится в памяти целиком, а прерванный перенос можно продолжить повторным запуском:
+    занятия, у которых связи уже есть, пропускаются.
+    """
+    with app.app_context():
+        existing_groups = {row[0] for row in db.session.execute(text("SELECT id FROM \"group\""))}
+        last_id = 0
+        converted = 0
+        while True:
+            batch = db.session.execute(text(
+                "SELECT id, groups FROM schedule_item WHERE id > :last_id AND NOT EXISTS ("
+                "SELECT 1 FROM schedule_item_group WHERE schedule_item_id = schedule_item.id) "
+                "ORDER BY id LIMIT :batch_size"), {'last_id': last_id, 'batch_size': batch_size}).fetchall()
+            if not batch:
+                break
+
+            rows = []
+            for item_id, groups in batch:
+                for part in (groups or '').split(','):
+                    # Ссылки на удаленные группы не переносим
+                    if part.strip() and int(part) in existing_groups:
+                        rows.append((item_id, int(part)))
+            if rows:
+                bulk_insert(schedule_item_group, ('schedule_item_id', 'group_id'), rows)
+            db.session.commit()
+
+            last_id = batch[-1][0]
+            converted += len(batch)
+            print(f"Перенесены группы {converted} занятий...")
+
+        if converted:
+            print(f"Связи с группами созданы для {converted} занятий")
+        else:
+            print("Связи занятий с группами уже перенесены")
+
+
+def create_missing_indexes():
+    """Создает индексы, объявленные в моделях, которых еще нет в базе данных (CREATE INDEX IF NOT EXISTS)"""
+    with app.app_context():
+        for table in db.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                index.create(bind=db.engine, checkfirst=True)
+        print("Индексы таблиц проверены")
+
+
+def _query_plan_checks():
+    """
+    Запросы приложения и индексы, которыми они могут пользоваться. Выборки эндпоинтов строятся теми же
+    функциями, что и в приложении, поэтому проверка следит за запросами, которые выполняются на самом деле.
+    Значения параметров не важны: план SQLite зависит только от условий.
+    """
+    version_id, week, teacher_id, group_id = 1, 1, 1, 1
+    items = ScheduleItem.query.filter(ScheduleItem.version_id == version_id)
+    # Все индексы занятий начинаются с version_id, выборке всей версии подходит любой из них
+    version_indexes = ('ix_schedule_item_version_time', 'ix_schedule_item_version_teacher',
+                       'ix_schedule_item_version_manual')
+    return [
+        ('занятия недели', ('ix_schedule_item_version_time',),
+         schedule_items_query(items.filter_by(week=week))),
+        ('занятость для проверки конфликтов', ('ix_schedule_item_version_time',),
+         occupancy_select(version_id, {(week, 0, 0), (week + 1, 1, 3)})),
+        ('группы занятий для индекса свободного времени', version_indexes,
+         item_groups_select(version_id)),
+        ('занятия для индекса свободного времени', version_indexes,
+         items_select(version_id)),
+        # Фильтр массовых операций по группе и перестроение документов групп
+        ('занятия групп', ('ix_schedule_item_group_group_id',),
+         items.filter(ScheduleItem.id.in_(select(schedule_item_group.c.schedule_item_id)
+                                          .where(schedule_item_group.c.group_id.in_([group_id, group_id + 1]))))),
+        ('ручные занятия', ('ix_schedule_item_version_manual',),
+         items.filter_by(is_manually_placed=True)),
+        ('преподаватель дисциплины', ('ix_course_teacher_course_type',),
+         CourseTeacher.query.filter_by(course_id=1, lesson_type='lab', lab_subgroup_id=None)),
+        ('занятия преподавателя', ('ix_course_teacher_teacher_id',),
+         CourseTeacher.query.filter_by(teacher_id=teacher_id)),
+        ('группы дисциплины', ('ix_course_group_course_id',),
+         CourseGroup.query.filter_by(course_id=1)),
+        ('дисциплины группы', ('ix_course_group_group_id',),
+         CourseGroup.query.filter_by(group_id=group_id)),
+        ('подгруппы группы', ('ix_lab_subgroup_group_id',),
+         LabSubgroup.query.filter_by(group_id=group_id)),
+        ('документ расписания', ('ix_timetable_document_entity',),
+         TimetableDocument.query.filter_by(version_id=version_id, entity_type='group', entity_id=group_id)),
+    ]
+
+
+def check_query_plans():
+    """
+    Проверяет через EXPLAIN QUERY PLAN, что основные выборки расписания идут по индексам,
+    а не полным просмотром таблиц. Возвращает список описаний проблем (пустой, если все в порядке).
+    """
+    problems = []
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            print("Проверка планов запросов доступна только для SQLite")
+            return problems
+
+        for name, indexes, query in _query_plan_checks():
+            # Запросы ORM отдают выборку через .statement, выборки Core передаются как есть
+            statement = getattr(query, 'statement', query)
+            sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+            plan = [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            uses_index = any(f"INDEX {index} " in f"{detail} " for detail in plan for index in indexes)
+            # Полный просмотр таблицы или индекса SQLite обозначает как "SCAN <таблица>"
+            full_scan = any(detail.startswith('SCAN ') for detail in plan)
+            if not uses_index or full_scan:
+                problems.append(f"{name}: ожидался индекс {' или '.join(indexes)}, план: {'; '.join(plan)}")
+
+    if problems:
+        print("Запросы без нужных индексов:")
+        for problem in problems:
+            print(f"  {problem}")
+    else:
+        print("Планы запросов используют индексы")
+    return problems
+
+
 if __name__ == "__main__":
-    migrate_database()
\ No newline at end of file
+    # Сначала добавляем новые поля: миграция данных читает модели целиком
+    add_missing_columns()
+    migrate_database()
+    migrate_schedule_versions()
+    migrate_schedule_item_groups()
+    create_missing_indexes()
+    if check_query_plans():
+        sys.exit(1)
\ No newline at end of file
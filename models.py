@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship
 from collections import defaultdict
+from datetime import datetime
 
 # Create the SQLAlchemy instance
 db = SQLAlchemy()
@@ -43,6 +44,10 @@ class Teacher(db.Model):
 
 
 class LabSubgroup(db.Model):
+    __table_args__ = (
+        db.Index('ix_lab_subgroup_group_id', 'group_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
     subgroup_number = db.Column(db.Integer, nullable=False)  # Номер подгруппы
@@ -132,6 +137,13 @@ course_preferred_rooms = db.Table('course_preferred_rooms',
 
 # Модель для связи курса с преподавателями по типам занятий и подгруппам
 class CourseTeacher(db.Model):
+    __table_args__ = (
+        # Поиск преподавателя занятия по дисциплине, типу и подгруппе
+        db.Index('ix_course_teacher_course_type', 'course_id', 'lesson_type', 'lab_subgroup_id'),
+        db.Index('ix_course_teacher_teacher_id', 'teacher_id'),
+        db.Index('ix_course_teacher_lab_subgroup_id', 'lab_subgroup_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
@@ -209,6 +221,11 @@ class Course(db.Model):
 
 
 class CourseGroup(db.Model):
+    __table_args__ = (
+        db.Index('ix_course_group_course_id', 'course_id'),
+        db.Index('ix_course_group_group_id', 'group_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
@@ -219,8 +236,45 @@ class CourseGroup(db.Model):
         return f'<CourseGroup {self.course.name} - {self.group.name}>'
 
 
+class ScheduleVersion(db.Model):
+    """Версия расписания: генерация пишет в новую версию, которая затем становится активной"""
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), default='staged')  # staged, active, archived
+    description = db.Column(db.String(200), nullable=True)
+    score = db.Column(db.Float, nullable=True)  # Оценка сгенерированного расписания
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    activated_at = db.Column(db.DateTime, nullable=True)
+    # JSON отпечатков данных, по которым составлена версия (snapshot.input_fingerprints),
+    # для инкрементального восстановления после изменения данных
+    input_fingerprints = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f'<ScheduleVersion {self.id} {self.status}>'
+
+
+# Группы занятия расписания. Строка ScheduleItem.groups хранит те же id для отображения,
+# а выборки по группе идут через эту таблицу и индекс (group_id, schedule_item_id)
+schedule_item_group = db.Table('schedule_item_group',
+                               db.Column('schedule_item_id', db.Integer, db.ForeignKey('schedule_item.id'),
+                                         primary_key=True),
+                               db.Column('group_id', db.Integer, db.ForeignKey('group.id'), primary_key=True),
+                               db.Index('ix_schedule_item_group_group_id', 'group_id', 'schedule_item_id')
+                               )
+
+
 class ScheduleItem(db.Model):
+    # Все выборки занятий идут по одной версии расписания, поэтому version_id - первое поле индексов
+    __table_args__ = (
+        # Проверка конфликтов по времени; префикс (version_id, week) - занятия недели
+        db.Index('ix_schedule_item_version_time', 'version_id', 'week', 'day', 'time_slot'),
+        # Расписание преподавателя на неделю
+        db.Index('ix_schedule_item_version_teacher', 'version_id', 'teacher_id', 'week'),
+        # Ручные занятия для генератора
+        db.Index('ix_schedule_item_version_manual', 'version_id', 'is_manually_placed'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('schedule_version.id'), nullable=True)  # Версия расписания
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     course = relationship("Course", back_populates="schedule_items")
@@ -230,6 +284,8 @@ class ScheduleItem(db.Model):
     time_slot = db.Column(db.Integer, nullable=False)  # 0-7 (пары в день)
     lesson_type = db.Column(db.String(10), nullable=False)  # lecture, practice, lab
     groups = db.Column(db.String, nullable=False)  # Сериализованный список ID групп
+    assigned_groups = relationship("Group", secondary=schedule_item_group,
+                                   backref=db.backref('schedule_items', lazy='dynamic'))
     teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=True)
     teacher = relationship("Teacher")
     lab_subgroup_id = db.Column(db.Integer, db.ForeignKey('lab_subgroup.id'), nullable=True)
@@ -244,6 +300,11 @@ class ScheduleItem(db.Model):
     def get_group_ids(self):
         return [int(g) for g in self.groups.split(',')]
 
+    def set_group_ids(self, group_ids):
+        """Задает группы занятия: строку groups и связи в таблице schedule_item_group"""
+        self.groups = ','.join(map(str, group_ids))
+        self.assigned_groups = Group.query.filter(Group.id.in_(group_ids)).all() if group_ids else []
+
     def to_dict(self):
         """Преобразует объект ScheduleItem в словарь для API"""
         return {
@@ -266,6 +327,25 @@ class ScheduleItem(db.Model):
         }
 
 
+class TimetableDocument(db.Model):
+    """
+    Готовое расписание группы, подгруппы, преподавателя или аудитории на весь семестр для одной версии.
+    document - JSON "номер недели -> занятия" в формате ответа /schedule/data.
+    """
+    __table_args__ = (
+        db.Index('ix_timetable_document_entity', 'version_id', 'entity_type', 'entity_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('schedule_version.id'), nullable=False)
+    entity_type = db.Column(db.String(10), nullable=False)  # group, subgroup, teacher, room
+    entity_id = db.Column(db.Integer, nullable=False)
+    document = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'<TimetableDocument {self.entity_type} {self.entity_id} (version {self.version_id})>'
+
+
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     weeks_count = db.Column(db.Integer, default=18)
@@ -279,6 +359,14 @@ class Settings(db.Model):
     max_lessons_per_day_global = db.Column(db.Integer, default=4)  # Глобальный максимум пар в день
     preferred_lesson_distribution = db.Column(db.String(20), default='balanced')  # balanced, morning, afternoon
     version = db.Column(db.Integer, default=1)  # Версия расписания для отслеживания изменений
+    evaluation_backend = db.Column(db.String(20), default='python')  # python, numpy
+    chains_count = db.Column(db.Integer, default=1)  # Независимых цепочек генерации, из них берется лучшая
+    parallel_workers = db.Column(db.Integer, default=0)  # Процессов для цепочек (0 - по числу ядер)
+    random_seed = db.Column(db.Integer, nullable=True)  # Seed для воспроизводимой генерации (пусто - случайный)
+    active_schedule_version_id = db.Column(db.Integer, nullable=True)  # Версия расписания, которую видят все
+    # Ревизия видимого расписания: увеличивается при любом его изменении, по ней проверяется актуальность кэша
+    schedule_revision = db.Column(db.Integer, default=1)
+    schedule_modified_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<Settings weeks={self.weeks_count}>'
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""
+Кэш готовых JSON-ответов расписания в памяти процесса.
+
+Ключ записи включает ревизию расписания (Settings.schedule_revision), поэтому после любого изменения
+расписания старые записи просто перестают запрашиваться и со временем вытесняются как давно
+не использованные. Явно сбрасывать кэш не нужно, и несколько процессов приложения не мешают друг другу.
+"""
+import threading
+from collections import OrderedDict
+
+MAX_CACHED_RESPONSES = 2048  # сколько ответов (группа/преподаватель + неделя) держать в памяти
+
+
+class LRUCache:
+    """Словарь ограниченного размера, вытесняющий давно не использованные записи; безопасен для потоков"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+response_cache = LRUCache(MAX_CACHED_RESPONSES)
@@ -1,273 +1,876 @@
 import random
-import copy
 import math
+from bisect import bisect_left
+import contextlib
+import io
+import json
+import os
+import sys
 import time
 from collections import defaultdict
-from models import db, Course, Group, Teacher, Room, ScheduleItem, LabSubgroup
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import func, select
+from models import db, ScheduleItem, ScheduleVersion, Settings
+from snapshot import load_snapshot, count_queries, load_version_items, input_fingerprints, changed_inputs
+from versions import (create_staged_version, publish_version, discard_version, sqlite_bulk_write, bulk_insert,
+                      bulk_link_item_groups, copy_manual_items, delete_schedule_items, bump_schedule_revision)
+from timetables import build_timetables, lessons_timetable_entities, refresh_timetables
+import tensor_eval
+
+try:
+    import resource
+except ImportError:  # модуль недоступен в Windows
+    resource = None
+
+
+def get_peak_rss_mb():
+    """Возвращает пиковое потребление памяти процессом в МБ (None, если платформа не позволяет узнать)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В macOS значение в байтах, в Linux - в килобайтах
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class GenerationCancelled(Exception):
+    """Генерация расписания отменена"""
+
+
+class Lesson:
+    """Занятие в расписании генератора: id связанных записей и заранее посчитанные величины"""
+    __slots__ = ('course_id', 'lesson_type', 'teacher_id', 'group_ids', 'lab_subgroup_id', 'subgroup_group_id',
+                 'students', 'room_id', 'time_key', 'is_manually_placed')
+
+    def __init__(self, course_id, lesson_type, teacher_id, group_ids, students, room_id,
+                 lab_subgroup_id=None, subgroup_group_id=None, is_manually_placed=False):
+        self.course_id = course_id
+        self.lesson_type = lesson_type
+        self.teacher_id = teacher_id  # может отсутствовать у занятий, размещенных вручную
+        self.group_ids = tuple(group_ids)
+        self.lab_subgroup_id = lab_subgroup_id
+        self.subgroup_group_id = subgroup_group_id  # группа, которой принадлежит подгруппа
+        self.students = students  # размер подгруппы или суммарная численность групп
+        self.room_id = room_id
+        self.time_key = None  # (week, day, slot), заполняется при добавлении в расписание
+        self.is_manually_placed = is_manually_placed
 
 
 # Класс для генерации расписания с поддержкой подгрупп и приоритетов
 class ScheduleGenerator:
-    def __init__(self, settings):
-        self.settings = settings
-        self.weeks_count = settings.weeks_count
-        self.days_per_week = settings.days_per_week
-        self.slots_per_day = settings.slots_per_day
-
-        # Получаем все необходимые данные
-        self.courses = Course.query.all()
-        self.rooms = Room.query.all()
-        self.teachers = Teacher.query.all()
-        self.groups = Group.query.all()
+    def __init__(self, settings, snapshot=None, seed=None, progress_callback=None, cancel_event=None,
+                 keep_manual=True):
+        # Получаем все необходимые данные одним снимком: дальше генератор работает без запросов к БД.
+        # keep_manual - учитывать и сохранять ручные занятия активной версии расписания
+        if snapshot is None:
+            snapshot = load_snapshot(settings, keep_manual=keep_manual)
+        self.snapshot = snapshot
+        self.settings = snapshot.settings
+        self.weeks_count = self.settings.weeks_count
+        self.days_per_week = self.settings.days_per_week
+        self.slots_per_day = self.settings.slots_per_day
+
+        # Собственный генератор случайных чисел. Если в настройках задан seed, генерация воспроизводима:
+        # оптимизация ограничивается только числом итераций, а не временем
+        self.deterministic = self.settings.random_seed is not None
+        self.seed = seed if seed is not None else self.settings.random_seed
+        self.rng = random.Random(self.seed)
+
+        # Полная оценка расписания: на чистом Python или векторизованная на NumPy
+        self.evaluation_backend = self.settings.evaluation_backend
+        if self.evaluation_backend == 'numpy' and not tensor_eval.NUMPY_AVAILABLE:
+            print("NumPy не установлен, расписание будет оцениваться на Python")
+            self.evaluation_backend = 'python'
+
+        self.courses = snapshot.courses
+        self.rooms = snapshot.rooms
+        self.teachers = snapshot.teachers
+        self.groups = snapshot.groups
+
+        # Справочники по id
+        self.courses_by_id = {course.id: course for course in snapshot.courses}
+        self.rooms_by_id = {room.id: room for room in snapshot.rooms}
+        self.teachers_by_id = {teacher.id: teacher for teacher in snapshot.teachers}
+        self.groups_by_id = {group.id: group for group in snapshot.groups}
+        self.subgroups_by_id = {subgroup.id: subgroup for subgroup in snapshot.subgroups}
+        self._group_ids = set(self.groups_by_id)
+
+        # Аудитории по типам и вместимости
+        self._build_room_index()
 
         # Создаем пустое расписание
         self.schedule = {}  # (week, day, slot) -> [schedule_items]
 
+        # Журнал последней перестановки для ее отмены
+        self._last_swap = None
+
+        # Лучшее найденное решение хранится как положения занятий, измененных с начала оптимизации:
+        # id(занятия) -> (time_key, room_id); занятия, которые не двигались, в нем отсутствуют
+        self._best_assignment = {}
+        self._moved_since_snapshot = {}  # id(занятия) -> занятие, перемещенное после последнего снимка
+
+        # Статистика последней генерации
+        self.stats = {'load_queries': snapshot.query_count}
+
+        # Ход генерации передается в progress_callback(dict); установленный cancel_event прерывает генерацию
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+
+        # Индекс занятости преподавателей, групп, подгрупп и аудиторий
+        self._reset_index()
+
         # Загружаем уже размещенные вручную элементы
         self.load_manual_items()
 
         # Ограничения по времени и итерациям
         self.max_generation_time = 45  # максимальное время генерации расписания в секундах
-        self.max_iterations = 1500  # максимальное количество итераций
+        self.max_iterations = 150000  # максимальное количество итераций
 
         # Параметры оптимизации
         self.temperature = 1.0  # Начальная температура для имитации отжига
-        self.cooling_rate = 0.99  # Коэффициент охлаждения
+        self.cooling_rate = 0.9999  # Коэффициент охлаждения (к концу итераций температура ~3e-7)
+
+        # Ограничения короткой оптимизации после инкрементального восстановления (repair)
+        self.repair_time = 5  # секунд
+        self.repair_iterations = 20000
+
+        # Занятия, которые может переставлять оптимизация; None - все, кроме ручных.
+        # При восстановлении это только размещенные заново занятия, остальное расписание не двигается
+        self._movable_lessons = None
 
     def load_manual_items(self):
         """Загружает размещенные вручную элементы в расписание"""
-        manual_items = ScheduleItem.query.filter_by(is_manually_placed=True).all()
-        for item in manual_items:
+        for item in self.snapshot.manual_items:
             time_key = (item.week, item.day, item.time_slot)
-            if time_key not in self.schedule:
-                self.schedule[time_key] = []
-
-            group_ids = item.get_group_ids()
-            self.schedule[time_key].append({
-                'course': item.course,
-                'room': item.room,
-                'lesson_type': item.lesson_type,
-                'groups': group_ids,
-                'teacher': item.teacher,
-                'lab_subgroup': item.lab_subgroup,
-                'is_manually_placed': True
-            })
+            lab_subgroup = self.subgroups_by_id.get(item.lab_subgroup_id)
+            if lab_subgroup:
+                students = lab_subgroup.size
+            else:
+                students = sum(self.groups_by_id[gid].size for gid in item.group_ids if gid in self.groups_by_id)
+
+            self._add_lesson(time_key, Lesson(
+                course_id=item.course_id,
+                lesson_type=item.lesson_type,
+                teacher_id=item.teacher_id if item.teacher_id in self.teachers_by_id else None,
+                group_ids=item.group_ids,
+                students=students,
+                room_id=item.room_id,
+                lab_subgroup_id=lab_subgroup.id if lab_subgroup else None,
+                subgroup_group_id=lab_subgroup.group_id if lab_subgroup else None,
+                is_manually_placed=True
+            ))
+
+    def _get_course_teacher(self, course, lesson_type, lab_subgroup_id=None):
+        """Преподаватель курса для типа занятий и подгруппы (аналог Course.get_teacher_for_type)"""
+        for teacher_type, teacher_subgroup_id, teacher_id in course.teachers:
+            if teacher_type != lesson_type:
+                continue
+            if lesson_type == 'lab' and lab_subgroup_id:
+                if teacher_subgroup_id != lab_subgroup_id:
+                    continue
+            elif lesson_type == 'lab' and teacher_subgroup_id is not None:
+                continue
+            return self.teachers_by_id.get(teacher_id)
+        return None
+
+    def _reset_index(self):
+        """Создает пустой индекс занятости для быстрых проверок ограничений"""
+        self._time_keys = []  # ключи времени, присутствующие в расписании
+
+        # Занятость в конкретный слот: (id, week, day, slot) -> количество занятий
+        self._teacher_busy = defaultdict(int)
+        self._room_busy = defaultdict(int)
+        # Занятые аудитории по типам: тип -> {(week, day, slot) -> битовая маска позиций в self._room_buckets}
+        self._busy_room_masks = {bucket: defaultdict(int) for bucket in self._room_buckets}
+        self._group_busy = defaultdict(int)  # все занятия, в которых участвует группа
+        self._group_whole_busy = defaultdict(int)  # занятия группы без деления на подгруппы
+        # (group_id, id группы-владельца подгруппы, week, day, slot) -> количество занятий подгрупп
+        self._group_subgroup_busy = defaultdict(int)
+
+        # Дневная нагрузка: (id, week, day) -> количество занятий
+        self._teacher_day_load = defaultdict(int)
+        self._group_day_load = defaultdict(int)
+        # (group_id, id группы-владельца подгруппы, week, day) -> занятия подгрупп этой группы
+        self._group_owner_day_load = defaultdict(int)
+        # (group_id, subgroup_id, week, day) -> занятия конкретной подгруппы
+        self._group_subgroup_day_load = defaultdict(int)
+        # (group_id, week, day) -> {slot: количество занятий} для проверки "окон"
+        self._group_day_slots = defaultdict(lambda: defaultdict(int))
+
+        # Слагаемые оценки расписания, которые обновляются вместе с индексом
+        self._last_slot_lessons = 0  # занятия на последней паре
+        self._teacher_preferences_total = 0.0
+        self._room_usage_total = 0.0
+        self._group_windows = {}  # (group_id, week, day) -> количество "окон"
+        self._windows_total = 0
+        # group_id -> [дней с занятиями, сумма занятий, сумма квадратов] для оценки равномерности
+        self._distribution_stats = defaultdict(lambda: [0, 0, 0])
+        self._distribution_terms = {}  # group_id -> вклад группы в оценку равномерности
+        self._distribution_total = 0.0
+
+    def _index_lesson(self, time_key, lesson, delta):
+        """Учитывает занятие в индексе занятости (delta=1) или убирает его оттуда (delta=-1)"""
+        week, day, slot = time_key
+
+        teacher_id = lesson.teacher_id
+        if teacher_id is not None:
+            self._teacher_busy[(teacher_id, week, day, slot)] += delta
+            self._teacher_day_load[(teacher_id, week, day)] += delta
+
+        room_key = (lesson.room_id, week, day, slot)
+        room_busy = self._room_busy[room_key]
+        self._room_busy[room_key] = room_busy + delta
+        if not room_busy or not room_busy + delta:
+            # Аудитория стала занятой или освободилась - переключаем ее бит во всех типах
+            for bucket, bit in self._room_bits.get(lesson.room_id, ()):
+                self._busy_room_masks[bucket][time_key] ^= bit
+
+        lab_subgroup_id = lesson.lab_subgroup_id
+        for group_id in lesson.group_ids:
+            self._group_busy[(group_id, week, day, slot)] += delta
+            self._group_day_load[(group_id, week, day)] += delta
+
+            if lab_subgroup_id:
+                self._group_subgroup_busy[(group_id, lesson.subgroup_group_id, week, day, slot)] += delta
+                self._group_owner_day_load[(group_id, lesson.subgroup_group_id, week, day)] += delta
+                self._group_subgroup_day_load[(group_id, lab_subgroup_id, week, day)] += delta
+            else:
+                self._group_whole_busy[(group_id, week, day, slot)] += delta
+
+            day_slots = self._group_day_slots[(group_id, week, day)]
+            day_slots[slot] += delta
+            if not day_slots[slot]:
+                del day_slots[slot]
+
+            if group_id in self._group_ids:
+                self._update_group_scores(group_id, week, day, delta)
+
+        if slot >= self.slots_per_day - 1:
+            self._last_slot_lessons += delta
+        self._teacher_preferences_total += delta * self._lesson_teacher_preferences_score(lesson, day, slot)
+        self._room_usage_total += delta * self._lesson_room_usage_score(lesson)
+
+    def _update_group_scores(self, group_id, week, day, delta):
+        """Пересчитывает "окна" и равномерность только для затронутого дня группы"""
+        day_key = (group_id, week, day)
+
+        # "Окна" считаются только в пределах семестра
+        if 1 <= week <= self.weeks_count and 0 <= day < self.days_per_week:
+            windows = self._day_windows(self._group_day_slots[day_key])
+            self._windows_total += windows - self._group_windows.get(day_key, 0)
+            self._group_windows[day_key] = windows
+
+        # Равномерность: обновляем суммы по дням с занятиями и вклад группы
+        count = self._group_day_load[day_key]
+        previous = count - delta
+        stats = self._distribution_stats[group_id]
+        stats[0] += (count > 0) - (previous > 0)
+        stats[1] += delta
+        stats[2] += count * count - previous * previous
+
+        term = self._distribution_term(stats)
+        self._distribution_total += term - self._distribution_terms.get(group_id, 0)
+        self._distribution_terms[group_id] = term
+
+    def _day_windows(self, day_slots):
+        """Количество "окон" между занятиями одного дня"""
+        slots = [slot for slot in day_slots if slot < self.slots_per_day]
+        if len(slots) < 2:
+            return 0
+        return max(slots) - min(slots) + 1 - len(slots)
+
+    @staticmethod
+    def _distribution_term(stats):
+        """Вклад группы в оценку равномерности по числу дней, сумме и сумме квадратов нагрузки"""
+        days, total, total_squares = stats
+        if not days:
+            return 0
+        # Дисперсия в целых числах, чтобы не накапливать ошибку округления
+        variance = (days * total_squares - total * total) / (days * days)
+        std_dev = math.sqrt(variance) if variance > 0 else 0
+        return 10 / (1 + std_dev)
+
+    def _add_lesson(self, time_key, lesson):
+        """Добавляет занятие в расписание и обновляет индекс занятости"""
+        if time_key not in self.schedule:
+            self.schedule[time_key] = []
+            self._time_keys.append(time_key)
+        self.schedule[time_key].append(lesson)
+        lesson.time_key = time_key
+        self._index_lesson(time_key, lesson, 1)
+
+    def _remove_lesson(self, time_key, idx):
+        """Удаляет занятие из расписания по индексу и обновляет индекс занятости"""
+        lesson = self.schedule[time_key].pop(idx)
+        self._index_lesson(time_key, lesson, -1)
+        return lesson
 
     def generate(self):
         try:
             start_time = time.time()
             print("Начало генерации расписания...")
 
-            # Сортируем курсы по приоритету
-            prioritized_courses = sorted(self.courses,
-                                         key=lambda c: c.get_effective_priority(),
-                                         reverse=True)
+            # Между загрузкой снимка и сохранением запросов к БД быть не должно
+            with count_queries() as query_counter:
+                if self.settings.chains_count > 1:
+                    built = self._build_best_of_chains()
+                else:
+                    built = self._build_schedule(start_time)
+            self.stats['generation_queries'] = query_counter.count
 
-            # Создаем начальное расписание с учетом частоты занятий, подгрупп и приоритетов
-            if not self._create_frequency_based_schedule(prioritized_courses):
+            if not built:
                 print("Не удалось создать начальное расписание")
                 return False
 
-            print(f"Начальное расписание создано за {time.time() - start_time:.2f} сек.")
-
-            # Оптимизируем расписание с использованием симуляции отжига
-            if time.time() - start_time < self.max_generation_time:
-                print("Оптимизация расписания...")
-                self._optimize_schedule()
-
             # Сохраняем сгенерированное расписание в БД
+            self._check_cancelled()
+            self._report_progress('saving', score=self.stats['score'])
+            save_start = time.perf_counter()
             self._save_schedule()
+            self.stats['save_time'] = time.perf_counter() - save_start
+            self.stats['save_rows_per_sec'] = self.stats['saved_rows'] / max(self.stats['save_time'], 1e-9)
+            self.stats['total_time'] = time.time() - start_time
             print(f"Расписание сгенерировано и сохранено за {time.time() - start_time:.2f} сек.")
+            self._print_summary()
+            self._report_progress('done', score=self.stats['score'], lessons_failed=self.stats['unplaced'])
             return True
+        except GenerationCancelled:
+            print("Генерация расписания отменена")
+            self.stats['cancelled'] = True
+            return False
         except Exception as e:
             print(f"Ошибка при генерации расписания: {e}")
             return False
 
-    def _create_frequency_based_schedule(self, prioritized_courses):
-        """Создаем расписание, исходя из частоты проведения занятий разных типов, с учетом подгрупп и приоритетов"""
-        # Для каждого курса определяем частоту занятий, начиная с курсов с высшим приоритетом
-        for course in prioritized_courses:
-            # Получаем связанные группы
-            course_groups = course.groups
-            group_ids = [cg.group_id for cg in course_groups]
+    def repair(self):
+        """
+        Инкрементальное восстановление активной версии расписания после изменения данных.
+        Отпечатки данных, сохраненные при генерации версии, сравниваются с текущими. Занятия удаленных
+        и измененных дисциплин, а также занятия, у которых изменились преподаватель, группы или аудитория,
+        снимаются и размещаются заново через _place_lesson вокруг остальных занятий, которые не двигаются.
+        Затем короткая оптимизация переставляет только размещенные заново занятия.
+        Изменения записываются в активную версию одной транзакцией, документы расписания перестраиваются
+        только для затронутых групп, преподавателей и аудиторий.
+        Генератор для восстановления создается с keep_manual=False: ручные занятия берутся из версии
+        вместе с остальными. Если восстановление невозможно (нет сохраненных отпечатков, изменились
+        настройки), возвращает False с причиной в stats['repair_error'] - нужна полная генерация.
+        """
+        try:
+            start_time = time.time()
+            print("Инкрементальное восстановление расписания...")
+
+            settings = Settings.query.first()
+            version = ScheduleVersion.query.get(settings.active_schedule_version_id) \
+                if settings.active_schedule_version_id else None
+            if version is None or not version.input_fingerprints:
+                self.stats['repair_error'] = "Нет сведений о данных, по которым составлено расписание: " \
+                                             "нужна полная генерация"
+                print(self.stats['repair_error'])
+                return False
 
-            # Если нет групп, пропускаем курс
-            if not group_ids:
+            fingerprints = input_fingerprints(self.snapshot)
+            changes = changed_inputs(json.loads(version.input_fingerprints), fingerprints)
+            if changes['settings']:
+                self.stats['repair_error'] = "Изменились настройки расписания: нужна полная генерация"
+                print(self.stats['repair_error'])
+                return False
+
+            items = load_version_items(version.id)
+            self.stats['score'] = version.score
+            with count_queries() as query_counter:
+                removed, new_lessons = self._repair_schedule(items, changes)
+            self.stats['generation_queries'] = query_counter.count
+
+            self._check_cancelled()
+            self._report_progress('saving', score=self.stats['score'])
+            save_start = time.perf_counter()
+            self._save_repair(version, removed, new_lessons, fingerprints)
+            self.stats['save_time'] = time.perf_counter() - save_start
+            self.stats['save_rows_per_sec'] = self.stats['saved_rows'] / max(self.stats['save_time'], 1e-9)
+            self.stats['total_time'] = time.time() - start_time
+            print(f"Расписание восстановлено за {self.stats['total_time']:.2f} сек.: снято занятий - "
+                  f"{len(removed)}, размещено - {len(new_lessons)}, не удалось разместить - {self.stats['unplaced']}")
+            self._print_summary()
+            self._report_progress('done', score=self.stats['score'], lessons_failed=self.stats['unplaced'])
+            return True
+        except GenerationCancelled:
+            print("Восстановление расписания отменено")
+            self.stats['cancelled'] = True
+            return False
+        except Exception as e:
+            db.session.rollback()
+            print(f"Ошибка при восстановлении расписания: {e}")
+            return False
+
+    def _repair_schedule(self, items, changes):
+        """
+        Строит восстановленное расписание в памяти. items - занятия активной версии (PlacedItemData),
+        changes - изменившиеся данные (changed_inputs). Возвращает снятые занятия версии
+        и размещенные заново занятия генератора.
+        """
+        changed_courses = changes['courses']
+        removed = []
+        replaced = defaultdict(list)  # id дисциплины -> снятые занятия, которые размещаются заново по одному
+        kept = []
+        for item in items:
+            course = self.courses_by_id.get(item.course_id)
+            if course is None:
+                # Занятия удаленной дисциплины (в том числе ручные) просто снимаются
+                removed.append(item)
+            elif item.is_manually_placed:
+                kept.append(item)
+            elif course.id in changed_courses:
+                # Занятия измененной дисциплины планируются заново целиком
+                removed.append(item)
+            elif self._repair_inputs_changed(item, changes):
+                removed.append(item)
+                replaced[course.id].append(item)
+            else:
+                kept.append(item)
+
+        # Снятые занятия размещаются в том же порядке дисциплин, что и при полной генерации
+        courses = sorted((course for course in self.courses if course.id in changed_courses or course.id in replaced),
+                         key=lambda c: c.effective_priority, reverse=True)
+        self.stats['removed'] = len(removed)
+        self.stats['replanned_courses'] = len(courses)
+        if not removed and not courses:
+            # Изменения не затронули ни одного занятия: индекс всего расписания строить незачем
+            self.stats.update(unplaced=0, lessons=0, evaluation_time=0)
+            return removed, []
+
+        # Остальные занятия ставятся на свои места и дальше не двигаются
+        for item in kept:
+            if item.room_id not in self.rooms_by_id:
                 continue
+            lab_subgroup = self.subgroups_by_id.get(item.lab_subgroup_id)
+            if lab_subgroup:
+                students = lab_subgroup.size
+            else:
+                students = sum(self.groups_by_id[gid].size for gid in item.group_ids if gid in self.groups_by_id)
+            self._add_lesson((item.week, item.day, item.time_slot), Lesson(
+                course_id=item.course_id,
+                lesson_type=item.lesson_type,
+                teacher_id=item.teacher_id if item.teacher_id in self.teachers_by_id else None,
+                group_ids=item.group_ids,
+                students=students,
+                room_id=item.room_id,
+                lab_subgroup_id=lab_subgroup.id if lab_subgroup else None,
+                subgroup_group_id=lab_subgroup.group_id if lab_subgroup else None,
+                is_manually_placed=item.is_manually_placed
+            ))
+        kept_lessons = {id(lesson) for lessons in self.schedule.values() for lesson in lessons}
+
+        placed = 0
+        unplaced = 0
+        phase_start = time.perf_counter()
+        for courses_done, course in enumerate(courses, 1):
+            self._check_cancelled()
+            if course.id in changed_courses:
+                lessons_to_schedule = self._plan_course_lessons(course) or []
+            else:
+                lessons_to_schedule = [self._replacement_lesson(course, item) for item in replaced[course.id]]
 
-            # Получаем группы с разделением на подгруппы для лабораторных
-            groups_with_subgroups = []
-            for group_id in group_ids:
-                group = Group.query.get(group_id)
-                if group.has_lab_subgroups():
-                    groups_with_subgroups.append(group)
+            for lesson in lessons_to_schedule:
+                if lesson is not None and self._place_lesson(lesson):
+                    placed += 1
+                else:
+                    unplaced += 1
+                    print(f"  ОШИБКА: Не удалось заново разместить занятие дисциплины {course.name}")
+
+            self._report_progress('construction', courses_done=courses_done, courses_total=len(courses),
+                                  lessons_placed=placed, lessons_failed=unplaced)
+        self.stats['construction_time'] = time.perf_counter() - phase_start
+        self.stats['unplaced'] = unplaced
+
+        new_lessons = [lesson for lessons in self.schedule.values() for lesson in lessons
+                       if id(lesson) not in kept_lessons]
+        self.stats['lessons'] = len(new_lessons)
+
+        # Короткая оптимизация двигает только размещенные заново занятия
+        phase_start = time.perf_counter()
+        if len(new_lessons) > 1:
+            print("Оптимизация размещенных заново занятий...")
+            self._movable_lessons = new_lessons
+            self.max_iterations = min(self.max_iterations, self.repair_iterations)
+            self.max_generation_time = min(self.max_generation_time, self.repair_time)
+            self._optimize_schedule()
+            self._movable_lessons = None
+        self.stats['optimization_time'] = time.perf_counter() - phase_start
+
+        # Полная оценка прошла бы по всему семестру; оценка индекса с ней совпадает
+        evaluation_start = time.perf_counter()
+        self.stats['score'] = self._incremental_score()
+        self.stats['evaluation_time'] = time.perf_counter() - evaluation_start
+        return removed, new_lessons
+
+    def _repair_inputs_changed(self, item, changes):
+        """Изменились ли (или удалены) преподаватель, аудитория, группы или подгруппа занятия"""
+        if item.teacher_id not in self.teachers_by_id or item.teacher_id in changes['teachers']:
+            return True
+        if item.room_id not in self.rooms_by_id or item.room_id in changes['rooms']:
+            return True
+        if item.lab_subgroup_id and item.lab_subgroup_id not in self.subgroups_by_id:
+            return True
+        return any(group_id not in self.groups_by_id or group_id in changes['groups'] for group_id in item.group_ids)
+
+    def _replacement_lesson(self, course, item):
+        """Описание для _place_lesson, ставящее снятое занятие заново рядом с его прежней неделей"""
+        lab_subgroup = self.subgroups_by_id.get(item.lab_subgroup_id)
+        teacher = self._get_course_teacher(course, item.lesson_type, lab_subgroup.id if lab_subgroup else None)
+        if not teacher and lab_subgroup:
+            # Как и при планировании, для подгруппы без своего преподавателя берется общий
+            teacher = self._get_course_teacher(course, 'lab')
+        if not teacher:
+            return None
 
-            # Определяем доступные недели с учетом начальной недели курса
-            available_weeks = list(range(course.start_week, self.weeks_count + 1))
+        if lab_subgroup:
+            total_students = lab_subgroup.size
+        else:
+            total_students = sum(self.groups_by_id[gid].size for gid in item.group_ids)
+        return {
+            'course': course,
+            'lesson_type': item.lesson_type,
+            'teacher': teacher,
+            'group_ids': list(item.group_ids),
+            'total_students': total_students,
+            'target_week': item.week,
+            'lab_subgroup': lab_subgroup
+        }
+
+    def _build_schedule(self, start_time):
+        """Строит расписание в памяти: начальное размещение, оптимизация и итоговая оценка"""
+        # Сортируем курсы по приоритету
+        prioritized_courses = sorted(self.courses,
+                                     key=lambda c: c.effective_priority,
+                                     reverse=True)
+
+        # Создаем начальное расписание с учетом частоты занятий, подгрупп и приоритетов
+        phase_start = time.perf_counter()
+        if not self._create_frequency_based_schedule(prioritized_courses):
+            return False
+        self.stats['construction_time'] = time.perf_counter() - phase_start
+        self.stats['lessons'] = sum(len(lessons) for lessons in self.schedule.values())
+
+        print(f"Начальное расписание создано за {time.time() - start_time:.2f} сек.")
+
+        # Оптимизируем расписание с использованием симуляции отжига
+        phase_start = time.perf_counter()
+        if self._has_time_left(start_time):
+            print("Оптимизация расписания...")
+            self._optimize_schedule()
+        self.stats['optimization_time'] = time.perf_counter() - phase_start
+
+        # Итоговая полная оценка проверяет оценку, которую вела оптимизация
+        evaluation_start = time.perf_counter()
+        self.stats['score'] = self._evaluate_schedule()
+        self.stats['evaluation_time'] = time.perf_counter() - evaluation_start
+        return True
 
-            if not available_weeks:
-                print(f"Недостаточно недель для дисциплины {course.name}")
+    def _report_progress(self, phase, **fields):
+        """Передает состояние генерации в progress_callback, если он задан"""
+        if self.progress_callback is not None:
+            fields['phase'] = phase
+            self.progress_callback(fields)
+
+    def _check_cancelled(self):
+        """Прерывает генерацию, если она отменена"""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled()
+
+    def _has_time_left(self, start_time):
+        """Не исчерпан ли лимит времени; при заданном seed время не ограничивает генерацию"""
+        return self.deterministic or time.time() - start_time < self.max_generation_time
+
+    def _build_best_of_chains(self):
+        """
+        Строит расписание несколькими независимыми цепочками (размещение + отжиг) с разными seed
+        и оставляет лучшее по оценке. Цепочки выполняются в пуле процессов, каждая со своим лимитом времени.
+        """
+        chains_count = self.settings.chains_count
+        base_seed = self.settings.random_seed
+        if base_seed is None:
+            base_seed = self.rng.randrange(2 ** 31)
+        seeds = [base_seed + chain for chain in range(chains_count)]
+
+        workers = min(self.settings.parallel_workers or os.cpu_count() or 1, chains_count)
+        print(f"Запуск {chains_count} цепочек генерации (процессов: {workers}), seed: {seeds[0]}..{seeds[-1]}")
+
+        results = []
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            try:
+                futures = [executor.submit(_run_chain, self.snapshot, seed, self.max_generation_time)
+                           for seed in seeds]
+                for future in as_completed(futures):
+                    results.append(future.result())
+                    self._report_progress('chains', chains_done=len(results), chains_total=chains_count)
+                    self._check_cancelled()
+            finally:
+                # При отмене не ждем оставшиеся цепочки
+                executor.shutdown(wait=False, cancel_futures=True)
+            results.sort(key=lambda result: result[0])
+        else:
+            for seed in seeds:
+                self._check_cancelled()
+                results.append(_run_chain(self.snapshot, seed, self.max_generation_time))
+                self._report_progress('chains', chains_done=len(results), chains_total=chains_count)
+
+        chains = []
+        best = None
+        for seed, built, schedule, stats in results:
+            if not built:
+                print(f"  Цепочка seed={seed}: не удалось создать расписание")
                 continue
+            chains.append({'seed': seed, 'score': stats['score'], 'unplaced': stats['unplaced'],
+                           'iterations': stats.get('iterations', 0)})
+            print(f"  Цепочка seed={seed}: оценка {stats['score']:.2f}, не размещено занятий: {stats['unplaced']}, "
+                  f"итераций: {stats.get('iterations', 0)}")
+            if best is None or stats['score'] > best[2]['score']:
+                best = (seed, schedule, stats)
+
+        if best is None:
+            return False
 
-            # Общее количество доступных недель
-            total_weeks = len(available_weeks)
+        seed, schedule, stats = best
+        scores = [chain['score'] for chain in chains]
+        print(f"Лучшая цепочка seed={seed}: оценка {stats['score']:.2f} "
+              f"(разброс оценок {min(scores):.2f}..{max(scores):.2f})")
 
-            print(f"Курс: {course.name}, начинается с недели {course.start_week}, доступно {total_weeks} недель")
-            print(f"Приоритет: {course.priority}, эффективный приоритет: {course.get_effective_priority():.2f}")
+        # Берем расписание лучшей цепочки вместо собственного
+        self._reset_index()
+        self.schedule = {}
+        for time_key, lessons in schedule.items():
+            for lesson in lessons:
+                self._add_lesson(time_key, lesson)
 
-            # Рассчитываем занятия для расписания
-            lessons_to_schedule = []
+        stats.pop('load_queries', None)
+        self.stats.update(stats)
+        self.stats['seed'] = seed
+        self.stats['chains'] = chains
+        return True
 
-            # Обрабатываем лекции
-            if course.lecture_count > 0:
-                lecture_teacher = course.get_teacher_for_type('lecture')
-                if not lecture_teacher:
-                    print(f"  ОШИБКА: Преподаватель для лекций не назначен для курса {course.name}")
-                    continue
+    def _print_summary(self):
+        """Выводит сводку по ресурсам, потраченным на генерацию"""
+        self.stats['peak_rss_mb'] = get_peak_rss_mb()
+        if self.stats['peak_rss_mb'] is not None:
+            print(f"Пиковое потребление памяти: {self.stats['peak_rss_mb']:.1f} МБ")
+        print(f"Итоговая оценка расписания: {self.stats['score']} "
+              f"({self.evaluation_backend}, {self.stats['evaluation_time'] * 1000:.1f} мс)")
+        print(f"SQL-запросов: загрузка данных - {self.stats['load_queries']}, "
+              f"генерация - {self.stats.get('generation_queries', 0)}")
+        if 'saved_rows' in self.stats:
+            print(f"Записано занятий: {self.stats['saved_rows']} за {self.stats['save_time'] * 1000:.1f} мс "
+                  f"({self.stats['save_rows_per_sec']:.0f} строк/с)")
+        if 'timetable_documents' in self.stats:
+            print(f"Документов расписания: {self.stats['timetable_documents']}, "
+                  f"построены за {self.stats['timetable_time'] * 1000:.1f} мс")
+        if 'snapshots' in self.stats:
+            print(f"Снимков лучшего решения: {self.stats['snapshots']}, "
+                  f"затрачено {self.stats['snapshot_time'] * 1000:.1f} мс")
 
-                # Рассчитываем частоту
-                frequency = total_weeks / course.lecture_count
-                print(f"  Лекции: {course.lecture_count} шт., частота: одна лекция каждые {frequency:.2f} недели")
+    def _create_frequency_based_schedule(self, prioritized_courses):
+        """Создаем расписание, исходя из частоты проведения занятий разных типов, с учетом подгрупп и приоритетов"""
+        placed = 0
+        unplaced = 0  # занятия, для которых не нашлось места
 
-                # Генерируем недели для лекций с учетом частоты
-                weeks = self._generate_weeks_with_frequency(
-                    course, 'lecture', frequency, available_weeks)
+        # Для каждого курса определяем частоту занятий, начиная с курсов с высшим приоритетом
+        for courses_done, course in enumerate(prioritized_courses, 1):
+            self._check_cancelled()
 
-                # Добавляем лекции в список занятий
-                total_students = sum([Group.query.get(gid).size for gid in group_ids])
-                for week in weeks:
-                    lessons_to_schedule.append({
-                        'course': course,
-                        'lesson_type': 'lecture',
-                        'teacher': lecture_teacher,
-                        'group_ids': group_ids,
-                        'total_students': total_students,
-                        'target_week': week,
-                        'lab_subgroup': None  # Лекции не делятся на подгруппы
-                    })
+            lessons_to_schedule = self._plan_course_lessons(course)
+            if lessons_to_schedule is None:
+                continue
 
-            # Обрабатываем практики
-            if course.practice_count > 0:
-                practice_teacher = course.get_teacher_for_type('practice')
-                if not practice_teacher:
-                    print(f"  ОШИБКА: Преподаватель для практик не назначен для курса {course.name}")
-                    continue
+            # Размещаем все занятия курса
+            for lesson in lessons_to_schedule:
+                if self._place_lesson(lesson):
+                    placed += 1
+                else:
+                    unplaced += 1
+                    subgroup_info = f" ({lesson['lab_subgroup'].name})" if lesson['lab_subgroup'] else ""
+                    print(
+                        f"  ОШИБКА: Не удалось разместить занятие {course.name} {lesson['lesson_type']}{subgroup_info} на неделе {lesson['target_week']}")
+
+            self._report_progress('construction', courses_done=courses_done, courses_total=len(prioritized_courses),
+                                  lessons_placed=placed, lessons_failed=unplaced)
+
+        self.stats['unplaced'] = unplaced
+
+        # Анализируем распределение
+        self._analyze_distribution()
+
+        return True
 
-                # Рассчитываем частоту
-                frequency = total_weeks / course.practice_count
-                print(f"  Практики: {course.practice_count} шт., частота: одна практика каждые {frequency:.2f} недели")
+    def _plan_course_lessons(self, course):
+        """
+        Занятия дисциплины, которые нужно разместить: описания для _place_lesson с целевыми неделями
+        по частоте занятий. None, если дисциплину разместить нельзя (нет групп, недель или преподавателя).
+        """
+        # Получаем связанные группы
+        group_ids = list(course.group_ids)
 
-                # Генерируем недели для практик с учетом частоты
-                weeks = self._generate_weeks_with_frequency(
-                    course, 'practice', frequency, available_weeks)
+        # Если нет групп, пропускаем курс
+        if not group_ids:
+            return None
 
-                # Добавляем практики в список занятий
-                total_students = sum([Group.query.get(gid).size for gid in group_ids])
+        # Получаем группы с разделением на подгруппы для лабораторных
+        groups_with_subgroups = []
+        for group_id in group_ids:
+            group = self.groups_by_id[group_id]
+            if group.lab_subgroups_count > 1:
+                groups_with_subgroups.append(group)
+
+        # Определяем доступные недели с учетом начальной недели курса
+        available_weeks = list(range(course.start_week, self.weeks_count + 1))
+
+        if not available_weeks:
+            print(f"Недостаточно недель для дисциплины {course.name}")
+            return None
+
+        # Общее количество доступных недель
+        total_weeks = len(available_weeks)
+
+        print(f"Курс: {course.name}, начинается с недели {course.start_week}, доступно {total_weeks} недель")
+        print(f"Приоритет: {course.priority}, эффективный приоритет: {course.effective_priority:.2f}")
+
+        # Рассчитываем занятия для расписания
+        lessons_to_schedule = []
+
+        # Обрабатываем лекции
+        if course.lecture_count > 0:
+            lecture_teacher = self._get_course_teacher(course, 'lecture')
+            if not lecture_teacher:
+                print(f"  ОШИБКА: Преподаватель для лекций не назначен для курса {course.name}")
+                return None
+
+            # Рассчитываем частоту
+            frequency = total_weeks / course.lecture_count
+            print(f"  Лекции: {course.lecture_count} шт., частота: одна лекция каждые {frequency:.2f} недели")
+
+            # Генерируем недели для лекций с учетом частоты
+            weeks = self._generate_weeks_with_frequency(
+                course, 'lecture', frequency, available_weeks)
+
+            # Добавляем лекции в список занятий
+            total_students = sum([self.groups_by_id[gid].size for gid in group_ids])
+            for week in weeks:
+                lessons_to_schedule.append({
+                    'course': course,
+                    'lesson_type': 'lecture',
+                    'teacher': lecture_teacher,
+                    'group_ids': group_ids,
+                    'total_students': total_students,
+                    'target_week': week,
+                    'lab_subgroup': None  # Лекции не делятся на подгруппы
+                })
+
+        # Обрабатываем практики
+        if course.practice_count > 0:
+            practice_teacher = self._get_course_teacher(course, 'practice')
+            if not practice_teacher:
+                print(f"  ОШИБКА: Преподаватель для практик не назначен для курса {course.name}")
+                return None
+
+            # Рассчитываем частоту
+            frequency = total_weeks / course.practice_count
+            print(f"  Практики: {course.practice_count} шт., частота: одна практика каждые {frequency:.2f} недели")
+
+            # Генерируем недели для практик с учетом частоты
+            weeks = self._generate_weeks_with_frequency(
+                course, 'practice', frequency, available_weeks)
+
+            # Добавляем практики в список занятий
+            total_students = sum([self.groups_by_id[gid].size for gid in group_ids])
+            for week in weeks:
+                lessons_to_schedule.append({
+                    'course': course,
+                    'lesson_type': 'practice',
+                    'teacher': practice_teacher,
+                    'group_ids': group_ids,
+                    'total_students': total_students,
+                    'target_week': week,
+                    'lab_subgroup': None  # Практики не делятся на подгруппы
+                })
+
+        # Обрабатываем лабораторные
+        if course.lab_count > 0:
+            # Генерируем недели для лабораторных
+            frequency = total_weeks / course.lab_count
+            print(f"  Лабораторные: {course.lab_count} шт., частота: одна лаба каждые {frequency:.2f} недели")
+            weeks = self._generate_weeks_with_frequency(
+                course, 'lab', frequency, available_weeks)
+
+            # Если есть группы с подгруппами, создаем отдельные занятия для каждой подгруппы
+            if groups_with_subgroups:
+                for week in weeks:
+                    # Для каждой группы с подгруппами
+                    for group in groups_with_subgroups:
+                        # Получаем подгруппы и их преподавателей
+                        for subgroup_id in group.subgroup_ids:
+                            subgroup = self.subgroups_by_id[subgroup_id]
+                            # Ищем преподавателя для этой подгруппы
+                            lab_teacher = self._get_course_teacher(course, 'lab', subgroup.id)
+                            if not lab_teacher:
+                                # Если нет специального преподавателя, используем общего
+                                lab_teacher = self._get_course_teacher(course, 'lab')
+
+                            if not lab_teacher:
+                                print(
+                                    f"  ОШИБКА: Преподаватель для лабораторных не назначен для курса {course.name} и подгруппы {subgroup.name}")
+                                continue
+
+                            # Добавляем занятие для этой подгруппы
+                            lessons_to_schedule.append({
+                                'course': course,
+                                'lesson_type': 'lab',
+                                'teacher': lab_teacher,
+                                'group_ids': [group.id],  # Только для этой группы
+                                'total_students': subgroup.size,  # Размер подгруппы
+                                'target_week': week,
+                                'lab_subgroup': subgroup  # Указываем подгруппу
+                            })
+
+            # Для остальных групп без подгрупп
+            groups_without_subgroups = [self.groups_by_id[gid] for gid in group_ids
+                                        if self.groups_by_id[gid] not in groups_with_subgroups]
+
+            if groups_without_subgroups:
+                # Находим преподавателя для обычных лабораторных
+                lab_teacher = self._get_course_teacher(course, 'lab')
+                if not lab_teacher:
+                    print(f"  ОШИБКА: Преподаватель для лабораторных не назначен для курса {course.name}")
+                    return None
+
+                # Добавляем обычные лабораторные для групп без подгрупп
                 for week in weeks:
+                    group_ids_without_subgroups = [g.id for g in groups_without_subgroups]
+                    total_students = sum([g.size for g in groups_without_subgroups])
+
                     lessons_to_schedule.append({
                         'course': course,
-                        'lesson_type': 'practice',
-                        'teacher': practice_teacher,
-                        'group_ids': group_ids,
+                        'lesson_type': 'lab',
+                        'teacher': lab_teacher,
+                        'group_ids': group_ids_without_subgroups,
                         'total_students': total_students,
                         'target_week': week,
-                        'lab_subgroup': None  # Практики не делятся на подгруппы
+                        'lab_subgroup': None  # Нет подгруппы
                     })
 
-            # Обрабатываем лабораторные
-            if course.lab_count > 0:
-                # Генерируем недели для лабораторных
-                frequency = total_weeks / course.lab_count
-                print(f"  Лабораторные: {course.lab_count} шт., частота: одна лаба каждые {frequency:.2f} недели")
-                weeks = self._generate_weeks_with_frequency(
-                    course, 'lab', frequency, available_weeks)
-
-                # Если есть группы с подгруппами, создаем отдельные занятия для каждой подгруппы
-                if groups_with_subgroups:
-                    for week in weeks:
-                        # Для каждой группы с подгруппами
-                        for group in groups_with_subgroups:
-                            # Получаем подгруппы и их преподавателей
-                            for subgroup in group.lab_subgroups:
-                                # Ищем преподавателя для этой подгруппы
-                                lab_teacher = None
-                                course_teacher = next((ct for ct in course.course_teachers
-                                                      if ct.lesson_type == 'lab' and ct.lab_subgroup_id == subgroup.id), None)
-
-                                if course_teacher:
-                                    lab_teacher = course_teacher.teacher
-                                else:
-                                    # Если нет специального преподавателя, используем общего
-                                    lab_teacher = course.get_teacher_for_type('lab')
-
-                                if not lab_teacher:
-                                    print(
-                                        f"  ОШИБКА: Преподаватель для лабораторных не назначен для курса {course.name} и подгруппы {subgroup.name}")
-                                    continue
-
-                                # Добавляем занятие для этой подгруппы
-                                lessons_to_schedule.append({
-                                    'course': course,
-                                    'lesson_type': 'lab',
-                                    'teacher': lab_teacher,
-                                    'group_ids': [group.id],  # Только для этой группы
-                                    'total_students': subgroup.size,  # Размер подгруппы
-                                    'target_week': week,
-                                    'lab_subgroup': subgroup  # Указываем подгруппу
-                                })
-
-                # Для остальных групп без подгрупп
-                groups_without_subgroups = [Group.query.get(gid) for gid in group_ids
-                                            if Group.query.get(gid) not in groups_with_subgroups]
-
-                if groups_without_subgroups:
-                    # Находим преподавателя для обычных лабораторных
-                    lab_teacher = course.get_teacher_for_type('lab')
-                    if not lab_teacher:
-                        print(f"  ОШИБКА: Преподаватель для лабораторных не назначен для курса {course.name}")
-                        continue
-
-                    # Добавляем обычные лабораторные для групп без подгрупп
-                    for week in weeks:
-                        group_ids_without_subgroups = [g.id for g in groups_without_subgroups]
-                        total_students = sum([g.size for g in groups_without_subgroups])
-
-                        lessons_to_schedule.append({
-                            'course': course,
-                            'lesson_type': 'lab',
-                            'teacher': lab_teacher,
-                            'group_ids': group_ids_without_subgroups,
-                            'total_students': total_students,
-                            'target_week': week,
-                            'lab_subgroup': None  # Нет подгруппы
-                        })
-
-            # Выводим информацию о запланированных занятиях
-            lectures = [l for l in lessons_to_schedule if l['lesson_type'] == 'lecture']
-            practices = [l for l in lessons_to_schedule if l['lesson_type'] == 'practice']
-            labs = [l for l in lessons_to_schedule if l['lesson_type'] == 'lab']
-
-            if lectures:
-                print(f"  Недели лекций: {sorted([l['target_week'] for l in lectures])}")
-            if practices:
-                print(f"  Недели практик: {sorted([l['target_week'] for l in practices])}")
-            if labs:
-                for lab in labs:
-                    subgroup_info = f" ({lab['lab_subgroup'].name})" if lab['lab_subgroup'] else ""
-                    group_ids = lab['group_ids']
-                    print(f"  Лабораторная на неделе {lab['target_week']}{subgroup_info} для групп: {group_ids}")
-
-            # Размещаем все занятия курса
-            for lesson in lessons_to_schedule:
-                if not self._place_lesson(lesson):
-                    subgroup_info = f" ({lesson['lab_subgroup'].name})" if lesson['lab_subgroup'] else ""
-                    print(
-                        f"  ОШИБКА: Не удалось разместить занятие {course.name} {lesson['lesson_type']}{subgroup_info} на неделе {lesson['target_week']}")
+        # Выводим информацию о запланированных занятиях
+        lectures = [l for l in lessons_to_schedule if l['lesson_type'] == 'lecture']
+        practices = [l for l in lessons_to_schedule if l['lesson_type'] == 'practice']
+        labs = [l for l in lessons_to_schedule if l['lesson_type'] == 'lab']
 
-        # Анализируем распределение
-        self._analyze_distribution()
+        if lectures:
+            print(f"  Недели лекций: {sorted([l['target_week'] for l in lectures])}")
+        if practices:
+            print(f"  Недели практик: {sorted([l['target_week'] for l in practices])}")
+        if labs:
+            for lab in labs:
+                subgroup_info = f" ({lab['lab_subgroup'].name})" if lab['lab_subgroup'] else ""
+                group_ids = lab['group_ids']
+                print(f"  Лабораторная на неделе {lab['target_week']}{subgroup_info} для групп: {group_ids}")
 
-        return True
+        return lessons_to_schedule
 
     def _generate_weeks_with_frequency(self, course, lesson_type, frequency, available_weeks):
         """Генерирует список недель для занятий с учетом их частоты"""
@@ -374,18 +977,8 @@ class ScheduleGenerator:
             for slot in time_slots:
                 time_key = (target_week, day, slot)
                 if self._check_constraints(time_key, course, group_ids, suitable_rooms, teacher, lab_subgroup):
-                    room = self._select_best_room(course, suitable_rooms, total_students)
-                    if time_key not in self.schedule:
-                        self.schedule[time_key] = []
-                    self.schedule[time_key].append({
-                        'course': course,
-                        'room': room,
-                        'lesson_type': lesson_type,
-                        'groups': group_ids,
-                        'teacher': teacher,
-                        'lab_subgroup': lab_subgroup,
-                        'is_manually_placed': False
-                    })
+                    room = self._select_best_room(time_key, suitable_rooms)
+                    self._add_lesson(time_key, self._new_lesson(lesson, room))
                     return True
 
         # Если не смогли разместить в текущую неделю, пробуем в ближайшие
@@ -397,18 +990,8 @@ class ScheduleGenerator:
                     for slot in time_slots:
                         time_key = (earlier_week, day, slot)
                         if self._check_constraints(time_key, course, group_ids, suitable_rooms, teacher, lab_subgroup):
-                            room = self._select_best_room(course, suitable_rooms, total_students)
-                            if time_key not in self.schedule:
-                                self.schedule[time_key] = []
-                            self.schedule[time_key].append({
-                                'course': course,
-                                'room': room,
-                                'lesson_type': lesson_type,
-                                'groups': group_ids,
-                                'teacher': teacher,
-                                'lab_subgroup': lab_subgroup,
-                                'is_manually_placed': False
-                            })
+                            room = self._select_best_room(time_key, suitable_rooms)
+                            self._add_lesson(time_key, self._new_lesson(lesson, room))
                             return True
 
             # Пробуем неделю позже
@@ -418,30 +1001,35 @@ class ScheduleGenerator:
                     for slot in time_slots:
                         time_key = (later_week, day, slot)
                         if self._check_constraints(time_key, course, group_ids, suitable_rooms, teacher, lab_subgroup):
-                            room = self._select_best_room(course, suitable_rooms, total_students)
-                            if time_key not in self.schedule:
-                                self.schedule[time_key] = []
-                            self.schedule[time_key].append({
-                                'course': course,
-                                'room': room,
-                                'lesson_type': lesson_type,
-                                'groups': group_ids,
-                                'teacher': teacher,
-                                'lab_subgroup': lab_subgroup,
-                                'is_manually_placed': False
-                            })
+                            room = self._select_best_room(time_key, suitable_rooms)
+                            self._add_lesson(time_key, self._new_lesson(lesson, room))
                             return True
 
         # Не смогли разместить занятие
         return False
 
+    @staticmethod
+    def _new_lesson(lesson, room):
+        """Создает занятие расписания по описанию из _create_frequency_based_schedule"""
+        lab_subgroup = lesson.get('lab_subgroup')
+        return Lesson(
+            course_id=lesson['course'].id,
+            lesson_type=lesson['lesson_type'],
+            teacher_id=lesson['teacher'].id,
+            group_ids=lesson['group_ids'],
+            students=lesson['total_students'],
+            room_id=room.id,
+            lab_subgroup_id=lab_subgroup.id if lab_subgroup else None,
+            subgroup_group_id=lab_subgroup.group_id if lab_subgroup else None
+        )
+
     def _get_prioritized_days(self, teacher):
         """Возвращает список дней, отсортированный по предпочтениям преподавателя"""
         all_days = list(range(self.days_per_week))
 
         # Если нужно учитывать предпочтения преподавателя
         if self.settings.respect_teacher_preferences and teacher:
-            preferred_days = teacher.get_preferred_days_list()
+            preferred_days = teacher.preferred_days
             if preferred_days:
                 # Сначала предпочитаемые дни, затем остальные
                 return sorted(all_days, key=lambda d: d not in preferred_days)
@@ -459,14 +1047,14 @@ class ScheduleGenerator:
         # Получаем предпочтения преподавателя
         teacher_preferred_slots = []
         if self.settings.respect_teacher_preferences and teacher:
-            teacher_preferred_slots = teacher.get_preferred_time_slots_list()
+            teacher_preferred_slots = teacher.preferred_time_slots
 
         # Получаем предпочтения групп
         groups_preferred_slots = []
         for group_id in group_ids:
-            group = Group.query.get(group_id)
+            group = self.groups_by_id.get(group_id)
             if group:
-                groups_preferred_slots.extend(group.get_preferred_time_slots_list())
+                groups_preferred_slots.extend(group.preferred_time_slots)
 
         # Нормализуем предпочтения групп, считая самыми предпочтительными те слоты,
         # которые выбраны большинством групп
@@ -505,17 +1093,22 @@ class ScheduleGenerator:
         """Оптимизирует расписание с использованием симуляции отжига"""
         iterations = 0
         start_time = time.time()
-        current_score = self._evaluate_schedule()
+        current_score = self._incremental_score()
         best_score = current_score
-        best_schedule = copy.deepcopy(self.schedule)
+        # Исходное расписание и есть первое лучшее решение: журнал изменений пуст
+        self._best_assignment = {}
+        self._moved_since_snapshot = {}
+        snapshots = 0
+        snapshot_time = 0
         temperature = self.temperature
 
         print(f"Начальная оценка расписания: {current_score}")
 
-        while iterations < self.max_iterations and time.time() - start_time < self.max_generation_time:
+        while iterations < self.max_iterations and self._has_time_left(start_time):
             # Пытаемся произвести случайную перестановку
             if self._make_random_swap():
-                new_score = self._evaluate_schedule()
+                # Индекс уже учел перестановку, пересчитаны только затронутые слагаемые
+                new_score = self._incremental_score()
 
                 # Решаем, принимать ли новое расписание
                 if new_score > current_score:
@@ -523,13 +1116,16 @@ class ScheduleGenerator:
                     current_score = new_score
                     if new_score > best_score:
                         best_score = new_score
-                        best_schedule = copy.deepcopy(self.schedule)
+                        snapshot_start = time.perf_counter()
+                        self._snapshot_best()
+                        snapshot_time += time.perf_counter() - snapshot_start
+                        snapshots += 1
                         print(f"Найдено лучшее расписание с оценкой: {best_score}")
                 else:
                     # Если хуже, принимаем с вероятностью, зависящей от температуры
                     delta = new_score - current_score
                     acceptance_probability = math.exp(delta / temperature)
-                    if random.random() < acceptance_probability:
+                    if self.rng.random() < acceptance_probability:
                         current_score = new_score
                     else:
                         # Отменяем перестановку
@@ -540,35 +1136,81 @@ class ScheduleGenerator:
             iterations += 1
 
             # Периодически выводим информацию
-            if iterations % 100 == 0:
+            if iterations % 10000 == 0:
                 print(f"Итерация {iterations}, текущая оценка: {current_score}, лучшая оценка: {best_score}")
+            if iterations % 1000 == 0:
+                self._check_cancelled()
+                self._report_progress('optimization', iteration=iterations, max_iterations=self.max_iterations,
+                                      current_score=current_score, best_score=best_score)
 
         # Восстанавливаем лучшее найденное расписание
-        self.schedule = best_schedule
+        self._restore_best()
+        self.stats['iterations'] = iterations
+        self.stats['snapshots'] = snapshots
+        self.stats['snapshot_time'] = snapshot_time
         print(f"Оптимизация завершена после {iterations} итераций. Финальная оценка: {best_score}")
 
+    def _track_move(self, lesson):
+        """Отмечает занятие как перемещенное после последнего снимка лучшего решения"""
+        key = id(lesson)
+        if key not in self._best_assignment:
+            # Занятие двигается впервые: его текущее положение совпадает с лучшим решением
+            self._best_assignment[key] = (lesson.time_key, lesson.room_id)
+        self._moved_since_snapshot[key] = lesson
+
+    def _snapshot_best(self):
+        """Запоминает текущее расписание как лучшее, копируя только перемещенные занятия"""
+        for key, lesson in self._moved_since_snapshot.items():
+            self._best_assignment[key] = (lesson.time_key, lesson.room_id)
+        self._moved_since_snapshot.clear()
+
+    def _restore_best(self):
+        """Возвращает на места из лучшего решения занятия, перемещенные после последнего снимка"""
+        moved = list(self._moved_since_snapshot.values())
+        for lesson in moved:
+            lessons = self.schedule[lesson.time_key]
+            idx = next(i for i, item in enumerate(lessons) if item is lesson)
+            self._remove_lesson(lesson.time_key, idx)
+
+        for lesson in moved:
+            time_key, room_id = self._best_assignment[id(lesson)]
+            lesson.room_id = room_id
+            self._add_lesson(time_key, lesson)
+
+        self._moved_since_snapshot.clear()
+
     def _make_random_swap(self):
         """Производит случайную перестановку в расписании"""
-        # Сохраняем предыдущее состояние для возможной отмены
-        self._previous_schedule = copy.deepcopy(self.schedule)
+        self._last_swap = None
 
-        # Получаем все ключи времени, где есть занятия
-        time_keys = list(self.schedule.keys())
-        if len(time_keys) < 2:
-            return False
+        if self._movable_lessons is not None:
+            # Выбираем два случайных занятия из тех, которые можно двигать
+            if len(self._movable_lessons) < 2:
+                return False
+            lesson1, lesson2 = self.rng.sample(self._movable_lessons, 2)
+            key1, key2 = lesson1.time_key, lesson2.time_key
+            if key1 == key2:
+                return False
+            idx1 = next(i for i, item in enumerate(self.schedule[key1]) if item is lesson1)
+            idx2 = next(i for i, item in enumerate(self.schedule[key2]) if item is lesson2)
+        else:
+            # Получаем все ключи времени, где есть занятия
+            time_keys = self._time_keys
+            if len(time_keys) < 2:
+                return False
 
-        # Выбираем два случайных ключа времени
-        key1, key2 = random.sample(time_keys, 2)
+            # Выбираем два случайных ключа времени
+            key1, key2 = self.rng.sample(time_keys, 2)
 
-        # Выбираем случайные занятия в этих временных слотах
-        if not self.schedule[key1] or not self.schedule[key2]:
-            return False
+            # Выбираем случайные занятия в этих временных слотах
+            if not self.schedule[key1] or not self.schedule[key2]:
+                return False
 
-        idx1 = random.randrange(len(self.schedule[key1]))
-        idx2 = random.randrange(len(self.schedule[key2]))
+            idx1 = self.rng.randrange(len(self.schedule[key1]))
+            idx2 = self.rng.randrange(len(self.schedule[key2]))
 
         # Проверяем, не являются ли занятия ручными (их не трогаем)
-        if self.schedule[key1][idx1].get('is_manually_placed') or self.schedule[key2][idx2].get('is_manually_placed'):
+        if self.schedule[key1][idx1].is_manually_placed or self.schedule[key2][idx2].is_manually_placed:
             return False
 
         # Запоминаем занятия
@@ -576,45 +1218,86 @@ class ScheduleGenerator:
         lesson2 = self.schedule[key2][idx2]
 
         # Удаляем занятия из расписания
-        self.schedule[key1].pop(idx1)
-        self.schedule[key2].pop(idx2)
+        self._remove_lesson(key1, idx1)
+        self._remove_lesson(key2, idx2)
+        room1 = lesson1.room_id
+        room2 = lesson2.room_id
+        course1 = self.courses_by_id[lesson1.course_id]
+        course2 = self.courses_by_id[lesson2.course_id]
 
         # Проверяем ограничения для перемещения
-        suitable_rooms1 = self._find_suitable_rooms(lesson2['course'], lesson2['lesson_type'],
-                                                    sum([Group.query.get(gid).size for gid in lesson2['groups']]))
-        suitable_rooms2 = self._find_suitable_rooms(lesson1['course'], lesson1['lesson_type'],
-                                                    sum([Group.query.get(gid).size for gid in lesson1['groups']]))
+        suitable_rooms1 = self._find_suitable_rooms(course2, lesson2.lesson_type, lesson2.students)
+        suitable_rooms2 = self._find_suitable_rooms(course1, lesson1.lesson_type, lesson1.students)
 
         can_swap = (suitable_rooms1 and suitable_rooms2 and
-                    self._check_constraints(key1, lesson2['course'], lesson2['groups'],
-                                            suitable_rooms1, lesson2['teacher'], lesson2.get('lab_subgroup')) and
-                    self._check_constraints(key2, lesson1['course'], lesson1['groups'],
-                                            suitable_rooms2, lesson1['teacher'], lesson1.get('lab_subgroup')))
+                    self._check_constraints(key1, course2, lesson2.group_ids, suitable_rooms1,
+                                            self.teachers_by_id[lesson2.teacher_id],
+                                            self.subgroups_by_id.get(lesson2.lab_subgroup_id)) and
+                    self._check_constraints(key2, course1, lesson1.group_ids, suitable_rooms2,
+                                            self.teachers_by_id[lesson1.teacher_id],
+                                            self.subgroups_by_id.get(lesson1.lab_subgroup_id)))
 
         if can_swap:
+            self._track_move(lesson1)
+            self._track_move(lesson2)
+
             # Если можем поменять, выбираем подходящие аудитории
-            lesson2['room'] = self._select_best_room(lesson2['course'], suitable_rooms1,
-                                                     sum([Group.query.get(gid).size for gid in lesson2['groups']]))
-            lesson1['room'] = self._select_best_room(lesson1['course'], suitable_rooms2,
-                                                     sum([Group.query.get(gid).size for gid in lesson1['groups']]))
+            lesson2.room_id = self._select_best_room(key1, suitable_rooms1).id
+            lesson1.room_id = self._select_best_room(key2, suitable_rooms2).id
 
             # Добавляем занятия в новые места
-            self.schedule[key1].append(lesson2)
-            self.schedule[key2].append(lesson1)
+            self._add_lesson(key1, lesson2)
+            self._add_lesson(key2, lesson1)
+
+            # Запоминаем перестановку для возможной отмены: занятия, их исходные ключи и аудитории
+            self._last_swap = (key1, lesson1, room1, key2, lesson2, room2)
             return True
         else:
             # Если не можем поменять, возвращаем занятия на место
-            self.schedule[key1].append(lesson1)
-            self.schedule[key2].append(lesson2)
+            self._add_lesson(key1, lesson1)
+            self._add_lesson(key2, lesson2)
             return False
 
     def _undo_last_swap(self):
-        """Отменяет последнюю перестановку, восстанавливая предыдущее состояние"""
-        if hasattr(self, '_previous_schedule'):
-            self.schedule = self._previous_schedule
+        """Отменяет последнюю перестановку по журналу, возвращая оба занятия на исходные места"""
+        if self._last_swap is None:
+            return
+
+        key1, lesson1, room1, key2, lesson2, room2 = self._last_swap
+        self._last_swap = None
+
+        # После перестановки занятия добавлены в конец списков своих новых слотов
+        self._remove_lesson(key1, len(self.schedule[key1]) - 1)
+        self._remove_lesson(key2, len(self.schedule[key2]) - 1)
+
+        lesson1.room_id = room1
+        lesson2.room_id = room2
+        self._add_lesson(key1, lesson1)
+        self._add_lesson(key2, lesson2)
+
+    def _incremental_score(self):
+        """Оценка расписания из слагаемых, поддерживаемых индексом; совпадает с _evaluate_schedule"""
+        score = 100
+        score -= self._last_slot_lessons * 0.5
+
+        if self.settings.avoid_windows:
+            score -= self._windows_total * 2
+
+        if self.settings.respect_teacher_preferences:
+            score += self._teacher_preferences_total
+
+        score += self._distribution_total
+
+        if self.settings.optimize_room_usage:
+            score += self._room_usage_total
+
+        return score
 
     def _evaluate_schedule(self):
         """Оценивает качество расписания по нескольким критериям"""
+        if self.evaluation_backend == 'numpy':
+            return tensor_eval.evaluate_schedule(self)
+
         score = 100  # Начальная оценка
 
         # Критерии оценки:
@@ -663,7 +1346,7 @@ class ScheduleGenerator:
                         time_key = (week, day, slot)
                         if time_key in self.schedule:
                             for lesson in self.schedule[time_key]:
-                                if group.id in lesson['groups']:
+                                if group.id in lesson.group_ids:
                                     day_slots.append(slot)
 
                     # Проверяем на окна (пропуски между занятиями)
@@ -686,18 +1369,25 @@ class ScheduleGenerator:
         for time_key, lessons in self.schedule.items():
             week, day, slot = time_key
             for lesson in lessons:
-                teacher = lesson['teacher']
-                if teacher:
-                    preferred_days = teacher.get_preferred_days_list()
-                    preferred_slots = teacher.get_preferred_time_slots_list()
+                score += self._lesson_teacher_preferences_score(lesson, day, slot)
 
-                    # Проверяем день
-                    if preferred_days and day in preferred_days:
-                        score += 0.5
+        return score
+
+    def _lesson_teacher_preferences_score(self, lesson, day, slot):
+        """Оценка соответствия одного занятия предпочтениям преподавателя"""
+        score = 0
+        teacher = self.teachers_by_id.get(lesson.teacher_id)
+        if teacher:
+            preferred_days = teacher.preferred_days
+            preferred_slots = teacher.preferred_time_slots
 
-                    # Проверяем временной слот
-                    if preferred_slots and slot in preferred_slots:
-                        score += 0.5
+            # Проверяем день
+            if preferred_days and day in preferred_days:
+                score += 0.5
+
+            # Проверяем временной слот
+            if preferred_slots and slot in preferred_slots:
+                score += 0.5
 
         return score
 
@@ -713,7 +1403,7 @@ class ScheduleGenerator:
             for time_key, lessons in self.schedule.items():
                 week, day, slot = time_key
                 for lesson in lessons:
-                    if group.id in lesson['groups']:
+                    if group.id in lesson.group_ids:
                         day_counts[(week, day)] += 1
 
             # Оцениваем равномерность распределения
@@ -736,25 +1426,27 @@ class ScheduleGenerator:
         # Для каждого занятия оцениваем соответствие размера аудитории количеству студентов
         for time_key, lessons in self.schedule.items():
             for lesson in lessons:
-                room = lesson['room']
-                total_students = sum([Group.query.get(gid).size for gid in lesson['groups']])
+                score += self._lesson_room_usage_score(lesson)
 
-                # Если есть подгруппа, используем ее размер
-                if lesson.get('lab_subgroup'):
-                    total_students = lesson['lab_subgroup'].size
+        return score
 
-                # Оцениваем соответствие: штраф за слишком большие и слишком маленькие аудитории
-                capacity_ratio = total_students / room.capacity if room.capacity > 0 else 0
+    def _lesson_room_usage_score(self, lesson):
+        """Оценка заполненности аудитории одного занятия"""
+        room = self.rooms_by_id[lesson.room_id]
+        # Размер подгруппы или всех групп занятия посчитан заранее
+        total_students = lesson.students
 
-                # Идеальное соотношение - 0.8-0.9
-                if 0.7 <= capacity_ratio <= 0.95:
-                    score += 0.5  # Хорошее использование
-                elif capacity_ratio > 1:
-                    score -= 1  # Перегруженная аудитория (штраф)
-                elif capacity_ratio < 0.4:
-                    score -= 0.5  # Неэффективное использование (небольшой штраф)
+        # Оцениваем соответствие: штраф за слишком большие и слишком маленькие аудитории
+        capacity_ratio = total_students / room.capacity if room.capacity > 0 else 0
 
-        return score
+        # Идеальное соотношение - 0.8-0.9
+        if 0.7 <= capacity_ratio <= 0.95:
+            return 0.5  # Хорошее использование
+        elif capacity_ratio > 1:
+            return -1  # Перегруженная аудитория (штраф)
+        elif capacity_ratio < 0.4:
+            return -0.5  # Неэффективное использование (небольшой штраф)
+        return 0
 
     def _analyze_distribution(self):
         """Анализирует распределение занятий по неделям с учетом подгрупп"""
@@ -766,13 +1458,13 @@ class ScheduleGenerator:
             week_loads[week] += len(lessons)
 
             for lesson in lessons:
-                course_id = lesson['course'].id
-                lesson_type = lesson['lesson_type']
+                course_id = lesson.course_id
+                lesson_type = lesson.lesson_type
 
                 # Добавляем информацию о подгруппе, если есть
                 subgroup_key = 'general'
-                if lesson.get('lab_subgroup'):
-                    subgroup_key = f"subgroup_{lesson['lab_subgroup'].id}"
+                if lesson.lab_subgroup_id:
+                    subgroup_key = f"subgroup_{lesson.lab_subgroup_id}"
 
                 course_distribution[course_id][lesson_type][f"{week}_{subgroup_key}"] += 1
 
@@ -784,7 +1476,7 @@ class ScheduleGenerator:
         # Вывод распределения по курсам
         print("\n=== Распределение занятий по курсам ===")
         for course_id, types in course_distribution.items():
-            course = Course.query.get(course_id)
+            course = self.courses_by_id[course_id]
             print(f"\nКурс: {course.name}")
 
             for lesson_type, weeks_data in types.items():
@@ -795,168 +1487,146 @@ class ScheduleGenerator:
 
                     if subgroup_key != 'general':
                         subgroup_id = int(subgroup_key.split('_')[1])
-                        subgroup = LabSubgroup.query.get(subgroup_id)
+                        subgroup = self.subgroups_by_id.get(subgroup_id)
                         if subgroup:
                             subgroup_info = f" ({subgroup.name})"
 
                     print(f"    Неделя {week_num}{subgroup_info}: {count} занятий")
 
-    def _find_suitable_rooms(self, course, lesson_type, total_students):
-        """Находит подходящие аудитории с учетом предпочтений курса"""
-        suitable_rooms = []
-
-        # Сначала проверяем предпочтительные аудитории курса
-        preferred_rooms = list(course.preferred_rooms)
-        if preferred_rooms:
-            for room in preferred_rooms:
-                # Проверяем вместимость
-                if room.capacity < total_students:
-                    continue
-
-                # Проверяем тип аудитории
-                if lesson_type == "lecture" and not room.is_lecture_hall:
-                    continue
-                if lesson_type == "lab" and not room.is_lab:
-                    continue
+    def _build_room_index(self):
+        """Раскладывает аудитории по типам и сортирует по вместимости для быстрого подбора"""
+        buckets = {
+            'lecture': [room for room in self.rooms if room.is_lecture_hall],
+            'lab': [room for room in self.rooms if room.is_lab],
+            'general': list(self.rooms),
+        }
+
+        self._room_buckets = {}  # тип -> (вместимости по возрастанию, аудитории в том же порядке)
+        for bucket, rooms in buckets.items():
+            if bucket == 'lab':
+                # Для лабораторных при равной вместимости в приоритете компьютерные классы
+                # (среди них, как и раньше, последние добавленные)
+                rooms.sort(key=lambda room: (room.capacity, not room.is_computer_lab,
+                                             -room.id if room.is_computer_lab else room.id))
+            else:
+                rooms.sort(key=lambda room: (room.capacity, room.id))
+            self._room_buckets[bucket] = ([room.capacity for room in rooms], tuple(rooms))
 
-                suitable_rooms.append(room)
+        # room_id -> [(тип, бит аудитории в маске этого типа)]
+        self._room_bits = defaultdict(list)
+        for bucket, (capacities, rooms) in self._room_buckets.items():
+            for position, room in enumerate(rooms):
+                self._room_bits[room.id].append((bucket, 1 << position))
 
-        # Если подходящих предпочтительных аудиторий нет, ищем среди всех
-        if not suitable_rooms:
-            for room in self.rooms:
-                # Проверяем вместимость
-                if room.capacity < total_students:
-                    continue
+        self._suitable_rooms_cache = {}  # (course_id, lesson_type, students) -> (тип, маска аудиторий) или None
 
-                # Проверяем тип аудитории
-                if lesson_type == "lecture" and not room.is_lecture_hall:
-                    continue
-                if lesson_type == "lab" and not room.is_lab:
-                    continue
-
-                if lesson_type == "lab" and room.is_computer_lab:
-                    suitable_rooms.insert(0, room)  # Компьютерные классы в приоритете для лабораторных
-                else:
-                    suitable_rooms.append(room)
+    @staticmethod
+    def _room_bucket(lesson_type):
+        """Тип аудиторий, подходящих для занятия"""
+        if lesson_type == 'lecture':
+            return 'lecture'
+        if lesson_type == 'lab':
+            return 'lab'
+        return 'general'
 
+    def _find_suitable_rooms(self, course, lesson_type, total_students):
+        """
+        Находит подходящие аудитории с учетом предпочтений курса.
+        Возвращает пару (тип аудиторий, битовая маска подходящих аудиторий этого типа) или None,
+        если подходящих аудиторий нет.
+        """
+        key = (course.id, lesson_type, total_students)
+        if key in self._suitable_rooms_cache:
+            return self._suitable_rooms_cache[key]
+
+        bucket = self._room_bucket(lesson_type)
+        capacities, rooms = self._room_buckets[bucket]
+        first = bisect_left(capacities, total_students)
+
+        # Сначала проверяем предпочтительные аудитории курса: вместимость и тип аудитории
+        preferred_room_ids = course.preferred_room_ids
+        mask = 0
+        if preferred_room_ids:
+            for position in range(first, len(rooms)):
+                if rooms[position].id in preferred_room_ids:
+                    mask |= 1 << position
+
+        # Если подходящих предпочтительных аудиторий нет, берем все аудитории типа с достаточной вместимостью
+        if not mask:
+            mask = (1 << len(rooms)) - (1 << first)
+
+        suitable_rooms = (bucket, mask) if mask else None
+        self._suitable_rooms_cache[key] = suitable_rooms
         return suitable_rooms
 
-    def _select_best_room(self, course, rooms, total_students):
-        """Выбирает наиболее подходящую аудиторию с учетом предпочтений"""
-        # Сначала проверяем предпочтительные аудитории
-        preferred_rooms = [room for room in rooms if room in course.preferred_rooms]
-        if preferred_rooms:
-            # Из предпочтительных выбираем наиболее подходящую по размеру
-            return min(preferred_rooms,
-                       key=lambda r: r.capacity - total_students if r.capacity >= total_students else float('inf'))
-
-        # Если предпочтительных нет или они не подходят, выбираем из всех доступных
-        return min(rooms, key=lambda r: r.capacity - total_students if r.capacity >= total_students else float('inf'))
+    def _select_best_room(self, time_key, suitable_rooms):
+        """
+        Выбирает наиболее подходящую по размеру свободную аудиторию в указанное время.
+        Аудитории типа упорядочены по вместимости, поэтому это младший бит среди свободных подходящих.
+        """
+        bucket, mask = suitable_rooms
+        free = mask & ~self._busy_room_masks[bucket].get(time_key, 0)
+        if not free:
+            return None
+        return self._room_buckets[bucket][1][(free & -free).bit_length() - 1]
 
     def _check_constraints(self, time_key, course, group_ids, suitable_rooms, teacher, lab_subgroup=None):
         """Проверяет жесткие и мягкие ограничения для размещения занятия с учетом подгрупп"""
         week, day, slot = time_key
 
-        # Проверка на уже размещенные вручную занятия
-        for time_k, lessons in self.schedule.items():
-            if time_k == time_key:
-                for lesson in lessons:
-                    if lesson.get('is_manually_placed', False):
-                        # Если это ручное занятие, проверяем конфликты
-                        # Конфликт преподавателя
-                        if lesson['teacher'] and lesson['teacher'].id == teacher.id:
-                            return False
-
-                        # Конфликт аудитории
-                        if all(room.id == lesson['room'].id for room in suitable_rooms):
-                            return False
-
-                        # Конфликт групп
-                        for group_id in group_ids:
-                            if group_id in lesson['groups']:
-                                # Проверяем подгруппы при необходимости
-                                if lab_subgroup and lesson.get('lab_subgroup'):
-                                    if lab_subgroup.id != lesson['lab_subgroup'].id:
-                                        continue  # Разные подгруппы могут заниматься параллельно
-                                return False
+        # Конфликты с размещенными вручную занятиями покрываются общими проверками занятости ниже
 
         # НОВОЕ: Добавляем предпочтение к ранним парам в зависимости от настроек
         if self.settings.preferred_lesson_distribution == 'morning' and slot > 3:
             # Для утренних пар высокая вероятность отклонения поздних пар
             rejection_probability = (slot - 3) / self.slots_per_day
-            if random.random() < rejection_probability:
+            if self.rng.random() < rejection_probability:
                 return False
         elif self.settings.preferred_lesson_distribution == 'afternoon' and (slot < 2 or slot > 5):
             # Для дневных пар предпочтение средних слотов
             rejection_probability = min(abs(slot - 3.5) / self.slots_per_day, 0.5)
-            if random.random() < rejection_probability:
+            if self.rng.random() < rejection_probability:
                 return False
 
-        # Если время уже занято в расписании
-        if time_key in self.schedule:
-            # Проверка доступности преподавателя
-            for item in self.schedule[time_key]:
-                if item['teacher'].id == teacher.id:
-                    return False
-
-                # Проверка доступности групп с учетом подгрупп
-                if lab_subgroup:
-                    # Если это занятие для подгруппы, проверяем конфликты с другими занятиями этой же группы
-                    # Нельзя ставить занятия одной группе и ее подгруппам одновременно
-                    for group_id in group_ids:
-                        if group_id in item['groups']:
-                            # Проверяем, не пересекаются ли подгруппы
-                            item_subgroup = item.get('lab_subgroup')
-
-                            # Если другое занятие не для подгруппы, или для другой подгруппы той же группы
-                            if not item_subgroup or (item_subgroup and item_subgroup.group_id == lab_subgroup.group_id):
-                                return False
-                else:
-                    # Если это обычное занятие, проверяем простое пересечение групп
-                    for group_id in group_ids:
-                        if group_id in item['groups']:
-                            return False
+        # Проверка доступности преподавателя
+        if self._teacher_busy.get((teacher.id, week, day, slot), 0):
+            return False
 
-            # Проверка доступности аудиторий
-            occupied_rooms = [item['room'].id for item in self.schedule[time_key]]
-            if all(room.id in occupied_rooms for room in suitable_rooms):
+        # Проверка доступности групп с учетом подгрупп
+        for group_id in group_ids:
+            if lab_subgroup:
+                # Нельзя ставить занятия одной группе и ее подгруппам одновременно:
+                # мешают занятия всей группы и занятия подгрупп той же группы
+                if (self._group_whole_busy.get((group_id, week, day, slot), 0) or
+                        self._group_subgroup_busy.get((group_id, lab_subgroup.group_id, week, day, slot), 0)):
+                    return False
+            elif self._group_busy.get((group_id, week, day, slot), 0):
+                # Если это обычное занятие, проверяем простое пересечение групп
                 return False
 
+        # Проверка доступности аудиторий: нужна хотя бы одна свободная подходящая аудитория
+        bucket, mask = suitable_rooms
+        if not mask & ~self._busy_room_masks[bucket].get(time_key, 0):
+            return False
+
         # Проверка мягких ограничений с учетом предпочтений преподавателя
 
         # 1. Проверка на максимальное количество пар в день
         max_lessons = min(self.settings.max_lessons_per_day_global, teacher.max_lessons_per_day)
-        teacher_lessons_today = 0
-        for check_slot in range(self.slots_per_day):
-            check_key = (week, day, check_slot)
-            if check_key in self.schedule:
-                for item in self.schedule[check_key]:
-                    if item['teacher'].id == teacher.id:
-                        teacher_lessons_today += 1
-
-        if teacher_lessons_today >= max_lessons:
+        if self._teacher_day_load.get((teacher.id, week, day), 0) >= max_lessons:
             return False
 
         # 2. Проверка на максимальное количество пар в день для групп
         for group_id in group_ids:
-            group = Group.query.get(group_id)
+            group = self.groups_by_id[group_id]
             group_max_lessons = min(self.settings.max_lessons_per_day_global, group.max_lessons_per_day)
-            group_lessons_today = 0
-            for check_slot in range(self.slots_per_day):
-                check_key = (week, day, check_slot)
-                if check_key in self.schedule:
-                    for item in self.schedule[check_key]:
-                        if group_id in item['groups']:
-                            # Учитываем подгруппы - если текущее занятие для подгруппы,
-                            # и другое занятие тоже для подгруппы этой же группы,
-                            # мы можем их запланировать параллельно
-                            if lab_subgroup and item.get('lab_subgroup'):
-                                # Если оба занятия для разных подгрупп той же группы, не считаем как пересечение
-                                if item['lab_subgroup'].group_id == lab_subgroup.group_id and item[
-                                    'lab_subgroup'].id != lab_subgroup.id:
-                                    continue
-
-                            group_lessons_today += 1
+            group_lessons_today = self._group_day_load.get((group_id, week, day), 0)
+            if lab_subgroup:
+                # Занятия других подгрупп этой же группы идут параллельно и не учитываются
+                parallel_lessons = (
+                    self._group_owner_day_load.get((group_id, lab_subgroup.group_id, week, day), 0) -
+                    self._group_subgroup_day_load.get((group_id, lab_subgroup.id, week, day), 0))
+                group_lessons_today -= parallel_lessons
 
             if group_lessons_today >= group_max_lessons:
                 return False
@@ -965,13 +1635,7 @@ class ScheduleGenerator:
         if self.settings.avoid_windows:
             for group_id in group_ids:
                 # Получаем все занятия группы в этот день
-                group_slots = []
-                for check_slot in range(self.slots_per_day):
-                    check_key = (week, day, check_slot)
-                    if check_key in self.schedule:
-                        for item in self.schedule[check_key]:
-                            if group_id in item['groups']:
-                                group_slots.append(check_slot)
+                group_slots = self._group_day_slots.get((group_id, week, day))
 
                 # Проверяем, создаст ли новое занятие "окно"
                 if group_slots:
@@ -981,43 +1645,112 @@ class ScheduleGenerator:
                     # Если занятие создает окно, с некоторой вероятностью отклоняем его
                     if min_slot < slot < max_slot and slot not in group_slots:
                         # Окно возникает - с вероятностью 70% отклоняем это размещение
-                        if random.random() < 0.7:
+                        if self.rng.random() < 0.7:
                             return False
 
                     # Если занятие расширяет диапазон занятий, создавая большой разрыв
                     if (slot < min_slot and min_slot - slot > 2) or (slot > max_slot and slot - max_slot > 2):
                         # С вероятностью 40% отклоняем большие разрывы
-                        if random.random() < 0.4:
+                        if self.rng.random() < 0.4:
                             return False
 
         return True
 
     def _save_schedule(self):
-        """Сохраняет сгенерированное расписание в базу данных с учетом подгрупп"""
-        for time_key, items in self.schedule.items():
-            week, day, slot = time_key
-
-            for item in items:
-                # Пропускаем уже размещенные вручную элементы, чтобы не дублировать их
-                if item.get('is_manually_placed', False):
-                    continue
-
-                schedule_item = ScheduleItem(
-                    course_id=item['course'].id,
-                    room_id=item['room'].id,
-                    teacher_id=item['teacher'].id,
-                    week=week,
-                    day=day,
-                    time_slot=slot,
-                    lesson_type=item['lesson_type'],
-                    groups=','.join(map(str, item['groups'])),
-                    is_manually_placed=False
-                )
-
-                # Добавляем информацию о подгруппе, если есть
-                if item.get('lab_subgroup'):
-                    schedule_item.lab_subgroup_id = item['lab_subgroup'].id
-
-                db.session.add(schedule_item)
-
-        db.session.commit()
\ No newline at end of file
+        """
+        Сохраняет сгенерированное расписание в новую версию и делает ее активной.
+        Пока версия записывается, читатели видят предыдущее расписание; при ошибке оно остается активным.
+        Занятия и переключение активной версии записываются одной транзакцией.
+        """
+        version = create_staged_version(description=f"Генерация, оценка {self.stats['score']:.2f}")
+        version_id = version.id
+        try:
+            with sqlite_bulk_write():
+                version.score = self.stats['score']
+                version.input_fingerprints = json.dumps(input_fingerprints(self.snapshot))
+                self.stats['saved_rows'] = self._save_schedule_items(version_id)
+                # Ручные занятия переносятся из версии, с которой работал генератор
+                copy_manual_items(self.snapshot.manual_version_id, version_id)
+
+                # Готовые документы расписания строятся до публикации, чтобы читатели сразу получали их
+                timetable_start = time.perf_counter()
+                self.stats['timetable_documents'] = len(build_timetables(version_id))
+                self.stats['timetable_time'] = time.perf_counter() - timetable_start
+
+                publish_version(version)
+        except Exception:
+            db.session.rollback()
+            discard_version(version)
+            raise
+        self.stats['version_id'] = version.id
+
+    def _save_repair(self, version, removed, new_lessons, fingerprints):
+        """
+        Записывает восстановленное расписание в ту же версию одной транзакцией: удаляет снятые занятия,
+        вставляет размещенные заново и перестраивает документы только затронутых сущностей.
+        """
+        with sqlite_bulk_write():
+            entities = lessons_timetable_entities(
+                [(item.group_ids, item.lab_subgroup_id, item.teacher_id, item.room_id) for item in removed] +
+                [(lesson.group_ids, lesson.lab_subgroup_id, lesson.teacher_id, lesson.room_id)
+                 for lesson in new_lessons])
+            delete_schedule_items(item.id for item in removed)
+            self.stats['saved_rows'] = self._save_schedule_items(version.id, new_lessons)
+
+            timetable_start = time.perf_counter()
+            self.stats['timetable_documents'] = len(refresh_timetables(version.id, entities)) if entities else 0
+            self.stats['timetable_time'] = time.perf_counter() - timetable_start
+
+            version.score = self.stats['score']
+            version.input_fingerprints = json.dumps(fingerprints)
+            if removed or new_lessons:
+                bump_schedule_revision()
+            db.session.commit()
+        self.stats['version_id'] = version.id
+
+    def _save_schedule_items(self, version_id, lessons=None):
+        """
+        Записывает занятия в указанную версию расписания без фиксации транзакции: по умолчанию все
+        сгенерированные занятия расписания, при восстановлении - только размещенные заново (lessons).
+        Строки вставляются одним executemany в обход ORM: объекты ScheduleItem для десятков тысяч
+        занятий создавать незачем. Возвращает количество записанных строк.
+        """
+        if lessons is None:
+            # Ручные занятия копируются при публикации версии вместе со всеми их полями
+            lessons = [item for items in self.schedule.values() for item in items if not item.is_manually_placed]
+
+        rows = []
+        item_group_ids = []
+        for item in lessons:
+            week, day, slot = item.time_key
+            rows.append((version_id, item.course_id, item.room_id, week, day, slot, item.lesson_type,
+                         ','.join(map(str, item.group_ids)), item.teacher_id,
+                         item.lab_subgroup_id,  # Информация о подгруппе, если есть
+                         False))
+            item_group_ids.append(item.group_ids)
+
+        if rows:
+            # Версия при восстановлении уже содержит занятия: связи с группами пишутся только для новых
+            items = ScheduleItem.__table__
+            last_id = db.session.connection().execute(
+                select(func.max(items.c.id)).where(items.c.version_id == version_id)).scalar() or 0
+            bulk_insert(items, SAVED_ITEM_COLUMNS, rows)
+            bulk_link_item_groups(version_id, item_group_ids, after_id=last_id)
+        return len(rows)
+
+
+# Поля schedule_item в порядке значений строк, которые записывает _save_schedule_items
+# (совпадает с порядком столбцов таблицы, поэтому строки не приходится переставлять)
+SAVED_ITEM_COLUMNS = ('version_id', 'course_id', 'room_id', 'week', 'day', 'time_slot', 'lesson_type', 'groups',
+                      'teacher_id', 'lab_subgroup_id', 'is_manually_placed')
+
+
+def _run_chain(snapshot, seed, max_generation_time):
+    """Строит расписание одной независимой цепочкой; выполняется в процессе пула"""
+    generator = ScheduleGenerator(None, snapshot=snapshot, seed=seed)
+    generator.max_generation_time = max_generation_time
+
+    # Подробный журнал размещения из нескольких процессов перемешался бы, поэтому не выводим его
+    with contextlib.redirect_stdout(io.StringIO()):
+        built = generator._build_schedule(time.time())
+    return seed, built, generator.schedule, generator.stats
@@ -0,0 +1,297 @@
+import hashlib
+from collections import namedtuple
+from contextlib import contextmanager
+from sqlalchemy import event, select
+from models import (db, Faculty, Teacher, Group, LabSubgroup, Room, Course, CourseGroup, CourseTeacher,
+                    ScheduleItem, course_preferred_rooms)
+
+
+# Неизменяемые копии данных, с которыми работает генератор расписания.
+# Списки из строковых полей моделей ("0,1,2") разобраны заранее в кортежи чисел.
+SettingsData = namedtuple('SettingsData', [
+    'weeks_count', 'days_per_week', 'slots_per_day', 'avoid_windows', 'prioritize_faculty',
+    'respect_teacher_preferences', 'optimize_room_usage', 'max_lessons_per_day_global',
+    'preferred_lesson_distribution', 'version', 'evaluation_backend', 'chains_count', 'parallel_workers',
+    'random_seed'
+])
+TeacherData = namedtuple('TeacherData', [
+    'id', 'name', 'preferred_days', 'preferred_time_slots', 'max_lessons_per_day'
+])
+GroupData = namedtuple('GroupData', [
+    'id', 'name', 'size', 'faculty_id', 'lab_subgroups_count', 'max_lessons_per_day', 'preferred_time_slots',
+    'subgroup_ids'
+])
+SubgroupData = namedtuple('SubgroupData', ['id', 'group_id', 'subgroup_number', 'name', 'size'])
+RoomData = namedtuple('RoomData', ['id', 'name', 'capacity', 'is_computer_lab', 'is_lecture_hall', 'is_lab'])
+# teachers - кортеж (lesson_type, lab_subgroup_id, teacher_id) в порядке id записей CourseTeacher
+CourseData = namedtuple('CourseData', [
+    'id', 'name', 'lecture_count', 'practice_count', 'lab_count', 'start_week', 'distribution_type', 'priority',
+    'effective_priority', 'group_ids', 'preferred_room_ids', 'teachers'
+])
+ManualItemData = namedtuple('ManualItemData', [
+    'id', 'course_id', 'room_id', 'teacher_id', 'week', 'day', 'time_slot', 'lesson_type', 'group_ids',
+    'lab_subgroup_id'
+])
+# Занятие сохраненной версии расписания, с которым работает инкрементальное восстановление
+PlacedItemData = namedtuple('PlacedItemData', ManualItemData._fields + ('is_manually_placed',))
+# manual_version_id - версия расписания, из которой взяты ручные занятия (None, если они не учитываются)
+ScheduleSnapshot = namedtuple('ScheduleSnapshot', [
+    'settings', 'teachers', 'groups', 'subgroups', 'rooms', 'courses', 'manual_items', 'manual_version_id',
+    'query_count'
+])
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов, выполненных через движок базы данных"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@contextmanager
+def count_queries():
+    """Контекстный менеджер, считающий SQL-запросы внутри блока"""
+    counter = QueryCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+
+def _parse_int_list(value):
+    if not value:
+        return ()
+    return tuple(int(part) for part in value.split(','))
+
+
+def load_snapshot(settings, keep_manual=True):
+    """
+    Загружает все данные, нужные генератору, несколькими массовыми запросами.
+    После загрузки генератор не обращается к базе данных до сохранения результата.
+    Ручные занятия берутся из активной версии расписания, если keep_manual.
+    """
+    manual_version_id = settings.active_schedule_version_id if keep_manual else None
+
+    with count_queries() as counter:
+        settings_data = SettingsData(
+            weeks_count=settings.weeks_count,
+            days_per_week=settings.days_per_week,
+            slots_per_day=settings.slots_per_day,
+            avoid_windows=settings.avoid_windows,
+            prioritize_faculty=settings.prioritize_faculty,
+            respect_teacher_preferences=settings.respect_teacher_preferences,
+            optimize_room_usage=settings.optimize_room_usage,
+            max_lessons_per_day_global=settings.max_lessons_per_day_global,
+            preferred_lesson_distribution=settings.preferred_lesson_distribution,
+            version=settings.version,
+            evaluation_backend=settings.evaluation_backend or 'python',
+            chains_count=settings.chains_count or 1,
+            parallel_workers=settings.parallel_workers or 0,
+            random_seed=settings.random_seed
+        )
+
+        faculty_priorities = dict(db.session.query(Faculty.id, Faculty.priority).all())
+
+        teachers = tuple(
+            TeacherData(
+                id=row.id,
+                name=row.name,
+                preferred_days=_parse_int_list(row.preferred_days),
+                preferred_time_slots=_parse_int_list(row.preferred_time_slots),
+                max_lessons_per_day=row.max_lessons_per_day
+            )
+            for row in db.session.query(Teacher.id, Teacher.name, Teacher.preferred_days,
+                                        Teacher.preferred_time_slots, Teacher.max_lessons_per_day)
+            .order_by(Teacher.id)
+        )
+
+        subgroups = tuple(
+            SubgroupData(id=row.id, group_id=row.group_id, subgroup_number=row.subgroup_number,
+                         name=row.name, size=row.size)
+            for row in db.session.query(LabSubgroup.id, LabSubgroup.group_id, LabSubgroup.subgroup_number,
+                                        LabSubgroup.name, LabSubgroup.size)
+            .order_by(LabSubgroup.id)
+        )
+        subgroup_ids_by_group = {}
+        for subgroup in subgroups:
+            subgroup_ids_by_group.setdefault(subgroup.group_id, []).append(subgroup.id)
+
+        groups = tuple(
+            GroupData(
+                id=row.id,
+                name=row.name,
+                size=row.size,
+                faculty_id=row.faculty_id,
+                lab_subgroups_count=row.lab_subgroups_count,
+                max_lessons_per_day=row.max_lessons_per_day,
+                preferred_time_slots=_parse_int_list(row.preferred_time_slots),
+                subgroup_ids=tuple(subgroup_ids_by_group.get(row.id, ()))
+            )
+            for row in db.session.query(Group.id, Group.name, Group.size, Group.faculty_id, Group.lab_subgroups_count,
+                                        Group.max_lessons_per_day, Group.preferred_time_slots)
+            .order_by(Group.id)
+        )
+        group_faculties = {group.id: group.faculty_id for group in groups}
+
+        rooms = tuple(
+            RoomData(id=row.id, name=row.name, capacity=row.capacity, is_computer_lab=bool(row.is_computer_lab),
+                     is_lecture_hall=bool(row.is_lecture_hall), is_lab=bool(row.is_lab))
+            for row in db.session.query(Room.id, Room.name, Room.capacity, Room.is_computer_lab,
+                                        Room.is_lecture_hall, Room.is_lab)
+            .order_by(Room.id)
+        )
+
+        course_groups = {}
+        for course_id, group_id in (db.session.query(CourseGroup.course_id, CourseGroup.group_id)
+                                    .order_by(CourseGroup.id)):
+            course_groups.setdefault(course_id, []).append(group_id)
+
+        course_teachers = {}
+        for row in (db.session.query(CourseTeacher.course_id, CourseTeacher.lesson_type,
+                                     CourseTeacher.lab_subgroup_id, CourseTeacher.teacher_id)
+                    .order_by(CourseTeacher.id)):
+            course_teachers.setdefault(row.course_id, []).append((row.lesson_type, row.lab_subgroup_id,
+                                                                  row.teacher_id))
+
+        preferred_rooms = {}
+        for course_id, room_id in db.session.execute(
+                db.select(course_preferred_rooms.c.course_id, course_preferred_rooms.c.room_id)):
+            preferred_rooms.setdefault(course_id, set()).add(room_id)
+
+        courses = []
+        for row in db.session.query(Course.id, Course.name, Course.lecture_count, Course.practice_count,
+                                    Course.lab_count, Course.start_week, Course.distribution_type,
+                                    Course.priority).order_by(Course.id):
+            group_ids = tuple(course_groups.get(row.id, ()))
+            courses.append(CourseData(
+                id=row.id,
+                name=row.name,
+                lecture_count=row.lecture_count or 0,
+                practice_count=row.practice_count or 0,
+                lab_count=row.lab_count or 0,
+                start_week=row.start_week,
+                distribution_type=row.distribution_type,
+                priority=row.priority,
+                effective_priority=_effective_priority(row.priority, group_ids, group_faculties,
+                                                       faculty_priorities),
+                group_ids=group_ids,
+                preferred_room_ids=frozenset(preferred_rooms.get(row.id, ())),
+                teachers=tuple(course_teachers.get(row.id, ()))
+            ))
+
+        manual_items = tuple(
+            ManualItemData(
+                id=item.id,
+                course_id=item.course_id,
+                room_id=item.room_id,
+                teacher_id=item.teacher_id,
+                week=item.week,
+                day=item.day,
+                time_slot=item.time_slot,
+                lesson_type=item.lesson_type,
+                group_ids=tuple(item.get_group_ids()),
+                lab_subgroup_id=item.lab_subgroup_id
+            )
+            for item in ScheduleItem.query.filter_by(version_id=manual_version_id, is_manually_placed=True)
+            .order_by(ScheduleItem.id)
+        ) if manual_version_id is not None else ()
+
+    return ScheduleSnapshot(
+        settings=settings_data,
+        teachers=teachers,
+        groups=groups,
+        subgroups=subgroups,
+        rooms=rooms,
+        courses=tuple(courses),
+        manual_items=manual_items,
+        manual_version_id=manual_version_id,
+        query_count=counter.count
+    )
+
+
+def load_version_items(version_id):
+    """Все занятия версии расписания (PlacedItemData) одним запросом, в порядке id"""
+    items = ScheduleItem.__table__
+    return tuple(
+        PlacedItemData(id=row.id, course_id=row.course_id, room_id=row.room_id, teacher_id=row.teacher_id,
+                       week=row.week, day=row.day, time_slot=row.time_slot, lesson_type=row.lesson_type,
+                       group_ids=_parse_int_list(row.groups), lab_subgroup_id=row.lab_subgroup_id,
+                       is_manually_placed=bool(row.is_manually_placed))
+        for row in db.session.execute(
+            select(items.c.id, items.c.course_id, items.c.room_id, items.c.teacher_id, items.c.week, items.c.day,
+                   items.c.time_slot, items.c.lesson_type, items.c.groups, items.c.lab_subgroup_id,
+                   items.c.is_manually_placed)
+            .where(items.c.version_id == version_id).order_by(items.c.id))
+    )
+
+
+def input_fingerprints(snapshot):
+    """
+    Отпечатки входных данных генерации: по одному на дисциплину, преподавателя, группу и аудиторию
+    и один на настройки. В отпечаток входят только поля, от которых зависит размещение занятий:
+    переименование или смена приоритета не требуют перестраивать расписание. В отпечаток дисциплины
+    входит и деление ее групп на подгруппы - от него зависит, какие лабораторные нужно поставить.
+    Сохраняются вместе с версией расписания, чтобы потом найти изменившиеся данные (changed_inputs).
+    """
+    settings = snapshot.settings
+    groups_by_id = {group.id: group for group in snapshot.groups}
+    subgroup_sizes = {subgroup.id: subgroup.size for subgroup in snapshot.subgroups}
+    return {
+        'settings_version': settings.version,
+        'settings': _fingerprint(settings.weeks_count, settings.days_per_week, settings.slots_per_day,
+                                 settings.avoid_windows, settings.prioritize_faculty,
+                                 settings.respect_teacher_preferences, settings.optimize_room_usage,
+                                 settings.max_lessons_per_day_global, settings.preferred_lesson_distribution),
+        'courses': {str(course.id): _fingerprint(
+            course.lecture_count, course.practice_count, course.lab_count, course.start_week,
+            course.distribution_type, course.group_ids, sorted(course.preferred_room_ids), course.teachers,
+            [(groups_by_id[group_id].lab_subgroups_count, groups_by_id[group_id].subgroup_ids)
+             for group_id in course.group_ids if group_id in groups_by_id]
+        ) for course in snapshot.courses},
+        'teachers': {str(teacher.id): _fingerprint(teacher.preferred_days, teacher.preferred_time_slots,
+                                                   teacher.max_lessons_per_day)
+                     for teacher in snapshot.teachers},
+        'groups': {str(group.id): _fingerprint(group.size, group.max_lessons_per_day, group.preferred_time_slots,
+                                               [subgroup_sizes[subgroup_id] for subgroup_id in group.subgroup_ids])
+                   for group in snapshot.groups},
+        'rooms': {str(room.id): _fingerprint(room.capacity, room.is_computer_lab, room.is_lecture_hall, room.is_lab)
+                  for room in snapshot.rooms},
+    }
+
+
+def changed_inputs(previous, current):
+    """
+    Сравнивает сохраненные отпечатки входных данных (input_fingerprints) с текущими.
+    Возвращает {'courses': id, 'teachers': id, 'groups': id, 'rooms': id} - множества id измененных,
+    добавленных и удаленных записей, и 'settings' - изменились ли влияющие на размещение настройки.
+    Настройки сравниваются, только если с тех пор менялась Settings.version.
+    """
+    changes = {}
+    for kind in ('courses', 'teachers', 'groups', 'rooms'):
+        before = previous.get(kind, {})
+        after = current[kind]
+        changes[kind] = {int(key) for key in before.keys() | after.keys() if before.get(key) != after.get(key)}
+    changes['settings'] = (previous.get('settings_version') != current['settings_version'] and
+                           previous.get('settings') != current['settings'])
+    return changes
+
+
+def _fingerprint(*values):
+    return hashlib.blake2b(repr(values).encode(), digest_size=8).hexdigest()
+
+
+def _effective_priority(priority, group_ids, group_faculties, faculty_priorities):
+    """То же, что Course.get_effective_priority, но по загруженным данным"""
+    faculties = [group_faculties[group_id] for group_id in group_ids if group_faculties.get(group_id)]
+    if not faculties:
+        return priority
+
+    # Вычисляем средний приоритет всех факультетов
+    faculty_priority = sum(faculty_priorities[faculty_id] for faculty_id in faculties) / len(faculties)
+
+    # Комбинируем приоритет курса и факультетов
+    return (priority * 0.7) + (faculty_priority * 0.3)
@@ -0,0 +1,163 @@
+"""
+Векторизованная оценка расписания на NumPy.
+
+Расписание генератора раскладывается в массивы занятости (сущность, неделя, день, пара)
+для групп, преподавателей и аудиторий, после чего все слагаемые оценки считаются
+редукциями по этим массивам. Результат совпадает с ScheduleGenerator._evaluate_schedule
+с точностью до погрешности суммирования чисел с плавающей точкой.
+"""
+try:
+    import numpy as np
+except ImportError:  # NumPy не установлен - остается оценка на чистом Python
+    np = None
+
+NUMPY_AVAILABLE = np is not None
+
+
+class ScheduleTensors:
+    """Массивы занятости расписания генератора"""
+
+    def __init__(self, generator):
+        settings = generator.settings
+        self.weeks_count = settings.weeks_count
+        self.days_per_week = settings.days_per_week
+        self.slots_per_day = settings.slots_per_day
+
+        group_index = {group.id: index for index, group in enumerate(generator.groups)}
+        teacher_index = {teacher.id: index for index, teacher in enumerate(generator.teachers)}
+        room_index = {room.id: index for index, room in enumerate(generator.rooms)}
+
+        # Плоские списки по занятиям; связи занятие-группа отдельно, т.к. групп у занятия несколько
+        weeks, days, slots = [], [], []
+        teachers, rooms, students = [], [], []
+        membership_lessons, membership_groups = [], []
+        lesson_count = 0
+        for (week, day, slot), lessons in generator.schedule.items():
+            for lesson in lessons:
+                weeks.append(week)
+                days.append(day)
+                slots.append(slot)
+                teachers.append(teacher_index.get(lesson.teacher_id, -1))
+                rooms.append(room_index.get(lesson.room_id, -1))
+                students.append(lesson.students)
+                for group_id in lesson.group_ids:
+                    index = group_index.get(group_id)
+                    if index is not None:
+                        membership_lessons.append(lesson_count)
+                        membership_groups.append(index)
+                lesson_count += 1
+
+        self.lesson_week = np.array(weeks, dtype=np.int64)
+        self.lesson_day = np.array(days, dtype=np.int64)
+        self.lesson_slot = np.array(slots, dtype=np.int64)
+        self.lesson_teacher = np.array(teachers, dtype=np.int64)
+        self.lesson_room = np.array(rooms, dtype=np.int64)
+        self.lesson_students = np.array(students, dtype=np.float64)
+
+        # Размеры осей: сетка семестра, расширенная, если вручную размещенные занятия выходят за нее.
+        # Неделя используется как индекс напрямую (нулевая остается пустой)
+        self.shape = (
+            max(self.weeks_count, int(self.lesson_week.max(initial=0))) + 1,
+            max(self.days_per_week, int(self.lesson_day.max(initial=-1)) + 1),
+            max(self.slots_per_day, int(self.lesson_slot.max(initial=-1)) + 1),
+        )
+
+        membership_lessons = np.array(membership_lessons, dtype=np.int64)
+        self.groups = self._occupancy(len(group_index), np.array(membership_groups, dtype=np.int64),
+                                      membership_lessons)
+        self.teachers = self._occupancy(len(teacher_index), self.lesson_teacher, None)
+        self.rooms = self._occupancy(len(room_index), self.lesson_room, None)
+
+    def _occupancy(self, entity_count, entities, lessons):
+        """Количество занятий сущности в каждую (неделю, день, пару); -1 в entities - сущность не найдена"""
+        weeks, days, slots = self.shape
+        if lessons is None:
+            lessons = np.arange(len(entities))
+        known = entities >= 0
+        entities, lessons = entities[known], lessons[known]
+        flat = ((entities * weeks + self.lesson_week[lessons]) * days + self.lesson_day[lessons]) * slots \
+            + self.lesson_slot[lessons]
+        counts = np.bincount(flat, minlength=entity_count * weeks * days * slots)
+        return counts.reshape(entity_count, weeks, days, slots)
+
+
+def count_group_windows(tensors):
+    """То же, что _count_group_windows: пропуски между первой и последней парой дня группы"""
+    occupied = tensors.groups[:, 1:tensors.weeks_count + 1, :tensors.days_per_week, :tensors.slots_per_day] > 0
+    lessons = occupied.sum(axis=-1)
+    first = occupied.argmax(axis=-1)
+    last = tensors.slots_per_day - 1 - occupied[..., ::-1].argmax(axis=-1)
+    windows = np.where(lessons >= 2, last - first + 1 - lessons, 0)
+    return int(windows.sum())
+
+
+def evaluate_teacher_preferences(generator, tensors):
+    """То же, что _evaluate_teacher_preferences: по 0.5 за совпадение дня и пары с предпочтениями"""
+    _, days, slots = tensors.shape
+    teacher_count = len(generator.teachers)
+    preferred_days = np.zeros((teacher_count, days), dtype=bool)
+    preferred_slots = np.zeros((teacher_count, slots), dtype=bool)
+    for index, teacher in enumerate(generator.teachers):
+        preferred_days[index, [day for day in teacher.preferred_days if 0 <= day < days]] = True
+        preferred_slots[index, [slot for slot in teacher.preferred_time_slots if 0 <= slot < slots]] = True
+
+    # Нагрузка преподавателя по дням и по парам за весь семестр
+    day_load = tensors.teachers.sum(axis=(1, 3))
+    slot_load = tensors.teachers.sum(axis=(1, 2))
+    matches = int((day_load * preferred_days).sum()) + int((slot_load * preferred_slots).sum())
+    return 0.5 * matches
+
+
+def evaluate_distribution(tensors):
+    """То же, что _evaluate_distribution: 10 / (1 + std) дневной нагрузки по дням с занятиями"""
+    day_load = tensors.groups.sum(axis=-1).reshape(len(tensors.groups), -1)
+    busy = day_load > 0
+    busy_days = busy.sum(axis=1)
+    active = busy_days > 0
+    if not active.any():
+        return 0.0
+
+    day_load, busy, busy_days = day_load[active], busy[active], busy_days[active]
+    mean = day_load.sum(axis=1) / busy_days
+    variance = np.where(busy, (day_load - mean[:, None]) ** 2, 0).sum(axis=1) / busy_days
+    std_dev = np.sqrt(np.maximum(variance, 0))
+    return float((10 / (1 + std_dev)).sum())
+
+
+def evaluate_room_usage(generator, tensors):
+    """То же, что _evaluate_room_usage: оценка заполненности аудитории каждого занятия"""
+    capacities = np.array([room.capacity for room in generator.rooms], dtype=np.float64)
+    capacity = capacities[tensors.lesson_room]
+    ratio = np.divide(tensors.lesson_students, capacity, out=np.zeros_like(capacity), where=capacity > 0)
+
+    good = int(((ratio >= 0.7) & (ratio <= 0.95)).sum())
+    overloaded = int((ratio > 1).sum())
+    underused = int((ratio < 0.4).sum())
+    return 0.5 * good - overloaded - 0.5 * underused
+
+
+def evaluate_schedule(generator):
+    """Оценка расписания генератора; повторяет критерии ScheduleGenerator._evaluate_schedule"""
+    tensors = ScheduleTensors(generator)
+    settings = generator.settings
+    score = 100
+
+    # 1. Занятия на последней паре
+    score -= int((tensors.lesson_slot >= tensors.slots_per_day - 1).sum()) * 0.5
+
+    # 2. "Окна" в расписании групп
+    if settings.avoid_windows:
+        score -= count_group_windows(tensors) * 2
+
+    # 3. Соответствие предпочтениям преподавателей
+    if settings.respect_teacher_preferences:
+        score += evaluate_teacher_preferences(generator, tensors)
+
+    # 4. Равномерность распределения занятий
+    score += evaluate_distribution(tensors)
+
+    # 5. Эффективность использования аудиторий
+    if settings.optimize_room_usage:
+        score += evaluate_room_usage(generator, tensors)
+
+    return score
@@ -0,0 +1,84 @@
+"""
+Проверки числа SQL-запросов эндпоинтов расписания и того, что основные выборки идут по индексам.
+
+Приложение работает с временной базой SQLite (переменная окружения SCHEDULE_DATABASE_URI задается
+до импорта app). Наборы данных создаются generate_dataset.populate, расписание строится генератором
+с небольшим числом итераций отжига.
+Запуск:
+    python -m pytest test_queries.py
+"""
+import os
+import tempfile
+
+import pytest
+
+_database_dir = tempfile.TemporaryDirectory()
+os.environ['SCHEDULE_DATABASE_URI'] = 'sqlite:///' + os.path.join(_database_dir.name, 'schedule.db')
+
+from app import app  # noqa: E402
+from generate_dataset import populate  # noqa: E402
+from migrate import check_query_plans  # noqa: E402
+from models import db, ScheduleItem, Settings  # noqa: E402
+from schedule_cache import response_cache  # noqa: E402
+from scheduler import ScheduleGenerator  # noqa: E402
+from snapshot import count_queries  # noqa: E402
+from versions import active_schedule_items  # noqa: E402
+
+# Два набора разного размера: число запросов не должно зависеть от числа занятий
+DATASET_SIZES = (10, 40)
+MAX_ENDPOINT_QUERIES = 4
+
+
+def load_dataset(courses):
+    """Пересоздает базу с набором данных из courses дисциплин и строит для него расписание"""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        populate(courses, seed=1)
+        settings = Settings.query.first()
+        settings.random_seed = 1
+        generator = ScheduleGenerator(settings)
+        generator.max_iterations = 500
+        assert generator.generate()
+
+
+def endpoint_query_counts():
+    """Число запросов каждого эндпоинта на текущем наборе, без кэша ответов"""
+    # Группа, преподаватель и неделя берутся из занятия, чтобы ответы не были пустыми
+    with app.app_context():
+        item = active_schedule_items().filter(ScheduleItem.teacher_id.isnot(None)).order_by(ScheduleItem.id).first()
+        week, teacher_id, group_id = item.week, item.teacher_id, item.get_group_ids()[0]
+
+    client = app.test_client()
+    counts = {}
+    for name, url in (('group', f'/schedule/data?group_id={group_id}&week={week}'),
+                      ('teacher', f'/schedule/data?teacher_id={teacher_id}&week={week}'),
+                      ('week items', f'/schedule/get-items?week={week}')):
+        response_cache.clear()
+        with app.app_context(), count_queries() as counter:
+            response = client.get(url)
+        assert response.status_code == 200, url
+        assert response.get_json(), f"{url}: пустой ответ, проверка ничего не показывает"
+        counts[name] = counter.count
+    return counts
+
+
+@pytest.fixture(scope='module')
+def query_counts():
+    counts = {}
+    for courses in DATASET_SIZES:
+        load_dataset(courses)
+        counts[courses] = endpoint_query_counts()
+    return counts
+
+
+def test_schedule_endpoints_use_fixed_number_of_queries(query_counts):
+    small, large = (query_counts[courses] for courses in DATASET_SIZES)
+    assert small == large
+    for name, count in small.items():
+        assert count <= MAX_ENDPOINT_QUERIES, f"{name}: {count} запросов"
+
+
+def test_schedule_queries_use_indexes(query_counts):
+    # После query_counts в базе остается набор наибольшего размера с расписанием
+    assert check_query_plans() == []
@@ -0,0 +1,324 @@
+"""
+Готовые документы расписания.
+
+Для каждой группы, подгруппы, преподавателя и аудитории версии расписания хранится документ на весь
+семестр: JSON-объект "номер недели -> занятия" в том же формате, в каком их отдает /schedule/data.
+Документы строятся за один проход по занятиям при сохранении сгенерированной версии, при ручной
+правке занятия перестраиваются только затронутые, а после изменения справочников (названий дисциплин,
+аудиторий, преподавателей, состава групп) удаляются и строятся заново при первом обращении.
+Пустые документы не хранятся: для сущности без занятий построение сводится к пустой выборке.
+"""
+import json
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from models import (db, Course, CourseTeacher, Group, LabSubgroup, Room, ScheduleItem, Teacher, TimetableDocument,
+                    schedule_item_group)
+from versions import bulk_insert, bump_schedule_revision
+
+ENTITY_TYPES = ('group', 'subgroup', 'teacher', 'room')
+
+# Поля занятия в компактной пакетной выдаче (encode_timetables); course, teacher, room, lesson_type и groups -
+# номера в словарях ответа
+BATCH_LESSON_FIELDS = ('id', 'week', 'day', 'time_slot', 'course', 'teacher', 'room', 'lesson_type', 'subgroup_id',
+                       'is_manually_placed', 'groups')
+
+
+def build_timetables(version_id, entities=None):
+    """
+    Строит документы расписания версии и записывает их в текущей транзакции (без фиксации).
+    entities - множество пар (entity_type, entity_id), документы которых нужно перестроить;
+    None - документы всех сущностей, у которых есть занятия (версия еще не должна их иметь).
+    Возвращает словарь (entity_type, entity_id) -> JSON документа.
+    """
+    subgroups_by_group = {}
+    subgroup_parent = {}
+    for subgroup_id, group_id in db.session.query(LabSubgroup.id, LabSubgroup.group_id).order_by(LabSubgroup.id):
+        subgroups_by_group.setdefault(group_id, []).append(subgroup_id)
+        subgroup_parent[subgroup_id] = group_id
+    group_names = dict(db.session.query(Group.id, Group.name))
+
+    query = (db.session.query(ScheduleItem.id, ScheduleItem.course_id, ScheduleItem.room_id, ScheduleItem.teacher_id,
+                              ScheduleItem.week, ScheduleItem.day, ScheduleItem.time_slot, ScheduleItem.lesson_type,
+                              ScheduleItem.groups, ScheduleItem.lab_subgroup_id, ScheduleItem.is_manually_placed,
+                              Course.name.label('course_name'), Room.name.label('room_name'),
+                              Teacher.name.label('teacher_name'), LabSubgroup.name.label('subgroup_name'))
+             .join(Course, Course.id == ScheduleItem.course_id)
+             .outerjoin(Room, Room.id == ScheduleItem.room_id)
+             .outerjoin(Teacher, Teacher.id == ScheduleItem.teacher_id)
+             .outerjoin(LabSubgroup, LabSubgroup.id == ScheduleItem.lab_subgroup_id)
+             .filter(ScheduleItem.version_id == version_id)
+             # Занятия сразу идут в порядке документа, этот порядок дает индекс ix_schedule_item_version_time
+             .order_by(ScheduleItem.week, ScheduleItem.day, ScheduleItem.time_slot, ScheduleItem.id))
+
+    if entities is None:
+        rows = query.all()
+    else:
+        conditions = _entity_conditions(entities, subgroup_parent)
+        rows = query.filter(or_(*conditions)).all() if conditions else []
+
+    fallback_teachers = _fallback_teacher_names(rows)
+
+    # Занятия с одинаковыми группами и подгруппой попадают в одни и те же документы групп и подгрупп
+    audiences = {}
+    documents = {}
+    # Строки распаковываются в переменные: доступ к полям Row по имени заметно дороже на десятках тысяч занятий
+    for (item_id, course_id, room_id, teacher_id, week, day, time_slot, lesson_type, groups, lab_subgroup_id,
+         is_manually_placed, course_name, room_name, teacher_name, subgroup_name) in rows:
+        if not teacher_id:
+            # Если преподаватель не назначен в ScheduleItem, берем его из CourseTeacher
+            teacher_name = fallback_teachers.get((course_id, lesson_type, lab_subgroup_id))
+
+        # Добавляем информацию о подгруппе, если это лабораторная работа для подгруппы
+        subgroup_info = ""
+        if lesson_type == 'lab' and subgroup_name:
+            subgroup_info = f" ({subgroup_name})"
+
+        audience = audiences.get((groups, lab_subgroup_id))
+        if audience is None:
+            audience = audiences[(groups, lab_subgroup_id)] = _item_audience(groups, lab_subgroup_id, group_names,
+                                                                             subgroups_by_group)
+        item_group_names, keys = audience
+
+        # Занятие кодируется в JSON один раз, а не для каждого документа, в который попадает
+        entry = json.dumps({
+            'id': item_id,
+            'day': day,
+            'time_slot': time_slot,
+            'course_name': f"{course_name}{subgroup_info}",
+            'teacher_name': teacher_name or "Не назначен",
+            'teacher_id': teacher_id,
+            'room_name': room_name,
+            'room_id': room_id,
+            'lesson_type': lesson_type,
+            'subgroup_id': lab_subgroup_id,
+            'is_manually_placed': is_manually_placed,
+            'group_names': item_group_names
+        }, ensure_ascii=False)
+
+        week = str(week)
+        for key in keys:
+            documents.setdefault(key, {}).setdefault(week, []).append(entry)
+        if teacher_id:
+            documents.setdefault(('teacher', teacher_id), {}).setdefault(week, []).append(entry)
+        if room_id:
+            documents.setdefault(('room', room_id), {}).setdefault(week, []).append(entry)
+
+    if entities is not None:
+        documents = {key: document for key, document in documents.items() if key in entities}
+        _delete_documents(version_id, entities)
+
+    documents = {key: _encode_document(document) for key, document in documents.items()}
+    if documents:
+        bulk_insert(TimetableDocument.__table__, ('version_id', 'entity_type', 'entity_id', 'document'),
+                    [(version_id, entity_type, entity_id, document)
+                     for (entity_type, entity_id), document in documents.items()])
+    return documents
+
+
+def get_timetable(version_id, entity_type, entity_id):
+    """Документ расписания сущности; если его еще нет, он строится и сохраняется"""
+    return get_timetables(version_id, {(entity_type, entity_id)}).get((entity_type, entity_id), {})
+
+
+def get_timetables(version_id, entities):
+    """
+    Документы расписания нескольких сущностей: словарь (entity_type, entity_id) -> документ.
+    Готовые документы читаются одним запросом, недостающие строятся все вместе за один проход
+    и сохраняются. Сущностей без занятий в результате нет.
+    """
+    if version_id is None or not entities:
+        return {}
+
+    conditions = [and_(TimetableDocument.entity_type == entity_type, TimetableDocument.entity_id.in_(entity_ids))
+                  for entity_type, entity_ids in _ids_by_type(entities).items() if entity_ids]
+    rows = (db.session.query(TimetableDocument.entity_type, TimetableDocument.entity_id, TimetableDocument.document)
+            .filter(TimetableDocument.version_id == version_id, or_(*conditions)))
+    documents = {(entity_type, entity_id): json.loads(document) for entity_type, entity_id, document in rows}
+
+    missing = set(entities) - set(documents)
+    if missing:
+        built = build_timetables(version_id, missing)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Те же документы одновременно построил другой запрос
+            db.session.rollback()
+        documents.update((key, json.loads(document)) for key, document in built.items())
+    return documents
+
+
+def encode_timetables(entities, documents, week_from, week_to):
+    """
+    Компактное представление расписаний сущностей за недели week_from..week_to для пакетной выдачи.
+    Названия дисциплин, списки групп и типы занятий хранятся в словарях ответа по одному разу, преподаватели
+    и аудитории - парами [id, название]; каждое занятие - список чисел в порядке BATCH_LESSON_FIELDS,
+    тоже один раз, даже если оно входит в несколько расписаний. timetables[тип][id] - номера занятий
+    сущности в списке lessons.
+    """
+    dictionaries = {name: {} for name in ('courses', 'teachers', 'rooms', 'lesson_types', 'groups')}
+
+    def index(name, value):
+        values = dictionaries[name]
+        return values.setdefault(value, len(values))
+
+    lessons = []
+    lesson_positions = {}
+    timetables = {entity_type: {} for entity_type in ENTITY_TYPES}
+    for entity_type, entity_id in sorted(entities):
+        document = documents.get((entity_type, entity_id), {})
+        positions = []
+        for week in range(week_from, week_to + 1):
+            for entry in document.get(str(week), ()):
+                position = lesson_positions.get(entry['id'])
+                if position is None:
+                    position = lesson_positions[entry['id']] = len(lessons)
+                    lessons.append([
+                        entry['id'],
+                        week,
+                        entry['day'],
+                        entry['time_slot'],
+                        index('courses', entry['course_name']),
+                        index('teachers', (entry['teacher_id'], entry['teacher_name'])),
+                        index('rooms', (entry['room_id'], entry['room_name'])),
+                        index('lesson_types', entry['lesson_type']),
+                        entry['subgroup_id'],
+                        int(entry['is_manually_placed']),
+                        index('groups', entry['group_names'])
+                    ])
+                positions.append(position)
+        timetables[entity_type][str(entity_id)] = positions
+
+    payload = {name: [list(value) if isinstance(value, tuple) else value for value in values]
+               for name, values in dictionaries.items()}
+    payload.update({
+        'week_from': week_from,
+        'week_to': week_to,
+        'lesson_fields': list(BATCH_LESSON_FIELDS),
+        'lessons': lessons,
+        'timetables': timetables
+    })
+    return payload
+
+
+def item_timetable_entities(item):
+    """Сущности, в документы которых попадает занятие: его группы, подгруппы, преподаватель и аудитория"""
+    return items_timetable_entities([item])
+
+
+def items_timetable_entities(items):
+    """Сущности, в документы которых попадают занятия; подгруппы их групп читаются одним запросом"""
+    return lessons_timetable_entities((item.get_group_ids(), item.lab_subgroup_id, item.teacher_id, item.room_id)
+                                      for item in items)
+
+
+def lessons_timetable_entities(lessons):
+    """То же для занятий, заданных кортежами (id групп, id подгруппы, id преподавателя, id аудитории)"""
+    entities = set()
+    whole_group_ids = set()
+    for group_ids, lab_subgroup_id, teacher_id, room_id in lessons:
+        entities.update(('group', group_id) for group_id in group_ids)
+        if lab_subgroup_id:
+            entities.add(('subgroup', lab_subgroup_id))
+        else:
+            whole_group_ids.update(group_ids)
+        if teacher_id:
+            entities.add(('teacher', teacher_id))
+        if room_id:
+            entities.add(('room', room_id))
+
+    if whole_group_ids:
+        subgroup_ids = db.session.query(LabSubgroup.id).filter(LabSubgroup.group_id.in_(whole_group_ids))
+        entities.update(('subgroup', subgroup_id) for (subgroup_id,) in subgroup_ids)
+    return entities
+
+
+def refresh_timetables(version_id, entities):
+    """
+    Перестраивает документы после ручной правки занятий версии.
+    entities - сущности занятий до и после правки (item_timetable_entities).
+    Возвращает перестроенные непустые документы, как build_timetables.
+    """
+    db.session.flush()
+    return build_timetables(version_id, entities)
+
+
+def invalidate_timetables():
+    """
+    Удаляет все документы расписания после изменения справочников, видимых в расписании.
+    Документы активной версии строятся заново при первом обращении.
+    """
+    TimetableDocument.query.delete()
+    bump_schedule_revision()
+
+
+def _ids_by_type(entities):
+    """Множества id сущностей по типам"""
+    ids = {entity_type: set() for entity_type in ENTITY_TYPES}
+    for entity_type, entity_id in entities:
+        ids[entity_type].add(entity_id)
+    return ids
+
+
+def _entity_conditions(entities, subgroup_parent):
+    """Условия выборки занятий, попадающих в документы entities"""
+    ids = _ids_by_type(entities)
+
+    # Подгруппа видит и занятия всей группы, поэтому для нее берутся занятия группы-родителя
+    group_ids = ids['group'] | {subgroup_parent[subgroup_id] for subgroup_id in ids['subgroup']
+                                if subgroup_id in subgroup_parent}
+
+    conditions = []
+    if group_ids:
+        conditions.append(ScheduleItem.id.in_(
+            select(schedule_item_group.c.schedule_item_id).where(schedule_item_group.c.group_id.in_(group_ids))))
+    if ids['teacher']:
+        conditions.append(ScheduleItem.teacher_id.in_(ids['teacher']))
+    if ids['room']:
+        conditions.append(ScheduleItem.room_id.in_(ids['room']))
+    return conditions
+
+
+def _item_audience(groups, lab_subgroup_id, group_names, subgroup_ids_by_group):
+    """Названия групп занятия и документы групп и подгрупп, в которые оно попадает"""
+    group_ids = [int(part) for part in (groups or '').split(',') if part.strip()]
+    group_ids = [group_id for group_id in group_ids if group_id in group_names]
+
+    keys = [('group', group_id) for group_id in group_ids]
+    for group_id in group_ids:
+        # Занятие подгруппы видит только она сама, занятие всей группы - все ее подгруппы
+        keys.extend(('subgroup', subgroup_id) for subgroup_id in subgroup_ids_by_group.get(group_id, ())
+                    if lab_subgroup_id in (None, subgroup_id))
+    return ', '.join(group_names[group_id] for group_id in group_ids), list(dict.fromkeys(keys))
+
+
+def _encode_document(document):
+    """JSON документа из уже закодированных занятий: {"неделя": [занятие, ...], ...}"""
+    return '{' + ', '.join(f'"{week}": [{", ".join(entries)}]' for week, entries in document.items()) + '}'
+
+
+def _fallback_teacher_names(rows):
+    """Имена преподавателей из CourseTeacher для занятий без teacher_id, одним запросом"""
+    course_ids = {row.course_id for row in rows if not row.teacher_id}
+    if not course_ids:
+        return {}
+
+    fallback = {}
+    course_teachers = (db.session.query(CourseTeacher.course_id, CourseTeacher.lesson_type,
+                                        CourseTeacher.lab_subgroup_id, Teacher.name)
+                       .outerjoin(Teacher, Teacher.id == CourseTeacher.teacher_id)
+                       .filter(CourseTeacher.course_id.in_(course_ids))
+                       .order_by(CourseTeacher.id))
+    for course_id, lesson_type, lab_subgroup_id, teacher_name in course_teachers:
+        fallback.setdefault((course_id, lesson_type, lab_subgroup_id), teacher_name)
+    return fallback
+
+
+def _delete_documents(version_id, entities):
+    for entity_type, entity_ids in _ids_by_type(entities).items():
+        if entity_ids:
+            TimetableDocument.query.filter(TimetableDocument.version_id == version_id,
+                                           TimetableDocument.entity_type == entity_type,
+                                           TimetableDocument.entity_id.in_(entity_ids)
+                                           ).delete(synchronize_session=False)
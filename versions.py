@@ -0,0 +1,223 @@
+"""
+Версии расписания.
+
+Генератор записывает новое расписание в подготовленную (staged) версию, которую никто не видит,
+а затем одним коммитом делает ее активной. Читатели всегда работают с активной версией, поэтому
+не видят пустого или частично записанного расписания, а неудачная генерация не трогает текущее.
+Несколько предыдущих версий хранятся для быстрого отката.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import select, text
+
+from models import db, ScheduleItem, ScheduleVersion, Settings, TimetableDocument, schedule_item_group
+
+MAX_ARCHIVED_VERSIONS = 5  # сколько предыдущих версий хранить для отката
+
+# Настройки соединения SQLite на время массовой записи версии:
+# реже синхронизируемся с диском, держим в памяти больше страниц и временные данные индексов
+SQLITE_BULK_WRITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # в КБ, т.е. 64 МБ
+    'temp_store': 'MEMORY',
+}
+
+
+def bump_schedule_revision(settings=None):
+    """
+    Отмечает изменение видимого расписания (новая версия, ручная правка, переименование аудитории и т.п.)
+    или справочников, по которым подбирается время занятий (новая аудитория, преподаватель и т.п.).
+    Изменение фиксируется вместе с транзакцией вызывающего кода.
+    """
+    settings = settings or Settings.query.first()
+    settings.schedule_revision = (settings.schedule_revision or 0) + 1
+    settings.schedule_modified_at = datetime.utcnow()
+
+
+def get_active_version_id():
+    settings = Settings.query.first()
+    return settings.active_schedule_version_id if settings else None
+
+
+def active_schedule_items():
+    """Запрос элементов активной версии расписания"""
+    return ScheduleItem.query.filter_by(version_id=get_active_version_id())
+
+
+def get_or_create_active_version():
+    """Id активной версии; если расписания еще нет, создает пустую активную версию (для ручных занятий)"""
+    settings = Settings.query.first()
+    if settings.active_schedule_version_id is None:
+        version = ScheduleVersion(status='active', description='Ручное расписание', activated_at=datetime.utcnow())
+        db.session.add(version)
+        db.session.flush()
+        settings.active_schedule_version_id = version.id
+    return settings.active_schedule_version_id
+
+
+def create_staged_version(description=None):
+    """Создает новую версию, невидимую для читателей до публикации"""
+    version = ScheduleVersion(status='staged', description=description)
+    db.session.add(version)
+    db.session.commit()
+    return version
+
+
+@contextmanager
+def sqlite_bulk_write():
+    """
+    Меняет настройки соединения SQLite на время массовой записи и затем возвращает прежние.
+    Для других СУБД ничего не делает. Прагмы выполняются вне транзакции, поэтому менеджер
+    нужно открывать до первого изменения данных в сессии.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        yield
+        return
+
+    previous = {name: db.session.execute(text(f"PRAGMA {name}")).scalar() for name in SQLITE_BULK_WRITE_PRAGMAS}
+    for name, value in SQLITE_BULK_WRITE_PRAGMAS.items():
+        db.session.execute(text(f"PRAGMA {name} = {value}"))
+    try:
+        yield
+    except Exception:
+        # Незафиксированные изменения не должны попасть в базу вместе с восстановлением настроек
+        db.session.rollback()
+        raise
+    finally:
+        for name, value in previous.items():
+            db.session.execute(text(f"PRAGMA {name} = {value}"))
+        db.session.commit()
+
+
+def copy_manual_items(source_version_id, version_id):
+    """Переносит ручные занятия из версии source_version_id в версию version_id (без фиксации транзакции)"""
+    if source_version_id is None:
+        return
+    for item in ScheduleItem.query.filter_by(version_id=source_version_id, is_manually_placed=True):
+        db.session.add(copy_schedule_item(item, version_id))
+    db.session.flush()
+
+
+def publish_version(version):
+    """Делает подготовленную версию активной и фиксирует транзакцию вместе со всем, что в ней записано"""
+    settings = Settings.query.first()
+    _switch_active_version(settings, version)
+    bump_schedule_revision(settings)
+    db.session.commit()
+
+    prune_versions()
+
+
+def activate_version(version_id):
+    """Откат: делает активной одну из сохраненных версий"""
+    version = ScheduleVersion.query.get(version_id)
+    if version is None or version.status != 'archived':
+        return False
+
+    settings = Settings.query.first()
+    _switch_active_version(settings, version)
+    bump_schedule_revision(settings)
+    db.session.commit()
+    return True
+
+
+def bulk_insert(table, columns, rows):
+    """
+    Вставляет строки в таблицу одним executemany драйвера БД в текущей транзакции.
+    rows - кортежи значений в порядке columns. Подготовка параметров в SQLAlchemy для десятков
+    тысяч строк занимает больше времени, чем сама вставка, поэтому строки передаются драйверу как есть.
+    """
+    columns = list(columns)
+    statement = table.insert().compile(dialect=db.engine.dialect, column_keys=columns)
+    if statement.positional:
+        order = [columns.index(name) for name in statement.positiontup]
+        if order != list(range(len(columns))):
+            rows = [tuple(row[i] for i in order) for row in rows]
+    else:
+        rows = [dict(zip(columns, row)) for row in rows]
+    db.session.connection().exec_driver_sql(str(statement), rows)
+
+
+def bulk_link_item_groups(version_id, item_group_ids, after_id=0):
+    """
+    Записывает группы занятий, только что вставленных в версию через bulk_insert.
+    item_group_ids - списки id групп в том же порядке, в котором вставлялись занятия;
+    id занятий возрастают в порядке вставки. after_id - наибольший id занятий версии до вставки
+    (0 для новой версии).
+    """
+    items = ScheduleItem.__table__
+    item_ids = db.session.connection().execute(
+        select(items.c.id).where(items.c.version_id == version_id, items.c.id > after_id).order_by(items.c.id)
+    ).scalars().all()
+    if len(item_ids) != len(item_group_ids):
+        raise RuntimeError(f"В версии {version_id} {len(item_ids)} занятий, а групп передано для "
+                           f"{len(item_group_ids)}")
+
+    rows = [(item_id, group_id) for item_id, group_ids in zip(item_ids, item_group_ids) for group_id in group_ids]
+    if rows:
+        bulk_insert(schedule_item_group, ('schedule_item_id', 'group_id'), rows)
+
+
+def delete_schedule_items(item_ids, batch_size=500):
+    """Удаляет занятия по id вместе с их связями с группами (без фиксации транзакции)"""
+    item_ids = list(item_ids)
+    for start in range(0, len(item_ids), batch_size):
+        batch = item_ids[start:start + batch_size]
+        db.session.execute(schedule_item_group.delete().where(schedule_item_group.c.schedule_item_id.in_(batch)))
+        ScheduleItem.query.filter(ScheduleItem.id.in_(batch)).delete(synchronize_session=False)
+
+
+def delete_version_items(version_id):
+    """Удаляет занятия версии вместе с их связями с группами и готовыми документами расписания"""
+    TimetableDocument.query.filter_by(version_id=version_id).delete()
+    item_ids = select(ScheduleItem.id).where(ScheduleItem.version_id == version_id)
+    db.session.execute(schedule_item_group.delete().where(schedule_item_group.c.schedule_item_id.in_(item_ids)))
+    ScheduleItem.query.filter_by(version_id=version_id).delete()
+
+
+def discard_version(version):
+    """Удаляет неопубликованную версию вместе с ее элементами"""
+    delete_version_items(version.id)
+    db.session.delete(version)
+    db.session.commit()
+
+
+def prune_versions(keep=MAX_ARCHIVED_VERSIONS):
+    """Удаляет самые старые архивные версии сверх keep"""
+    archived = (ScheduleVersion.query.filter_by(status='archived')
+                .order_by(ScheduleVersion.activated_at.desc(), ScheduleVersion.id.desc())
+                .all())
+    for version in archived[keep:]:
+        delete_version_items(version.id)
+        db.session.delete(version)
+    db.session.commit()
+
+
+def copy_schedule_item(item, version_id):
+    return ScheduleItem(
+        version_id=version_id,
+        course_id=item.course_id,
+        room_id=item.room_id,
+        teacher_id=item.teacher_id,
+        week=item.week,
+        day=item.day,
+        time_slot=item.time_slot,
+        lesson_type=item.lesson_type,
+        groups=item.groups,
+        assigned_groups=list(item.assigned_groups),
+        lab_subgroup_id=item.lab_subgroup_id,
+        is_manually_placed=item.is_manually_placed,
+        notes=item.notes
+    )
+
+
+def _switch_active_version(settings, version):
+    if settings.active_schedule_version_id is not None:
+        previous = ScheduleVersion.query.get(settings.active_schedule_version_id)
+        if previous is not None and previous.id != version.id:
+            previous.status = 'archived'
+
+    version.status = 'active'
+    version.activated_at = datetime.utcnow()
+    settings.active_schedule_version_id = version.id